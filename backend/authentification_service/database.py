@@ -1,9 +1,10 @@
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
 import os
+from common import metrics, serving
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/scidata")
-engine = create_engine(DATABASE_URL)
+engine = serving.create_engine(DATABASE_URL)
+metrics.instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
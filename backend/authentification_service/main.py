@@ -1,21 +1,13 @@
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI
 from routes import router
-from database import Base, engine, SessionLocal
-import models
-from contextlib import asynccontextmanager
+from database import SessionLocal
+import tokens, utils
+from common import metrics, profiling, ratelimit, tracing
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    try:
-        Base.metadata.create_all(bind=engine)
-        print("Database tables created successfully")
-    except Exception as e:
-        print(f"Error creating database tables: {e}")
-    yield
-    print("Application shutdown")
-
-app = FastAPI(lifespan=lifespan)
+# Схему базы создают миграции (alembic upgrade head, см. common/migrations.py),
+# а не каждый под при старте
+app = FastAPI()
 
 origins = [
     "http://localhost",
@@ -30,7 +22,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+ratelimit.install(app, expensive_routes=(r"/login$", r"/register$"))
+metrics.install(app)
+tracing.install(app, "auth-service")
+profiling.install(app, "auth-service")
+
 app.include_router(router, prefix="", tags=["auth"])
+tokens.install(app, SessionLocal)
+
+# Стоимость хеша пароля подбирается под железо пода один раз при старте
+utils.hasher()
 
 @app.get("/health")
 async def health_check():
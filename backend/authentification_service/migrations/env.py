@@ -0,0 +1,18 @@
+"""Окружение Alembic для auth_service: схема — models.Base.metadata"""
+import os
+import sys
+from logging.config import fileConfig
+
+from alembic import context
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули сервиса и common — как при запуске uvicorn из каталога сервиса
+sys.path[:0] = [SERVICE_DIR, os.path.dirname(SERVICE_DIR)]
+
+import models  # noqa: E402
+from common import migrations  # noqa: E402
+
+if context.config.config_file_name is not None:
+    fileConfig(context.config.config_file_name, disable_existing_loggers=False)
+
+migrations.run(context, models.Base.metadata, version_table="alembic_version_auth")
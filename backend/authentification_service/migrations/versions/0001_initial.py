@@ -0,0 +1,32 @@
+"""Таблица пользователей
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from common.migrations import has_table
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # База, созданная прежним create_all, уже содержит таблицу
+    if has_table(op.get_bind(), "users"):
+        return
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String(), nullable=False, unique=True),
+        sa.Column("password_hash", sa.String(), nullable=False),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+
+
+def downgrade():
+    op.drop_table("users")
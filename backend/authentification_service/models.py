@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Float, ForeignKey, Integer, String
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -6,4 +6,22 @@ class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, nullable=False)
-    password_hash = Column(String, nullable=False)
\ No newline at end of file
+    password_hash = Column(String, nullable=False)
+
+class RefreshToken(Base):
+    """Refresh-токен хранится как SHA-256; токены одной цепочки ротации — одно family (см. tokens.py)"""
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64), unique=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
+    family = Column(String(32), index=True, nullable=False)
+    created_at = Column(Float, nullable=False)
+    expires_at = Column(Float, index=True, nullable=False)
+    revoked_at = Column(Float, nullable=True)
+
+class RevokedToken(Base):
+    """Отозванный access-токен; строка нужна только до истечения токена"""
+    __tablename__ = "revoked_tokens"
+    id = Column(Integer, primary_key=True)
+    jti = Column(String(32), unique=True, nullable=False)
+    expires_at = Column(Float, index=True, nullable=False)
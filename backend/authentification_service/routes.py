@@ -1,14 +1,21 @@
 from fastapi import APIRouter, Depends, HTTPException, Body, Header
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from database import SessionLocal
-import models, utils
+import hmac, os
+import models, tokens, users, utils
 from pydantic import BaseModel
-import os, time, jwt
 
 class UserModel(BaseModel):
     username: str
     password: str
 
+class RefreshModel(BaseModel):
+    refresh_token: str
+
+class IntrospectModel(BaseModel):
+    tokens: list[str]
+
 
 router = APIRouter()
 
@@ -22,7 +29,8 @@ def get_db():
 @router.post("/register")
 async def register(user: UserModel, db: Session = Depends(get_db)):
 
-    if db.query(models.User).filter_by(username=user.username).first():
+    # Регистрация проверяет базу, а не кэш: имя могла занять другая реплика
+    if users.cache.lookup(db, user.username):
         raise HTTPException(status_code=400, detail="User already exists")
     
     if len(user.username) < 3:
@@ -34,44 +42,76 @@ async def register(user: UserModel, db: Session = Depends(get_db)):
     )
 
     db.add(user_obj)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Имя одновременно зарегистрировал другой запрос
+        db.rollback()
+        raise HTTPException(status_code=400, detail="User already exists")
     db.refresh(user_obj)
+    users.cache.put(user_obj)
     return {"username": user.username}
 
 @router.post("/login")
 async def login(user: UserModel, db: Session = Depends(get_db)):
 
-    db_user = db.query(models.User).filter_by(username=user.username).first()
-    if not db_user or not utils.verify_password(user.password, db_user.password_hash):
+    db_user = users.cache.find(db, user.username)
+    if db_user is None:
+        utils.verify_dummy(user.password)
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    jwt_secret = os.getenv("JWT_SECRET", "myjwtsecret")
-    jwt_algorithm = "HS256"
-    expires_in_seconds = int(os.getenv("JWT_EXPIRES_IN", "3600"))
-    payload = {
-        "sub": str(db_user.id),
-        "username": db_user.username,
-        "iat": int(time.time()),
-        "exp": int(time.time()) + expires_in_seconds
-    }
-    token = jwt.encode(payload, jwt_secret, algorithm=jwt_algorithm)
-    return {"message": "Login successful", "access_token": token, "token_type": "Bearer", "expires_in": expires_in_seconds}
+    if not utils.verify_password(user.password, db_user.password_hash):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if utils.needs_rehash(db_user.password_hash):
+        users.rehash(db, db_user, user.password)
+
+    return {"message": "Login successful", **tokens.token_pair(db, db_user.id, db_user.username)}
+
+@router.post("/refresh")
+async def refresh(body: RefreshModel, db: Session = Depends(get_db)):
+    return tokens.rotate(db, body.refresh_token)
+
+def bearer_token(authorization: str | None):
+    if not authorization or not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
+    return authorization.split(" ", 1)[1]
 
 @router.post("/logout")
-async def logout():
+async def logout(body: RefreshModel | None = None, authorization: str | None = Header(default=None),
+                 db: Session = Depends(get_db)):
+    """Отзывает access-токен из заголовка и цепочку refresh-токена из тела, если они переданы"""
+    if authorization:
+        try:
+            tokens.revoke_access(db, tokens.decode_access(bearer_token(authorization)))
+        except HTTPException:
+            # Истёкший или уже отозванный токен отзывать не нужно
+            pass
+    if body is not None:
+        row = db.query(models.RefreshToken).filter_by(token_hash=tokens.hash_token(body.refresh_token)).first()
+        if row is not None:
+            tokens.revoke_family(db, row.family)
+            db.commit()
     return {"message": "Logged out"}
 
 @router.get("/check-session")
 async def check_session(authorization: str | None = Header(default=None)):
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    token = authorization.split(" ", 1)[1]
-    jwt_secret = os.getenv("JWT_SECRET", "myjwtsecret")
-    jwt_algorithm = "HS256"
-    try:
-        payload = jwt.decode(token, jwt_secret, algorithms=[jwt_algorithm])
-        return {"user_id": int(payload.get("sub")), "username": payload.get("username")}
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    payload = tokens.decode_access(bearer_token(authorization))
+    return {"user_id": int(payload.get("sub")), "username": payload.get("username")}
+
+@router.post("/introspect")
+async def introspect(body: IntrospectModel, x_service_token: str | None = Header(default=None)):
+    """Пакетная проверка access-токенов для других сервисов (см. common/auth.py);
+    только подпись, срок и список отзыва в памяти — без запросов к базе"""
+    expected = os.getenv("INTROSPECTION_TOKEN")
+    if expected and not hmac.compare_digest(x_service_token or "", expected):
+        raise HTTPException(status_code=403, detail="Invalid service token")
+    if len(body.tokens) > tokens.MAX_INTROSPECT_BATCH:
+        raise HTTPException(status_code=400, detail=f"No more than {tokens.MAX_INTROSPECT_BATCH} tokens per request")
+    results = []
+    for token in body.tokens:
+        try:
+            payload = tokens.decode_access(token)
+        except HTTPException as e:
+            results.append({"active": False, "reason": e.detail})
+            continue
+        results.append({"active": True, "user_id": int(payload["sub"]), "username": payload.get("username"), "exp": payload.get("exp")})
+    return {"results": results}
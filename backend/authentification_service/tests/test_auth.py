@@ -3,7 +3,8 @@ import sys
 import os
 from pathlib import Path
 
-# Добавляем родительский каталог в путь для импорта
+# Добавляем каталог сервиса и backend (общий пакет common) в путь для импорта
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from fastapi.testclient import TestClient
@@ -13,7 +14,7 @@ from unittest.mock import patch
 
 from main import app
 from database import Base
-import utils
+import models, users, utils
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
@@ -22,9 +23,6 @@ TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engin
 import database
 database.engine = engine
 
-import main
-main.engine = engine
-
 import routes
 routes.SessionLocal = TestingSessionLocal
 
@@ -43,6 +41,7 @@ app.dependency_overrides[get_db] = override_get_db
 @pytest.fixture(scope="function")
 def setup_database():
     Base.metadata.create_all(bind=engine)
+    users.cache.clear()
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -174,6 +173,102 @@ class TestLogout:
         assert response.status_code == 200
         assert "Logged out" in response.json()["message"]
 
+class TestTokens:
+    """Тесты refresh-токенов и отзыва access-токенов"""
+
+    @pytest.fixture(autouse=True)
+    def clean_revocations(self):
+        import tokens
+        tokens.revocations.clear()
+        yield
+        tokens.revocations.clear()
+
+    def login(self, client, test_user_data):
+        client.post("/register", json=test_user_data)
+        return client.post("/login", json=test_user_data).json()
+
+    def test_refresh_rotates_and_detects_reuse(self, client, setup_database, test_user_data):
+        """Refresh-токен обменивается один раз; повторное предъявление отзывает всю цепочку"""
+        first = self.login(client, test_user_data)
+        second = client.post("/refresh", json={"refresh_token": first["refresh_token"]})
+        assert second.status_code == 200
+        second = second.json()
+        assert second["refresh_token"] != first["refresh_token"]
+        headers = {"Authorization": f"Bearer {second['access_token']}"}
+        assert client.get("/check-session", headers=headers).json()["username"] == test_user_data["username"]
+
+        reused = client.post("/refresh", json={"refresh_token": first["refresh_token"]})
+        assert reused.status_code == 401
+        assert client.post("/refresh", json={"refresh_token": second["refresh_token"]}).status_code == 401
+        assert client.post("/refresh", json={"refresh_token": "unknown"}).status_code == 401
+
+    def test_logout_revokes_tokens(self, client, setup_database, test_user_data):
+        """Выход отзывает access-токен и refresh-токен; проверка отзыва не обращается к базе"""
+        from sqlalchemy import event
+        tokens_ = self.login(client, test_user_data)
+        headers = {"Authorization": f"Bearer {tokens_['access_token']}"}
+        response = client.post("/logout", headers=headers, json={"refresh_token": tokens_["refresh_token"]})
+        assert response.status_code == 200
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            response = client.get("/check-session", headers=headers)
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert response.status_code == 401
+        assert response.json()["detail"] == "Token revoked"
+        assert statements == []
+        assert client.post("/refresh", json={"refresh_token": tokens_["refresh_token"]}).status_code == 401
+
+    def test_revocation_from_other_replica(self, client, setup_database, test_user_data):
+        """Отзыв, записанный другой репликой, подхватывается синхронизацией; истёкшие jti забываются"""
+        import jwt, tokens
+        access = self.login(client, test_user_data)["access_token"]
+        payload = jwt.decode(access, options={"verify_signature": False})
+        db = TestingSessionLocal()
+        try:
+            db.add(models.RevokedToken(jti=payload["jti"], expires_at=float(payload["exp"])))
+            db.commit()
+            replica = tokens.RevocationList()
+            replica.sync(db)
+            assert replica.is_revoked(payload["jti"])
+
+            with patch('tokens.time.time', return_value=payload["exp"] + 1):
+                replica.sync(db)
+            assert not replica.is_revoked(payload["jti"])
+        finally:
+            db.close()
+
+class TestIntrospection:
+    """Тесты пакетной проверки токенов для других сервисов"""
+
+    def test_batch_results_in_order(self, client, setup_database, test_user_data):
+        """Ответы идут в порядке токенов; отозванный и поддельный токены неактивны"""
+        import tokens
+        client.post("/register", json=test_user_data)
+        active = client.post("/login", json=test_user_data).json()["access_token"]
+        revoked = client.post("/login", json=test_user_data).json()["access_token"]
+        client.post("/logout", headers={"Authorization": f"Bearer {revoked}"})
+
+        response = client.post("/introspect", json={"tokens": [active, revoked, "garbage"]})
+        tokens.revocations.clear()
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert results[0]["active"] is True
+        assert results[0]["username"] == test_user_data["username"]
+        assert results[1] == {"active": False, "reason": "Token revoked"}
+        assert results[2] == {"active": False, "reason": "Invalid token"}
+
+    def test_service_token_and_batch_limit(self, client):
+        """С INTROSPECTION_TOKEN нужен заголовок X-Service-Token; пакет ограничен по размеру"""
+        with patch.dict(os.environ, {"INTROSPECTION_TOKEN": "s3cret"}):
+            assert client.post("/introspect", json={"tokens": []}).status_code == 403
+            response = client.post("/introspect", json={"tokens": []}, headers={"X-Service-Token": "s3cret"})
+            assert response.json() == {"results": []}
+        assert client.post("/introspect", json={"tokens": ["t"] * 101}).status_code == 400
+
 class TestPasswordHashing:
     """Тесты хеширования паролей"""
     
@@ -201,6 +296,13 @@ class TestPasswordHashing:
         
         assert utils.verify_password(wrong_password, hashed) == False
     
+    def test_verify_argon2_without_package(self, caplog):
+        """Хеш argon2 без пакета argon2-cffi отклоняется с записью в лог, а не ошибкой"""
+        hashed = "$argon2id$v=19$m=19456,t=2,p=1$c2FsdHNhbHQ$aGFzaGhhc2hoYXNo"
+        with patch.dict(sys.modules, {"argon2": None}):
+            assert utils.verify_password("testpassword123", hashed) is False
+        assert "argon2-cffi" in caplog.text
+
     def test_hash_password_different_salts(self):
         """Тест что одинаковые пароли дают разные хеши"""
         password = "testpassword123"
@@ -212,6 +314,98 @@ class TestPasswordHashing:
         assert utils.verify_password(password, hashed1) == True
         assert utils.verify_password(password, hashed2) == True
 
+    def test_calibration_picks_cost_for_target(self):
+        """Стоимость bcrypt подбирается по времени хеша на малой стоимости и не опускается ниже минимума"""
+        with patch('utils._best_of', return_value=0.02):
+            assert utils.calibrate_bcrypt(0.25, min_rounds=4) == 11
+            assert utils.calibrate_bcrypt(0.01, min_rounds=10) == 10
+            assert utils.calibrate_bcrypt(1000, min_rounds=4) == utils.MAX_BCRYPT_ROUNDS
+
+    def test_hash_carries_parameters(self):
+        """Хеш хранит стоимость; пересчёта требует только более слабый хеш или другая схема"""
+        weak = utils.Hasher(rounds=4).hash("secret")
+        assert weak.startswith("$2b$04$")
+        current = utils.Hasher(rounds=5)
+        assert current.needs_rehash(weak)
+        assert not current.needs_rehash(current.hash("secret"))
+        assert not current.needs_rehash(utils.Hasher(rounds=6).hash("secret"))
+        assert current.verify("secret", weak)
+
+    def test_login_upgrades_outdated_hash(self, client, setup_database, test_user_data):
+        """Успешный вход пересчитывает хеш со стоимостью ниже текущей"""
+        with patch('utils._hasher', utils.Hasher(rounds=4)):
+            client.post("/register", json=test_user_data)
+        with patch('utils._hasher', utils.Hasher(rounds=5)):
+            assert client.post("/login", json=test_user_data).status_code == 200
+            db = TestingSessionLocal()
+            try:
+                stored = db.query(models.User).filter_by(username=test_user_data["username"]).one().password_hash
+            finally:
+                db.close()
+            assert stored.startswith("$2b$05$")
+            assert users.cache.get(test_user_data["username"])[1].password_hash == stored
+            assert client.post("/login", json=test_user_data).status_code == 200
+
+class TestUserCache:
+    """Тесты кэша поиска пользователей"""
+
+    @pytest.fixture
+    def queries(self):
+        from sqlalchemy import event
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        yield statements
+        event.remove(engine, "before_cursor_execute", listener)
+
+    def test_repeated_login_skips_database(self, client, setup_database, test_user_data, queries):
+        """Повторный вход и неверный пароль проверяются по кэшу без поиска пользователя в базе"""
+        client.post("/register", json=test_user_data)
+        queries.clear()
+
+        assert client.post("/login", json=test_user_data).status_code == 200
+        wrong = {**test_user_data, "password": "wrongpassword"}
+        assert client.post("/login", json=wrong).status_code == 401
+        assert [q for q in queries if "FROM users" in q] == []
+
+    def test_unknown_users_skip_database(self, client, setup_database, queries):
+        """Разные неизвестные имена отклоняются по множеству имён: один запрос к базе, bcrypt всегда"""
+        with patch('utils.verify_password', wraps=utils.verify_password) as verify:
+            for i in range(3):
+                unknown = {"username": f"ghost{i}", "password": "whatever123"}
+                assert client.post("/login", json=unknown).status_code == 401
+        assert verify.call_count == 3
+        assert len([q for q in queries if "FROM users" in q]) == 1
+
+    def test_register_replaces_negative_entry(self, client, setup_database, test_user_data):
+        """После регистрации имя, запомненное как отсутствующее, сразу входит"""
+        assert client.post("/login", json=test_user_data).status_code == 401
+        assert client.post("/register", json=test_user_data).status_code == 200
+        assert client.post("/login", json=test_user_data).status_code == 200
+        assert client.post("/register", json=test_user_data).status_code == 400
+
+    def test_names_refresh_and_cache_is_bounded(self, setup_database):
+        """Множество имён перечитывается через names_refresh секунд, кэш не растёт сверх max_items"""
+        cache = users.UserCache(max_items=2, names_refresh=5)
+        db = TestingSessionLocal()
+        try:
+            with patch('users.time.monotonic', return_value=100.0):
+                assert cache.find(db, "ghost") is None
+            # Пользователя добавила другая реплика
+            db.add(models.User(username="ghost", password_hash="hash"))
+            db.commit()
+            with patch('users.time.monotonic', return_value=104.0):
+                assert cache.find(db, "ghost") is None
+            with patch('users.time.monotonic', return_value=106.0):
+                assert cache.find(db, "ghost").username == "ghost"
+        finally:
+            db.close()
+
+        for i in range(3):
+            cache.put(users.CachedUser(i, f"user{i}", "hash"))
+        assert cache.get("user2")[1].id == 2
+        assert cache.get("user0") == (False, None)
+
 class TestHealthCheck:
     """Тесты проверки здоровья сервиса"""
     
@@ -223,6 +417,21 @@ class TestHealthCheck:
         assert data["status"] == "healthy"
         assert data["service"] == "auth-service"
 
+class TestMetrics:
+    """Тесты эндпоинта метрик"""
+
+    def test_metrics_endpoint(self, client, setup_database, test_user_data):
+        """Задержки маршрутов, время bcrypt и SQL-запросов попадают в /metrics"""
+        client.post("/register", json=test_user_data)
+        client.post("/login", json=test_user_data)
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        body = response.text
+        assert 'http_request_duration_seconds_count{method="POST",route="/login",status="200"}' in body
+        assert 'password_hash_duration_seconds_count{operation="verify"}' in body
+        assert "db_query_duration_seconds_count" in body
+
 class TestIntegration:
     """Интеграционные тесты полного цикла"""
     
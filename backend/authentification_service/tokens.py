@@ -0,0 +1,227 @@
+"""Access- и refresh-токены.
+
+Access-токен — JWT на JWT_EXPIRES_IN секунд (по умолчанию 15 минут) с уникальным
+jti. Refresh-токен — случайная строка на REFRESH_TOKEN_EXPIRES_IN секунд
+(по умолчанию 30 дней); в базе хранится только её SHA-256. POST /refresh
+обменивает refresh-токен на новую пару, а старый refresh-токен отзывается.
+Повторное предъявление отозванного refresh-токена означает, что его
+скопировали: отзывается вся цепочка ротации (family).
+
+POST /logout отзывает access-токен из Authorization и цепочку refresh-токена
+из тела запроса. Отозванные jti хранятся в таблице revoked_tokens до истечения
+токена и в памяти процесса: /check-session проверяет множество в памяти без
+обращения к базе. Фоновый поток дочитывает новые строки revoked_tokens
+с периодом REVOCATION_SYNC_SECONDS (по умолчанию 1), поэтому отзыв в другой
+реплике виден здесь не позже чем через этот период.
+"""
+import hashlib
+import os
+import secrets
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import jwt
+from fastapi import FastAPI, HTTPException
+from sqlalchemy import delete, select, update
+
+import models
+
+JWT_ALGORITHM = "HS256"
+FULL_SYNC_SECONDS = 60
+PRUNE_INTERVAL_SECONDS = 600
+MAX_INTROSPECT_BATCH = 100
+
+
+def jwt_secret():
+    return os.getenv("JWT_SECRET", "myjwtsecret")
+
+
+def access_ttl():
+    return int(os.getenv("JWT_EXPIRES_IN", "900"))
+
+
+def refresh_ttl():
+    return int(os.getenv("REFRESH_TOKEN_EXPIRES_IN", str(30 * 24 * 3600)))
+
+
+def hash_token(token):
+    # У refresh-токена 256 бит случайности: медленный хеш не нужен
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def issue_access(user_id, username):
+    now = int(time.time())
+    expires_in = access_ttl()
+    payload = {
+        "sub": str(user_id),
+        "username": username,
+        "jti": uuid.uuid4().hex,
+        "iat": now,
+        "exp": now + expires_in,
+    }
+    return jwt.encode(payload, jwt_secret(), algorithm=JWT_ALGORITHM), expires_in
+
+
+def issue_refresh(db, user_id, family=None):
+    """Добавляет refresh-токен в текущую транзакцию; возвращает сам токен"""
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    db.add(models.RefreshToken(
+        token_hash=hash_token(token), user_id=user_id, family=family or uuid.uuid4().hex,
+        created_at=now, expires_at=now + refresh_ttl(),
+    ))
+    return token
+
+
+def token_pair(db, user_id, username, family=None):
+    """Ответ /login и /refresh; фиксирует транзакцию"""
+    refresh_token = issue_refresh(db, user_id, family)
+    db.commit()
+    access_token, expires_in = issue_access(user_id, username)
+    return {
+        "access_token": access_token,
+        "token_type": "Bearer",
+        "expires_in": expires_in,
+        "refresh_token": refresh_token,
+        "refresh_expires_in": refresh_ttl(),
+    }
+
+
+def revoke_family(db, family):
+    c = models.RefreshToken
+    db.execute(update(c).where(c.family == family, c.revoked_at.is_(None)).values(revoked_at=time.time()))
+
+
+def rotate(db, refresh_token):
+    """Отзывает предъявленный refresh-токен и выдаёт новую пару в той же цепочке"""
+    c = models.RefreshToken
+    row = db.execute(
+        select(c.id, c.user_id, c.family, c.expires_at, c.revoked_at, models.User.username)
+        .join(models.User, models.User.id == c.user_id)
+        .where(c.token_hash == hash_token(refresh_token))
+    ).first()
+    now = time.time()
+    if row is None or row.expires_at <= now:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    # Условный UPDATE: из двух одновременных обменов одного токена успешен один
+    rotated = db.execute(update(c).where(c.id == row.id, c.revoked_at.is_(None)).values(revoked_at=now)).rowcount
+    if not rotated:
+        revoke_family(db, row.family)
+        db.commit()
+        raise HTTPException(status_code=401, detail="Refresh token reused")
+    return token_pair(db, row.user_id, row.username, row.family)
+
+
+def decode_access(token):
+    try:
+        payload = jwt.decode(token, jwt_secret(), algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if revocations.is_revoked(payload.get("jti")):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    return payload
+
+
+def revoke_access(db, payload):
+    """Отзывает access-токен до его истечения; токены без jti (выданные раньше) не отзываются"""
+    jti = payload.get("jti")
+    if not jti or revocations.is_revoked(jti):
+        return
+    db.add(models.RevokedToken(jti=jti, expires_at=float(payload["exp"])))
+    db.commit()
+    revocations.add(jti, float(payload["exp"]))
+
+
+class RevocationList:
+    """jti отозванных неистёкших access-токенов; размер ограничен временем жизни токена"""
+
+    def __init__(self, sync_seconds=1.0):
+        self.sync_seconds = sync_seconds
+        self._revoked = {}
+        self._last_id = 0
+        self._last_full_sync = 0.0
+        self._last_pruned = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(sync_seconds=float(os.getenv("REVOCATION_SYNC_SECONDS", "1")))
+
+    def is_revoked(self, jti):
+        return jti is not None and jti in self._revoked
+
+    def add(self, jti, expires_at):
+        self._revoked[jti] = expires_at
+
+    def clear(self):
+        self._revoked = {}
+        self._last_id = 0
+
+    def sync(self, db):
+        """Дочитывает новые строки revoked_tokens и забывает истёкшие; раз в FULL_SYNC_SECONDS
+        перечитывает все строки, чтобы подобрать транзакции, зафиксированные не по порядку id"""
+        now = time.time()
+        c = models.RevokedToken
+        full = now - self._last_full_sync >= FULL_SYNC_SECONDS
+        query = select(c.id, c.jti, c.expires_at).where(c.expires_at > now)
+        if not full:
+            query = query.where(c.id > self._last_id)
+        rows = db.execute(query).all()
+        # Словарь заменяется целиком: читатели в других потоках не блокируются
+        revoked = {jti: expires for jti, expires in self._revoked.items() if expires > now}
+        for row in rows:
+            revoked[row.jti] = row.expires_at
+            self._last_id = max(self._last_id, row.id)
+        self._revoked = revoked
+        if full:
+            self._last_full_sync = now
+        if now - self._last_pruned >= PRUNE_INTERVAL_SECONDS:
+            self._last_pruned = now
+            db.execute(delete(c).where(c.expires_at <= now))
+            db.execute(delete(models.RefreshToken).where(models.RefreshToken.expires_at <= now))
+            db.commit()
+
+    def run(self, session_factory):
+        while not self._stop.is_set():
+            db = session_factory()
+            try:
+                self.sync(db)
+            except Exception as e:
+                print(f"Не удалось прочитать отозванные токены: {e}")
+            finally:
+                db.close()
+            self._stop.wait(self.sync_seconds)
+
+    def start(self, session_factory):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(session_factory,), name="token-revocations", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.sync_seconds + 1)
+
+
+revocations = RevocationList.from_env()
+
+
+def install(app: FastAPI, session_factory):
+    """Синхронизирует список отзыва с базой на время жизни приложения"""
+    previous = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app_):
+        revocations.start(session_factory)
+        try:
+            async with previous(app_) as state:
+                yield state
+        finally:
+            revocations.stop()
+
+    app.router.lifespan_context = lifespan
@@ -0,0 +1,131 @@
+"""Кэш поиска пользователей по имени для /login и /register.
+
+Найденные пользователи (id и хеш пароля) хранятся в LRU ограниченного размера,
+поэтому повторные входы не обращаются к базе. Рядом хранится множество всех
+имён из базы: имя, которого в нём нет, отклоняется без запроса, так что
+перебор произвольных несуществующих имён не нагружает базу. Множество
+перечитывается одним запросом не чаще раза в USER_NAMES_REFRESH_SECONDS;
+регистрация в этом процессе добавляет имя сразу, пользователь,
+зарегистрированный другой репликой, виден здесь не позже чем через
+USER_NAMES_REFRESH_SECONDS. Сама регистрация всегда проверяет имя по базе.
+
+    USER_CACHE_SIZE              — записей в кэше (по умолчанию 10000)
+    USER_NAMES_REFRESH_SECONDS   — как часто перечитывать имена из базы (по умолчанию 5)
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from prometheus_client import Counter
+from sqlalchemy import update
+
+import models, utils
+
+USER_LOOKUPS = Counter("user_cache_lookups_total", "Поиск пользователя по имени", ["result"])
+
+
+class CachedUser(NamedTuple):
+    id: int
+    username: str
+    password_hash: str
+
+
+class UserCache:
+    def __init__(self, max_items=10000, names_refresh=5.0):
+        self.max_items = max_items
+        self.names_refresh = names_refresh
+        self._items = OrderedDict()
+        self._names = set()
+        self._names_until = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_items=int(os.getenv("USER_CACHE_SIZE", "10000")),
+            names_refresh=float(os.getenv("USER_NAMES_REFRESH_SECONDS", "5")),
+        )
+
+    def _store(self, username, value):
+        with self._lock:
+            self._names.add(username)
+            self._items[username] = value
+            self._items.move_to_end(username)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def put(self, user):
+        cached = CachedUser(user.id, user.username, user.password_hash)
+        self._store(user.username, cached)
+        return cached
+
+    def forget(self, username):
+        with self._lock:
+            self._items.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._names.clear()
+            self._names_until = None
+
+    def _refresh_names(self, db):
+        """Перечитывает множество имён, если оно устарело; при names_refresh <= 0 не ведётся"""
+        if self.names_refresh <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if self._names_until is not None and self._names_until > now:
+                return True
+        names = {name for (name,) in db.query(models.User.username)}
+        with self._lock:
+            # Имена, добавленные этим процессом во время чтения, не теряются
+            self._names |= names
+            self._names_until = now + self.names_refresh
+        return True
+
+    def get(self, username):
+        """(True, пользователь или None), если ответ известен без базы, иначе (False, None)"""
+        with self._lock:
+            value = self._items.get(username)
+            if value is not None:
+                self._items.move_to_end(username)
+                return True, value
+            if self._names_until is not None and self._names_until > time.monotonic() and username not in self._names:
+                return True, None
+            return False, None
+
+    def lookup(self, db, username):
+        """Поиск по базе в обход кэша; найденный пользователь попадает в кэш"""
+        db_user = db.query(models.User).filter_by(username=username).first()
+        return self.put(db_user) if db_user is not None else None
+
+    def find(self, db, username):
+        known, user = self.get(username)
+        if not known and self._refresh_names(db):
+            known, user = self.get(username)
+        if known:
+            USER_LOOKUPS.labels("hit" if user else "negative_hit").inc()
+            return user
+        USER_LOOKUPS.labels("miss").inc()
+        return self.lookup(db, username)
+
+
+def rehash(db, user, password):
+    """Пересчитывает хеш пароля с текущими параметрами после успешного входа"""
+    new_hash = utils.hash_password(password)
+    c = models.User
+    # Условие на старый хеш: если хеш уже заменил другой вход, его запись остаётся
+    updated = db.execute(
+        update(c).where(c.id == user.id, c.password_hash == user.password_hash).values(password_hash=new_hash)
+    ).rowcount
+    db.commit()
+    if updated:
+        cache.put(CachedUser(user.id, user.username, new_hash))
+    else:
+        cache.forget(user.username)
+
+
+cache = UserCache.from_env()
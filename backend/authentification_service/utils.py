@@ -1,10 +1,171 @@
-import bcrypt, uuid
+"""Хеширование паролей.
+
+Хеш хранит свои параметры (схему, стоимость, соль), поэтому параметры можно
+менять без миграции: при успешном входе хеш со схемой или стоимостью слабее
+текущих пересчитывается (см. needs_rehash).
+
+    PASSWORD_HASH_SCHEME    — bcrypt (по умолчанию) или argon2id (нужен пакет argon2-cffi)
+    PASSWORD_HASH_TARGET_MS — желаемое время одного хеша; по нему при старте
+                              подбирается стоимость (по умолчанию 250)
+    BCRYPT_ROUNDS           — стоимость bcrypt без подбора
+    BCRYPT_MIN_ROUNDS       — нижняя граница подобранной стоимости (по умолчанию 10)
+    ARGON2_TIME_COST        — число проходов argon2id без подбора
+    ARGON2_MEMORY_KB        — память на один хеш argon2id (по умолчанию 19456, 19 МиБ)
+    ARGON2_PARALLELISM      — потоков на один хеш argon2id (по умолчанию 1)
+
+Память argon2id берётся на каждый одновременный вход: ARGON2_MEMORY_KB,
+умноженная на число одновременных входов в рабочем процессе, должна
+помещаться в лимит пода вместе с остальной памятью процесса.
+"""
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+
+import bcrypt
+
+from common import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+MAX_BCRYPT_ROUNDS = 16
+CALIBRATION_BCRYPT_ROUNDS = 8
+
+_dummy_hash = None
+_dummy_lock = threading.Lock()
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def _env_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def _best_of(runs, fn):
+    best = math.inf
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _argon2():
+    try:
+        import argon2
+    except ImportError:
+        raise RuntimeError("Для хешей argon2id нужен пакет argon2-cffi")
+    return argon2
+
+
+def calibrate_bcrypt(target_seconds, min_rounds):
+    """Стоимость bcrypt, при которой хеш занимает не больше target_seconds:
+    время измеряется на малой стоимости и удваивается с каждой единицей"""
+    probe = _best_of(3, lambda: bcrypt.hashpw(b"calibration", bcrypt.gensalt(CALIBRATION_BCRYPT_ROUNDS)))
+    rounds = CALIBRATION_BCRYPT_ROUNDS + math.floor(math.log2(max(target_seconds / probe, 1e-9)))
+    return max(min_rounds, min(rounds, MAX_BCRYPT_ROUNDS))
+
+
+def calibrate_argon2(target_seconds, memory_kb, parallelism):
+    """Число проходов argon2id под target_seconds; не меньше 2 при указанной памяти"""
+    argon2 = _argon2()
+    probe = argon2.PasswordHasher(time_cost=1, memory_cost=memory_kb, parallelism=parallelism)
+    single = _best_of(3, lambda: probe.hash("calibration"))
+    return max(2, math.floor(target_seconds / single))
+
+
+class Hasher:
+    def __init__(self, scheme="bcrypt", rounds=12, argon2_time_cost=2, argon2_memory_kb=19456, argon2_parallelism=1):
+        self.scheme = scheme
+        self.rounds = rounds
+        self.argon2 = None
+        if scheme == "argon2id":
+            self.argon2 = _argon2().PasswordHasher(
+                time_cost=argon2_time_cost, memory_cost=argon2_memory_kb, parallelism=argon2_parallelism,
+            )
+        elif scheme != "bcrypt":
+            raise RuntimeError(f"Неизвестная схема хеширования паролей: {scheme}")
+
+    @classmethod
+    def from_env(cls):
+        scheme = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt").lower()
+        target = float(os.getenv("PASSWORD_HASH_TARGET_MS", "250")) / 1000
+        if scheme == "argon2id":
+            memory_kb = _env_int("ARGON2_MEMORY_KB") or 19456
+            parallelism = _env_int("ARGON2_PARALLELISM") or 1
+            time_cost = _env_int("ARGON2_TIME_COST") or calibrate_argon2(target, memory_kb, parallelism)
+            return cls(scheme, argon2_time_cost=time_cost, argon2_memory_kb=memory_kb, argon2_parallelism=parallelism)
+        rounds = _env_int("BCRYPT_ROUNDS") or calibrate_bcrypt(target, _env_int("BCRYPT_MIN_ROUNDS") or 10)
+        return cls(scheme, rounds=rounds)
+
+    def hash(self, password):
+        if self.argon2 is not None:
+            return self.argon2.hash(password)
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)).decode('utf-8')
+
+    def verify(self, password, hashed):
+        if hashed.startswith("$argon2"):
+            try:
+                argon2 = _argon2()
+            except RuntimeError:
+                # Без argon2-cffi такой хеш не проверить: вход отклоняется, а не падает с 500
+                logger.error("Хеш argon2 не проверен: не установлен пакет argon2-cffi")
+                return False
+            try:
+                return argon2.PasswordHasher().verify(hashed, password)
+            except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+                return False
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+    def needs_rehash(self, hashed):
+        """Хеш другой схемы или слабее текущих параметров; более сильный хеш
+        не понижается, чтобы реплики с разной подобранной стоимостью не пересчитывали его по очереди"""
+        if self.argon2 is not None:
+            return not hashed.startswith("$argon2id$") or self.argon2.check_needs_rehash(hashed)
+        if not hashed.startswith("$2"):
+            return True
+        return int(hashed.split("$")[2]) < self.rounds
+
+
+def hasher():
+    """Параметры подбираются один раз на процесс; под gunicorn с preload — в главном процессе"""
+    global _hasher
+    with _hasher_lock:
+        if _hasher is None:
+            _hasher = Hasher.from_env()
+            metrics.PASSWORD_HASH_COST.labels(_hasher.scheme).set(
+                _hasher.argon2.time_cost if _hasher.argon2 is not None else _hasher.rounds
+            )
+        return _hasher
+
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    with metrics.timed(metrics.BCRYPT_SECONDS, operation="hash"), tracing.span("password.hash"):
+        return hasher().hash(password)
+
 
 def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    with metrics.timed(metrics.BCRYPT_SECONDS, operation="verify"), tracing.span("password.verify"):
+        return hasher().verify(password, hashed)
+
+
+def needs_rehash(hashed: str) -> bool:
+    return hasher().needs_rehash(hashed)
+
+
+def verify_dummy(password: str) -> bool:
+    """Та же работа хеширования, что и при проверке настоящего пароля: ответ для
+    несуществующего пользователя не отличается от неверного пароля по времени"""
+    global _dummy_hash
+    with _dummy_lock:
+        if _dummy_hash is None or needs_rehash(_dummy_hash):
+            _dummy_hash = hash_password(uuid.uuid4().hex)
+    verify_password(password, _dummy_hash)
+    return False
+
 
 def generate_session_id() -> str:
     return str(uuid.uuid4())
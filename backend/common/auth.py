@@ -0,0 +1,232 @@
+"""Проверка access-токенов в data_service и processing_service.
+
+Зависимость current_user сначала проверяет JWT локально (подпись JWT_SECRET
+и срок): поддельный или истёкший токен отклоняется без сетевых вызовов.
+Отзыв токена (logout) виден только auth_service, поэтому подлинный токен
+затем проверяется через POST /introspect. Токены одновременных запросов
+процесса собираются в один вызов за AUTH_BATCH_MS миллисекунд, ответы
+кэшируются на AUTH_CACHE_SECONDS, а HTTP-соединения с auth_service
+переиспользуются.
+
+Настройка переменными окружения:
+
+    AUTH_REQUIRED          — true: запрос без токена получает 401 (так запущены сервисы
+                             в docker-compose и k8s); false (по умолчанию, для локального
+                             запуска и тестов): без токена запрос анонимный, но переданный
+                             токен проверяется
+    DOWNLOAD_LINK_SECONDS  — срок подписанной ссылки на скачивание (по умолчанию 300)
+    AUTH_SERVICE_URL       — адрес auth_service; без него проверка только локальная
+    AUTH_CACHE_SECONDS     — сколько секунд помнить ответ introspect (по умолчанию 5);
+                             столько же отзыв токена может быть не виден здесь
+    AUTH_BATCH_MS          — окно сбора токенов в один вызов (по умолчанию 5)
+    AUTH_TIMEOUT_SECONDS   — таймаут вызова auth_service (по умолчанию 2)
+    INTROSPECTION_TOKEN    — общий с auth_service ключ заголовка X-Service-Token
+
+Если auth_service недоступен и ответа нет в кэше — 503: отозванный токен
+не принимается.
+
+Без токена при AUTH_REQUIRED доступны только:
+
+    /health, /metrics      — проверки kubelet и сбор метрик
+    /admin/                — защищены собственным ADMIN_TOKEN
+    /download/<имя>        — только по подписанной ссылке (sign_path): <img> и
+                             ссылки браузера не передают заголовок Authorization
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import jwt
+from fastapi import HTTPException, Request
+from prometheus_client import Counter
+
+EXEMPT_PATHS = ("/health", "/metrics", "/admin/")
+SIGNED_PATHS = ("/download/",)
+MAX_BATCH = 100
+
+INTROSPECTIONS = Counter("auth_introspection_total", "Проверки токенов через auth_service", ["result"])
+
+
+def _flag(name):
+    return os.getenv(name, "false").lower() in ("1", "true", "yes")
+
+
+class Introspector:
+    """Пакетная проверка токенов через auth_service с кэшем ответов.
+    Пакеты отправляет фоновый поток, поэтому проверку можно ждать из любого event loop"""
+
+    def __init__(self, url, cache_seconds=5.0, batch_seconds=0.005, timeout=2.0, service_token=None, max_items=10000):
+        self.url = url.rstrip("/")
+        self.cache_seconds = cache_seconds
+        self.batch_seconds = batch_seconds
+        self.timeout = timeout
+        self.service_token = service_token
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._client = None
+
+    @classmethod
+    def from_env(cls):
+        url = os.getenv("AUTH_SERVICE_URL")
+        if not url:
+            return None
+        return cls(
+            url,
+            cache_seconds=float(os.getenv("AUTH_CACHE_SECONDS", "5")),
+            batch_seconds=float(os.getenv("AUTH_BATCH_MS", "5")) / 1000,
+            timeout=float(os.getenv("AUTH_TIMEOUT_SECONDS", "2")),
+            service_token=os.getenv("INTROSPECTION_TOKEN") or None,
+        )
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def cached(self, token):
+        key = self._key(token)
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            result, until = item
+            if until <= time.monotonic():
+                del self._cache[key]
+                return None
+            return result
+
+    def _store(self, token, result, expires_at):
+        # Ответ не живёт дольше самого токена
+        ttl = min(self.cache_seconds, max(expires_at - time.time(), 0)) if expires_at else self.cache_seconds
+        with self._lock:
+            self._cache[self._key(token)] = (result, time.monotonic() + ttl)
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+
+    def submit(self, token, expires_at=None):
+        """Future с ответом introspect для токена; одинаковые токены в одном пакете проверяются один раз"""
+        result = self.cached(token)
+        if result is not None:
+            INTROSPECTIONS.labels("cached").inc()
+            future = Future()
+            future.set_result(result)
+            return future
+        with self._lock:
+            if token in self._pending:
+                return self._pending[token][0]
+            future = Future()
+            self._pending[token] = (future, expires_at)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="auth-introspect", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return future
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # Запросы, пришедшие за окно, попадут в тот же пакет
+            time.sleep(self.batch_seconds)
+            with self._lock:
+                self._wake.clear()
+                pending, self._pending = self._pending, {}
+            tokens = list(pending)
+            for start in range(0, len(tokens), MAX_BATCH):
+                self._send({token: pending[token] for token in tokens[start:start + MAX_BATCH]})
+
+    def _http(self):
+        if self._client is None:
+            # httpx загружается при первой проверке, а не при старте сервиса
+            import httpx
+            self._client = httpx.Client(
+                base_url=self.url, timeout=self.timeout,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            )
+        return self._client
+
+    def _send(self, batch):
+        headers = {"X-Service-Token": self.service_token} if self.service_token else {}
+        try:
+            response = self._http().post("/introspect", json={"tokens": list(batch)}, headers=headers)
+            response.raise_for_status()
+            results = response.json()["results"]
+        except Exception as e:
+            INTROSPECTIONS.labels("error").inc()
+            for future, _ in batch.values():
+                future.set_exception(e)
+            return
+        for (token, (future, expires_at)), result in zip(batch.items(), results):
+            INTROSPECTIONS.labels("active" if result.get("active") else "inactive").inc()
+            self._store(token, result, expires_at)
+            future.set_result(result)
+
+
+introspector = Introspector.from_env()
+
+
+def decode_local(token):
+    try:
+        return jwt.decode(token, os.getenv("JWT_SECRET", "myjwtsecret"), algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+
+def _link_signature(path, expires):
+    key = os.getenv("JWT_SECRET", "myjwtsecret").encode("utf-8")
+    return hmac.new(key, f"{path}\n{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def sign_path(path, ttl=None):
+    """Query-параметры подписанной ссылки на path: {"expires", "signature"}"""
+    if ttl is None:
+        ttl = float(os.getenv("DOWNLOAD_LINK_SECONDS", "300"))
+    expires = int(time.time() + ttl)
+    return {"expires": expires, "signature": _link_signature(path, expires)}
+
+
+def signed_link_valid(request: Request):
+    """Запрос пришёл по неистёкшей ссылке, подписанной sign_path для этого же пути"""
+    if not request.url.path.startswith(SIGNED_PATHS):
+        return False
+    try:
+        expires = int(request.query_params.get("expires", ""))
+    except ValueError:
+        return False
+    signature = request.query_params.get("signature", "")
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_link_signature(request.url.path, expires), signature)
+
+
+async def current_user(request: Request):
+    """Зависимость FastAPI: пользователь запроса ({"user_id", "username"}) или None
+    для анонимного запроса; результат также в request.state.user"""
+    request.state.user = None
+    if request.url.path.startswith(EXEMPT_PATHS):
+        return None
+    authorization = request.headers.get("authorization")
+    if not authorization or not authorization.lower().startswith("bearer "):
+        if _flag("AUTH_REQUIRED") and not signed_link_valid(request):
+            raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
+        return None
+    token = authorization.split(" ", 1)[1]
+    payload = decode_local(token)
+    if introspector is not None:
+        try:
+            result = await asyncio.wrap_future(introspector.submit(token, payload.get("exp")))
+        except Exception:
+            raise HTTPException(status_code=503, detail="Сервис авторизации недоступен", headers={"Retry-After": "1"})
+        if not result.get("active"):
+            raise HTTPException(status_code=401, detail=result.get("reason") or "Invalid token")
+    request.state.user = {"user_id": int(payload["sub"]), "username": payload.get("username")}
+    return request.state.user
@@ -0,0 +1,136 @@
+"""Чтение CSV/TSV без предварительной перекодировки файла.
+
+Кодировка, разделитель и сжатие определяются по первым килобайтам файла,
+после чего строки читаются потоково: gzip распаковывается на лету,
+а байты декодируются по мере чтения.
+"""
+import codecs
+import csv
+import gzip
+import io
+import os
+from typing import NamedTuple, Optional
+
+SAMPLE_SIZE = 64 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+DELIMITERS = (",", ";", "\t", "|")
+CSV_EXTENSIONS = (".csv", ".tsv")
+
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+class CsvFormat(NamedTuple):
+    encoding: str
+    delimiter: str
+    compressed: bool
+
+
+def get_fallback_encodings():
+    """Кодировки, которые пробуются, если образец не является корректным UTF-8"""
+    value = os.getenv("CSV_FALLBACK_ENCODINGS", "cp1251")
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+def strip_compression(filename: str) -> str:
+    return filename[:-3] if filename.lower().endswith(".gz") else filename
+
+
+def is_csv_filename(filename: str) -> bool:
+    return strip_compression(filename).lower().endswith(CSV_EXTENSIONS)
+
+
+def is_gzip(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_binary(path: str, compressed: Optional[bool] = None):
+    """Открывает файл на чтение байтов, распаковывая gzip на лету"""
+    if compressed is None:
+        compressed = is_gzip(path)
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+def normalize_delimiter(value: str) -> str:
+    """Приводит разделитель из параметра запроса к символу ("tab" и "\\t" -> табуляция)"""
+    if value.lower() in ("tab", "\\t"):
+        return "\t"
+    if len(value) != 1:
+        raise ValueError(f"Некорректный разделитель: {value!r}")
+    return value
+
+
+def normalize_encoding(value: str) -> str:
+    """Проверяет, что кодировка известна Python, и возвращает её каноническое имя"""
+    try:
+        return codecs.lookup(value).name
+    except LookupError:
+        raise ValueError(f"Неизвестная кодировка: {value!r}")
+
+
+def detect_encoding(sample: bytes) -> str:
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+
+    # Образец может обрываться посреди многобайтового символа,
+    # поэтому декодируем инкрементально без final=True
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    for encoding in get_fallback_encodings():
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return "latin-1"
+
+
+def detect_delimiter(text: str, filename: Optional[str] = None) -> str:
+    """Выбирает разделитель, который чаще всего встречается в строке заголовка"""
+    if filename and strip_compression(filename).lower().endswith(".tsv"):
+        return "\t"
+
+    header = text.splitlines()[0] if text else ""
+    counts = {delimiter: header.count(delimiter) for delimiter in DELIMITERS}
+    best = max(DELIMITERS, key=lambda d: counts[d])
+    return best if counts[best] > 0 else ","
+
+
+def sniff(path: str, filename: Optional[str] = None, encoding: Optional[str] = None, delimiter: Optional[str] = None) -> CsvFormat:
+    """Определяет формат файла по образцу; явно заданные параметры имеют приоритет"""
+    compressed = is_gzip(path)
+    with open_binary(path, compressed) as f:
+        sample = f.read(SAMPLE_SIZE)
+
+    if encoding is None:
+        encoding = detect_encoding(sample)
+    if delimiter is None:
+        text = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample, final=False)
+        delimiter = detect_delimiter(text, filename)
+
+    return CsvFormat(encoding=encoding, delimiter=delimiter, compressed=compressed)
+
+
+def is_line_seekable(fmt: CsvFormat) -> bool:
+    """Можно ли читать файл с произвольной границы строки: не сжат и перевод строки занимает один байт"""
+    return not fmt.compressed and not codecs.lookup(fmt.encoding).name.startswith(("utf-16", "utf-32"))
+
+
+def open_text(path: str, fmt: CsvFormat):
+    """Текстовый поток поверх (возможно, сжатого) файла для передачи в csv.reader"""
+    return io.TextIOWrapper(open_binary(path, fmt.compressed), encoding=fmt.encoding, errors="replace", newline="")
+
+
+def reader(stream, fmt: CsvFormat):
+    return csv.reader(stream, delimiter=fmt.delimiter)
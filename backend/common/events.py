@@ -0,0 +1,210 @@
+"""События жизненного цикла файлов: file.uploaded, file.updated (CSV дописан) и file.deleted.
+
+data_service записывает событие в таблицу event_outbox в той же транзакции,
+что и изменение метаданных, поэтому событие не теряется и не появляется
+для отменённой записи. Брокером служит сама таблица в общей базе: подписчик
+(processing_service) читает строки с id больше последнего прочитанного.
+В PostgreSQL публикация дополнительно делает NOTIFY, и подписчик просыпается
+сразу, а не по таймеру. В тестах та же схема работает на SQLite.
+
+Каждая реплика подписчика читает все события сама: кэши у реплик свои.
+Рабочие процессы одного пода делят кэши (см. sharedstate.py), поэтому события
+читает только процесс, держащий блокировку ведущего; если он завершится,
+блокировку заберёт другой. Подписчик начинает с конца журнала — при старте
+процесса кэши пусты.
+Строки старше EVENTS_RETENTION_SECONDS (по умолчанию сутки) удаляет публикующая сторона.
+
+Настройка подписчика переменными окружения:
+
+    EVENTS_BACKEND        — none (по умолчанию) или database
+    EVENTS_DATABASE_URL   — база с таблицей event_outbox (по умолчанию DATABASE_URL)
+    EVENTS_POLL_SECONDS   — период опроса без NOTIFY, по умолчанию 1
+"""
+import os
+import select as select_module
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from prometheus_client import Counter
+from sqlalchemy import JSON, BigInteger, Column, Float, Integer, MetaData, String, Table, delete, func, insert, select, text
+
+from common import serving, sharedstate
+
+FILE_UPLOADED = "file.uploaded"
+FILE_UPDATED = "file.updated"
+FILE_DELETED = "file.deleted"
+CHANNEL = "file_events"
+PRUNE_INTERVAL_SECONDS = 600
+# id выдаются до фиксации, поэтому транзакция с меньшим id может стать видна позже;
+# столько секунд подписчик перечитывает свежие строки, пропуская уже обработанные
+REORDER_SECONDS = 10
+
+EVENTS_HANDLED = Counter("file_events_handled_total", "События жизненного цикла файлов, обработанные подписчиком", ["type", "outcome"])
+
+metadata = MetaData()
+outbox_table = Table(
+    "event_outbox", metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("type", String, nullable=False),
+    Column("filename", String, nullable=False, index=True),
+    Column("payload", JSON, nullable=True),
+    Column("created_at", Float, nullable=False, index=True),
+)
+
+_last_pruned = 0.0
+
+
+def publish(db, event_type, files):
+    """Добавляет события в текущую транзакцию db (Session или Connection);
+    files — словари с ключом filename и любыми другими полями для payload"""
+    global _last_pruned
+    if not files:
+        return
+    now = time.time()
+    db.execute(insert(outbox_table), [
+        {"type": event_type, "filename": file["filename"], "payload": file, "created_at": now}
+        for file in files
+    ])
+    if now - _last_pruned > PRUNE_INTERVAL_SECONDS:
+        _last_pruned = now
+        retention = float(os.getenv("EVENTS_RETENTION_SECONDS", "86400"))
+        db.execute(delete(outbox_table).where(outbox_table.c.created_at < now - retention))
+    dialect = db.get_bind().dialect if hasattr(db, "get_bind") else db.dialect
+    if dialect.name == "postgresql":
+        # Доставляется подписчикам при фиксации транзакции
+        db.execute(text(f"NOTIFY {CHANNEL}"))
+
+
+class Subscriber:
+    """Фоновый поток, который читает новые события и вызывает обработчики по типу события.
+    Ошибка обработчика не останавливает поток: событие считается обработанным"""
+
+    def __init__(self, url, handlers, poll_seconds=1.0, batch_size=500):
+        self.engine = serving.create_engine(url)
+        self.handlers = handlers
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.last_id = None
+        self._seen = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._listener = None
+        self.leader = sharedstate.LeaderLock("file-events")
+
+    def seek_to_end(self):
+        with self.engine.connect() as conn:
+            self.last_id = conn.execute(select(func.max(outbox_table.c.id))).scalar() or 0
+
+    def poll(self):
+        """Обрабатывает следующую порцию событий; возвращает их число"""
+        if self.last_id is None:
+            self.seek_to_end()
+        now = time.time()
+        c = outbox_table.c
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(outbox_table)
+                .where((c.id > self.last_id) | (c.created_at >= now - REORDER_SECONDS))
+                .order_by(c.id)
+                .limit(self.batch_size + len(self._seen))
+            ).all()
+        handled = 0
+        for row in rows:
+            if row.id in self._seen or handled == self.batch_size:
+                continue
+            self.dispatch(row)
+            self._seen[row.id] = row.created_at
+            self.last_id = max(self.last_id, row.id)
+            handled += 1
+        self._seen = {id_: created for id_, created in self._seen.items() if created >= now - 2 * REORDER_SECONDS}
+        return handled
+
+    def dispatch(self, row):
+        handler = self.handlers.get(row.type)
+        if handler is None:
+            return
+        try:
+            handler({**(row.payload or {}), "id": row.id, "type": row.type, "filename": row.filename})
+        except Exception as e:
+            EVENTS_HANDLED.labels(row.type, "error").inc()
+            print(f"Ошибка обработки события {row.type} для {row.filename}: {e}")
+        else:
+            EVENTS_HANDLED.labels(row.type, "ok").inc()
+
+    def _wait(self):
+        """Ждёт NOTIFY (PostgreSQL) или просто период опроса"""
+        if self.engine.dialect.name == "postgresql":
+            try:
+                if self._listener is None:
+                    self._listener = self.engine.raw_connection()
+                    self._listener.driver_connection.autocommit = True
+                    self._listener.cursor().execute(f"LISTEN {CHANNEL}")
+                connection = self._listener.driver_connection
+                select_module.select([connection], [], [], self.poll_seconds)
+                connection.poll()
+                connection.notifies.clear()
+                return
+            except Exception:
+                self._close_listener()
+        self._stop.wait(self.poll_seconds)
+
+    def _close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    def run(self):
+        while not self._stop.is_set():
+            if not self.leader.acquire():
+                self._stop.wait(self.poll_seconds)
+                continue
+            try:
+                if self.poll() == self.batch_size:
+                    continue
+            except Exception as e:
+                print(f"Не удалось прочитать события: {e}")
+            self._wait()
+        self._close_listener()
+        self.leader.release()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="file-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_seconds + 1)
+
+
+def create_subscriber(handlers):
+    if os.getenv("EVENTS_BACKEND", "none").lower() != "database":
+        return None
+    url = os.getenv("EVENTS_DATABASE_URL") or os.getenv("DATABASE_URL")
+    return Subscriber(url, handlers, poll_seconds=float(os.getenv("EVENTS_POLL_SECONDS", "1")))
+
+
+def install(app: FastAPI, handlers, subscriber=None):
+    """Запускает подписчика на время жизни приложения; без настроенного бэкенда ничего не делает"""
+    subscriber = subscriber or create_subscriber(handlers)
+    if subscriber is None:
+        return
+    app.state.event_subscriber = subscriber
+    previous = app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan(app_):
+        subscriber.start()
+        try:
+            async with previous(app_) as state:
+                yield state
+        finally:
+            subscriber.stop()
+
+    app.router.lifespan_context = lifespan
@@ -0,0 +1,44 @@
+"""Распознавание колоночных форматов (Parquet, Arrow IPC, Feather) по расширению и сигнатуре"""
+from typing import Optional
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_EXTENSIONS = (".arrow", ".feather", ".ipc", ".arrows")
+ARROW_STREAM_EXTENSIONS = (".arrows",)
+
+PARQUET_MAGIC = b"PAR1"
+ARROW_MAGIC = b"ARROW1"
+FEATHER_V1_MAGIC = b"FEA1"
+
+
+def columnar_filetype(filename: str) -> Optional[str]:
+    """Тип файла по расширению: "parquet", "arrow" или None"""
+    name = filename.lower()
+    if name.endswith(PARQUET_EXTENSIONS):
+        return "parquet"
+    if name.endswith(ARROW_EXTENSIONS):
+        return "arrow"
+    return None
+
+
+def sniff_columnar(path: str, filename: Optional[str] = None) -> Optional[str]:
+    """Определяет формат по сигнатуре файла.
+
+    Возвращает "parquet", "arrow" (IPC file / Feather v2), "feather" (Feather v1),
+    "arrow_stream" (IPC stream, распознаётся только по расширению) или None.
+    """
+    with open(path, "rb") as f:
+        head = f.read(6)
+        if head[:4] == PARQUET_MAGIC:
+            f.seek(0, 2)
+            if f.tell() >= 8:
+                f.seek(-4, 2)
+                if f.read(4) == PARQUET_MAGIC:
+                    return "parquet"
+            return None
+    if head == ARROW_MAGIC:
+        return "arrow"
+    if head[:4] == FEATHER_V1_MAGIC:
+        return "feather"
+    if filename and filename.lower().endswith(ARROW_STREAM_EXTENSIONS):
+        return "arrow_stream"
+    return None
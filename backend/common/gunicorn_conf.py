@@ -0,0 +1,80 @@
+"""Настройки gunicorn для всех сервисов:
+
+    gunicorn -c python:common.gunicorn_conf main:app
+
+Рабочие процессы — uvicorn, их число задаёт WEB_CONCURRENCY (по умолчанию 1).
+Приложение загружается в главном процессе до fork (preload): импорт, сборка
+маршрутов и прогрев выполняются один раз, а память кода делится процессами.
+
+Переменные окружения:
+
+    WEB_CONCURRENCY  — рабочих процессов (по умолчанию 1)
+    PORT             — порт (по умолчанию 8000)
+    GRACEFUL_TIMEOUT — сколько секунд после SIGTERM процесс дорабатывает начатые
+                       запросы, включая долгий опрос /files/changes (по умолчанию 120)
+    WORKER_TIMEOUT   — через сколько секунд молчания рабочий процесс перезапускается (по умолчанию 120)
+    MAX_REQUESTS     — перезапуск процесса после стольких запросов, 0 — никогда (по умолчанию 0)
+
+При нескольких рабочих процессах состояние, которое должно быть общим для пода,
+переносится в каталоги на tmpfs, если они не заданы явно:
+SHARED_STATE_DIR (см. sharedstate.py), PROMETHEUS_MULTIPROC_DIR (см. metrics.py),
+а ограничитель частоты memory заменяется на database с SQLite в SHARED_STATE_DIR.
+Переменные задаются здесь, до импорта приложения, иначе prometheus_client
+и модули сервиса их не увидят.
+"""
+import os
+import shutil
+import tempfile
+
+
+def _int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _pod_dir(variable, prefix):
+    """Каталог из переменной окружения или новый в /dev/shm (в памяти), если он есть"""
+    path = os.getenv(variable)
+    if not path:
+        root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        path = tempfile.mkdtemp(prefix=prefix, dir=root)
+        os.environ[variable] = path
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _clear(path):
+    for name in os.listdir(path):
+        target = os.path.join(path, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        else:
+            os.remove(target)
+
+
+workers = _int("WEB_CONCURRENCY", 1)
+worker_class = "uvicorn_worker.UvicornWorker"
+bind = f"0.0.0.0:{_int('PORT', 8000)}"
+preload_app = True
+graceful_timeout = _int("GRACEFUL_TIMEOUT", 120)
+timeout = _int("WORKER_TIMEOUT", 120)
+max_requests = _int("MAX_REQUESTS", 0)
+max_requests_jitter = max_requests // 10
+# Keep-alive балансировщика обычно 60 секунд: соединение закрывает он, а не сервис
+keepalive = 75
+
+multiprocess = workers > 1
+if multiprocess:
+    shared = _pod_dir("SHARED_STATE_DIR", "shared-state-")
+    # Файлы метрик прошлого запуска с теми же pid исказили бы суммы
+    _clear(_pod_dir("PROMETHEUS_MULTIPROC_DIR", "prometheus-"))
+    if os.getenv("RATE_LIMIT_BACKEND", "none").lower() == "memory":
+        os.environ["RATE_LIMIT_BACKEND"] = "database"
+        from common import ratelimit
+        os.environ["RATE_LIMIT_DATABASE_URL"] = ratelimit.create_local_store(os.path.join(shared, "ratelimit.db"))
+
+
+def child_exit(server, worker):
+    if multiprocess:
+        from prometheus_client import multiprocess as prometheus_multiprocess
+        prometheus_multiprocess.mark_process_dead(worker.pid)
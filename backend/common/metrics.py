@@ -0,0 +1,153 @@
+"""Метрики Prometheus, общие для всех сервисов.
+
+Метрики регистрируются один раз при импорте модуля. В горячих циклах
+(разбор CSV) ничего не вызывается построчно: счётчики обновляются
+по итогам запроса или порции строк.
+
+Под gunicorn с несколькими рабочими процессами задаётся PROMETHEUS_MULTIPROC_DIR
+(см. common/gunicorn_conf.py): процессы пишут значения в файлы каталога,
+а /metrics любого процесса отдаёт их сумму по всем процессам пода.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(2 ** i for i in range(10, 32, 2))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+BCRYPT_SECONDS = Histogram(
+    "password_hash_duration_seconds", "Время хеширования и проверки пароля",
+    ["operation"], buckets=LATENCY_BUCKETS,
+)
+# max: параметры одинаковы у всех процессов пода, их подбирает главный процесс
+PASSWORD_HASH_COST = Gauge(
+    "password_hash_cost", "Стоимость хеша пароля: rounds bcrypt или проходы argon2id", ["scheme"],
+    multiprocess_mode="max",
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Время выполнения SQL-запроса", buckets=LATENCY_BUCKETS,
+)
+# livesum: в нескольких процессах — сумма по живым процессам пода
+DB_POOL_CHECKED_OUT = Gauge("db_pool_connections_in_use", "Соединения пула, выданные сессиям", multiprocess_mode="livesum")
+DB_POOL_SIZE = Gauge("db_pool_size", "Размер пула соединений (без overflow)", multiprocess_mode="livesum")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "Соединения сверх размера пула", multiprocess_mode="livesum")
+
+UPLOAD_BYTES = Counter("upload_bytes_total", "Принятые байты загружаемых файлов")
+UPLOAD_SECONDS = Histogram("upload_duration_seconds", "Время приёма и записи файла", buckets=LATENCY_BUCKETS)
+UPLOAD_THROUGHPUT = Histogram(
+    "upload_throughput_bytes_per_second", "Скорость приёма файла", buckets=THROUGHPUT_BUCKETS,
+)
+
+ANALYZE_ROWS = Counter("analyze_rows_total", "Строки, обработанные анализом", ["format"])
+ANALYZE_BYTES = Counter("analyze_bytes_parsed_total", "Байты файлов, прочитанные анализом", ["format"])
+ANALYZE_PHASE_SECONDS = Histogram(
+    "analyze_phase_duration_seconds", "Время фаз анализа: разбор (parse) и агрегирование (aggregate)",
+    ["format", "phase"], buckets=LATENCY_BUCKETS,
+)
+ANALYZE_THROUGHPUT = Histogram(
+    "analyze_throughput_rows_per_second", "Скорость анализа в строках в секунду", ["format"],
+    buckets=THROUGHPUT_BUCKETS,
+)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    metric = histogram.labels(**labels) if labels else histogram
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - start)
+
+
+def observe_upload(size: int, seconds: float):
+    UPLOAD_BYTES.inc(size)
+    UPLOAD_SECONDS.observe(seconds)
+    if seconds > 0:
+        UPLOAD_THROUGHPUT.observe(size / seconds)
+
+
+def observe_analysis(file_format: str, rows: int, size: int, parse_seconds: float, aggregate_seconds: float):
+    ANALYZE_ROWS.labels(file_format).inc(rows)
+    ANALYZE_BYTES.labels(file_format).inc(size)
+    ANALYZE_PHASE_SECONDS.labels(file_format, "parse").observe(parse_seconds)
+    ANALYZE_PHASE_SECONDS.labels(file_format, "aggregate").observe(aggregate_seconds)
+    total = parse_seconds + aggregate_seconds
+    if total > 0:
+        ANALYZE_THROUGHPUT.labels(file_format).observe(rows / total)
+
+
+def instrument_engine(engine):
+    """Время SQL-запросов и заполненность пула соединений движка SQLAlchemy"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.observe(time.perf_counter() - conn.info["query_start"].pop())
+
+    # Значения обновляются событиями пула, а не set_function: функция
+    # не вызывается при сборе метрик из файлов нескольких процессов.
+    # Размер записывается при первом подключении, то есть в рабочем процессе после fork
+    @event.listens_for(engine, "first_connect")
+    def _first_connect(dbapi_connection, connection_record):
+        if hasattr(engine.pool, "size"):
+            DB_POOL_SIZE.set(engine.pool.size())
+
+    def update_overflow():
+        # После engine.dispose() пул новый, поэтому он берётся из движка в момент события
+        if hasattr(engine.pool, "overflow"):
+            DB_POOL_OVERFLOW.set(max(engine.pool.overflow(), 0))
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.inc()
+        update_overflow()
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.dec()
+        update_overflow()
+
+
+def registry():
+    """Реестр для /metrics: в режиме нескольких процессов — собранный из файлов всех процессов"""
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    from prometheus_client import multiprocess
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+def install(app: FastAPI):
+    """Добавляет к приложению эндпоинт /metrics и гистограмму задержек по маршрутам"""
+
+    @app.middleware("http")
+    async def record_request_latency(request: Request, call_next):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # Шаблон маршрута вместо пути, чтобы имена файлов не раздували число серий
+            route = request.scope.get("route")
+            REQUEST_LATENCY.labels(
+                request.method, route.path if route is not None else "unmatched", str(status)
+            ).observe(time.perf_counter() - start)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,68 @@
+"""Миграции схемы базы через Alembic.
+
+Сервисы не создают таблицы при старте: схему один раз перед выкаткой
+обновляет отдельная задача (Job в k8s, сервис *_migrate в docker-compose):
+
+    cd backend/data_service && alembic upgrade head
+
+У auth_service и data_service свои истории миграций в общей базе, поэтому
+у каждого своя таблица версий (alembic_version_auth, alembic_version_data),
+а таблицы другого сервиса autogenerate не трогает. В PostgreSQL миграции
+одного сервиса сериализуются advisory-блокировкой, и одновременный запуск
+двух задач безопасен.
+
+Первые ревизии пропускают таблицы и столбцы, которые уже есть, — так
+подхватывается база, созданная прежним create_all.
+"""
+import os
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.pool import NullPool
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    # В базе есть таблицы других сервисов и FTS; удалять их autogenerate не должен
+    return not (type_ == "table" and reflected and compare_to is None)
+
+
+def run(context, target_metadata, version_table):
+    """Тело migrations/env.py сервиса; адрес базы — sqlalchemy.url или DATABASE_URL"""
+    url = context.config.get_main_option("sqlalchemy.url") or os.getenv("DATABASE_URL")
+    options = {"target_metadata": target_metadata, "version_table": version_table, "include_object": include_object}
+    if context.is_offline_mode():
+        context.configure(url=url, literal_binds=True, **options)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
+    engine = create_engine(url, poolclass=NullPool)
+    with engine.connect() as connection:
+        context.configure(connection=connection, **options)
+        with context.begin_transaction():
+            if connection.dialect.name == "postgresql":
+                connection.exec_driver_sql(f"SELECT pg_advisory_xact_lock(hashtext('{version_table}'))")
+            context.run_migrations()
+    engine.dispose()
+
+
+def upgrade(service_dir, revision="head"):
+    """alembic upgrade для сервиса из service_dir (бенчмарки, тесты, локальный запуск)"""
+    # Alembic импортируется только здесь: сервису при обычном старте он не нужен
+    from alembic import command
+    from alembic.config import Config
+
+    command.upgrade(Config(os.path.join(service_dir, "alembic.ini")), revision)
+
+
+def _offline():
+    from alembic import context
+    return context.is_offline_mode()
+
+
+def has_table(connection, name):
+    # В офлайн-режиме (alembic upgrade --sql) база считается пустой
+    return not _offline() and inspect(connection).has_table(name)
+
+
+def has_column(connection, table, column):
+    return not _offline() and column in {c["name"] for c in inspect(connection).get_columns(table)}
@@ -0,0 +1,266 @@
+"""Встроенный статистический профилировщик для работающих сервисов.
+
+Фоновый поток с заданным интервалом снимает стеки всех потоков процесса
+(sys._current_frames) и складывает их в формат collapsed stacks
+("f1;f2;f3 N"), который понимают flamegraph.pl, speedscope и Inferno.
+
+Режимы:
+    wall — каждый снимок каждого потока весит 1 (включая ожидание ввода-вывода);
+    cpu  — поток учитывается, только если потратил процессорное время с прошлого
+           снимка, вес — это время в микросекундах (только Linux, иначе wall).
+
+Эндпоинты доступны только с заголовком X-Admin-Token, совпадающим с ADMIN_TOKEN;
+если переменная не задана, профилирование выключено.
+
+Профили отдельных запросов хранятся в sharedstate: /admin/profile/{id} находит
+профиль, даже если запрос попал в другой рабочий процесс пода. Профиль запроса
+снимается со всех потоков процесса, как и /admin/profile: код запроса идёт то
+в цикле событий, то в пуле потоков, и под нагрузкой в профиль попадают стеки
+других запросов. Поэтому ответ помечается заголовком X-Profile-Scope: process,
+а запрос лучше профилировать на ненагруженной реплике. Снятие продолжается,
+пока отдаётся тело ответа, так что у StreamingResponse профилируется и
+генерация тела, но не дольше MAX_SECONDS.
+"""
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from html import escape
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, Response
+
+from common import sharedstate
+
+MAX_SECONDS = 60
+MAX_STORED_PROFILES = 20
+CPU_SUPPORTED = hasattr(time, "pthread_getcpuclockid")
+
+_profile_lock = threading.Lock()
+_stored = sharedstate.create_store("profiles", MAX_STORED_PROFILES)
+
+
+def get_admin_token():
+    return os.getenv("ADMIN_TOKEN")
+
+
+def is_admin(token):
+    expected = get_admin_token()
+    # compare_digest принимает строки только из ASCII, а в заголовке может быть что угодно
+    return bool(expected) and token is not None and hmac.compare_digest(token.encode("utf-8"), expected.encode("utf-8"))
+
+
+def require_admin(request: Request):
+    if not get_admin_token():
+        raise HTTPException(status_code=404, detail="Профилирование выключено")
+    if not is_admin(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="Требуется токен администратора")
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _thread_cpu_time(thread_id):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (OSError, OverflowError):
+        return None
+
+
+class Sampler:
+    def __init__(self, interval: float = 0.01, mode: str = "wall", max_seconds: float = None):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.mode = mode if mode == "wall" or CPU_SUPPORTED else "wall"
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._cpu = {}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds if self.max_seconds else None
+        while not self._stop.wait(self.interval):
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            self._sample(own)
+
+    def _sample(self, own):
+        self.samples += 1
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            if self.mode == "cpu":
+                now = _thread_cpu_time(thread_id)
+                if now is None:
+                    continue
+                previous = self._cpu.get(thread_id, now)
+                self._cpu[thread_id] = now
+                weight = int((now - previous) * 1_000_000)
+                if weight <= 0:
+                    continue
+            else:
+                weight = 1
+            self.stacks[_collapse(frame)] += weight
+
+
+def collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def flamegraph_svg(stacks, title="Flamegraph", width=1200, row_height=16):
+    """Простой SVG-флеймграф из collapsed stacks (корень внизу)"""
+    root = {"children": {}, "value": 0}
+    for stack, count in stacks.items():
+        root["value"] += count
+        node = root
+        for label in stack.split(";"):
+            node = node["children"].setdefault(label, {"children": {}, "value": 0})
+            node["value"] += count
+
+    def depth(node):
+        return 1 + max((depth(child) for child in node["children"].values()), default=0)
+
+    height = (depth(root) + 1) * row_height
+    total = root["value"] or 1
+    rects = []
+
+    def draw(node, x, level):
+        for label, child in sorted(node["children"].items()):
+            w = child["value"] / total * width
+            if w >= 0.5:
+                y = height - (level + 1) * row_height
+                hue = 20 + zlib.crc32(label.encode()) % 40
+                text = label if w > 40 else ""
+                rects.append(
+                    f'<g><title>{escape(label)} ({child["value"]}, {child["value"] / total:.1%})</title>'
+                    f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+                    f'<text x="{x + 3:.1f}" y="{y + row_height - 4}" font-size="11" font-family="monospace">'
+                    f'{escape(text[: int(w / 7)])}</text></g>'
+                )
+                draw(child, x, level + 1)
+            x += w
+
+    draw(root, 0.0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height + row_height}">'
+        f'<text x="4" y="12" font-size="12" font-family="sans-serif">{escape(title)}</text>'
+        + "".join(rects) + "</svg>"
+    )
+
+
+def render(stacks, output_format, title):
+    if output_format == "svg":
+        return Response(flamegraph_svg(stacks, title), media_type="image/svg+xml")
+    return PlainTextResponse(collapsed(stacks))
+
+
+def _new_profile_id():
+    # Номера, которые считал бы каждый процесс, совпали бы у соседних процессов пода
+    return uuid.uuid4().hex[:12]
+
+
+def _store(stacks, profile_id=None):
+    profile_id = profile_id or _new_profile_id()
+    _stored.put(profile_id, stacks)
+    return profile_id
+
+
+def profile_for(seconds: float, interval: float, mode: str):
+    """Блокирующий запуск профилировщика на заданное время (вызывается вне цикла событий)"""
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Профилирование уже выполняется")
+    try:
+        sampler = Sampler(interval, mode).start()
+        time.sleep(seconds)
+        return sampler.stop()
+    finally:
+        _profile_lock.release()
+
+
+def install(app: FastAPI, service_name: str, profile_paths=()):
+    """Эндпоинты /admin/profile и профилирование отдельных запросов по заголовку X-Profile.
+
+    Заголовок X-Profile (значение wall или cpu) действует для путей из profile_paths;
+    в ответ добавляется X-Profile-Id, по которому профиль забирается через
+    /admin/profile/{id}, когда тело ответа отдано целиком.
+    """
+
+    @app.get("/admin/profile", include_in_schema=False)
+    async def run_profile(
+        request: Request,
+        seconds: float = Query(10, gt=0, le=MAX_SECONDS),
+        interval: float = Query(0.01, ge=0.001, le=1),
+        mode: str = Query("wall", pattern="^(wall|cpu)$"),
+        format: str = Query("collapsed", pattern="^(collapsed|svg)$"),
+    ):
+        require_admin(request)
+        stacks = await asyncio.to_thread(profile_for, seconds, interval, mode)
+        return render(stacks, format, f"{service_name}: {mode}, {seconds:g}s")
+
+    @app.get("/admin/profile/{profile_id}", include_in_schema=False)
+    async def stored_profile(request: Request, profile_id: str, format: str = Query("collapsed", pattern="^(collapsed|svg)$")):
+        require_admin(request)
+        stacks = _stored.get(profile_id)
+        if stacks is None:
+            raise HTTPException(status_code=404, detail="Профиль не найден")
+        return render(stacks, format, f"{service_name}: запрос {profile_id}, все потоки процесса")
+
+    if not profile_paths:
+        return
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        mode = request.headers.get("x-profile")
+        if (
+            mode is None
+            or not request.url.path.startswith(tuple(profile_paths))
+            or not is_admin(request.headers.get("x-admin-token"))
+        ):
+            return await call_next(request)
+
+        sampler = Sampler(mode="cpu" if mode.lower() == "cpu" else "wall", interval=0.005, max_seconds=MAX_SECONDS).start()
+        try:
+            response = await call_next(request)
+        except BaseException:
+            sampler.stop()
+            raise
+        profile_id = _new_profile_id()
+        body = response.body_iterator
+
+        async def profiled_body():
+            # Профиль сохраняется, когда тело отдано: у потоковых ответов работа идёт здесь
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                _store(await asyncio.to_thread(sampler.stop), profile_id)
+
+        response.body_iterator = profiled_body()
+        response.headers["X-Profile-Id"] = profile_id
+        response.headers["X-Profile-Scope"] = "process"
+        return response
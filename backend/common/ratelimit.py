@@ -0,0 +1,266 @@
+"""Ограничение частоты запросов по алгоритму token bucket.
+
+Ключ корзины — sub из проверенного JWT (заголовок Authorization: Bearer),
+а для анонимных запросов — IP клиента. Маршруты делятся на дорогие
+(анализ, загрузка, выгрузка) и дешёвые; у каждого класса свой бюджет.
+Настройка переменными окружения:
+
+    RATE_LIMIT_BACKEND      — none (по умолчанию), memory или database
+    RATE_LIMIT_DATABASE_URL — база для database (по умолчанию DATABASE_URL);
+                              общая для всех реплик, таблица создаётся
+                              миграциями data_service
+    RATE_LIMIT_EXPENSIVE    — бюджет дорогих маршрутов "запросов/секунд", по умолчанию 30/60
+    RATE_LIMIT_CHEAP        — бюджет остальных маршрутов, по умолчанию 600/60
+    TRUSTED_PROXIES         — сети прокси, которым доверяется X-Real-IP/X-Forwarded-For
+                              (по умолчанию частные сети и localhost)
+
+Корзина вмещает "запросов" токенов и пополняется со скоростью запросов/секунд.
+Отказ — 429 с Retry-After (секунды до появления токена).
+
+Корзина, которая снова пополнилась до полной, ничем не отличается от
+отсутствующей, поэтому раз в RATE_LIMIT_SWEEP_SECONDS (по умолчанию 60)
+бэкенд удаляет корзины, не тронутые дольше полного пополнения: перебор
+IP или sub не накапливает ключи без ограничения.
+"""
+import ipaddress
+import math
+import os
+import re
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from prometheus_client import Counter
+from sqlalchemy import Column, Float, Index, MetaData, String, Table, case, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from common import serving
+
+# /introspect — пакеты проверок токенов от других сервисов (см. common/auth.py)
+EXEMPT_PATHS = ("/health", "/metrics", "/admin/", "/introspect")
+DEFAULT_TRUSTED_PROXIES = "127.0.0.0/8,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,::1/128"
+
+RATE_LIMITED = Counter("rate_limited_requests_total", "Запросы, отклонённые ограничителем частоты", ["route_class"])
+
+
+def parse_rate(value: str):
+    """"30/60" -> (ёмкость 30, пополнение 0.5 токена в секунду)"""
+    count, _, seconds = value.partition("/")
+    capacity = float(count)
+    return capacity, capacity / float(seconds or 1)
+
+
+def _sweep_seconds():
+    return float(os.getenv("RATE_LIMIT_SWEEP_SECONDS", "60"))
+
+
+class _Sweeper:
+    """Когда пора удалять пополнившиеся корзины и какие из них уже полные.
+    Пустая корзина пополняется за capacity / rate секунд; берётся наибольшее из бюджетов"""
+
+    def __init__(self, sweep_seconds):
+        self.sweep_seconds = sweep_seconds
+        self.refill_seconds = 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def due(self, capacity, rate, now):
+        """Отмечает бюджет; True, если этому вызову пора чистить"""
+        with self._lock:
+            self.refill_seconds = max(self.refill_seconds, capacity / rate)
+            if now < self._next:
+                return False
+            self._next = now + self.sweep_seconds
+            return True
+
+    def cutoff(self, now):
+        """Корзины, не тронутые с этого момента, уже полные"""
+        return now - self.refill_seconds
+
+
+class MemoryBackend:
+    """Корзины в памяти процесса — для одной реплики"""
+
+    blocking = False
+
+    def __init__(self, sweep_seconds=None):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._sweeper = _Sweeper(_sweep_seconds() if sweep_seconds is None else sweep_seconds)
+
+    def take(self, key, capacity, rate, now=None):
+        """Забирает токен; возвращает 0, если запрос разрешён, иначе секунды до следующего токена"""
+        now = time.time() if now is None else now
+        if self._sweeper.due(capacity, rate, now):
+            self.sweep(now)
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def sweep(self, now):
+        """Удаляет корзины, пополнившиеся до полной"""
+        cutoff = self._sweeper.cutoff(now)
+        with self._lock:
+            for key in [key for key, (_, updated) in self._buckets.items() if updated <= cutoff]:
+                del self._buckets[key]
+
+
+_metadata = MetaData()
+buckets_table = Table(
+    "rate_limit_buckets", _metadata,
+    Column("key", String, primary_key=True),
+    Column("tokens", Float, nullable=False),
+    Column("updated_at", Float, nullable=False),
+    # Для удаления пополнившихся корзин (DatabaseBackend.sweep)
+    Index("ix_rate_limit_buckets_updated_at", "updated_at"),
+)
+
+
+class DatabaseBackend:
+    """Корзины в общей базе — для нескольких реплик.
+
+    Списание токена — один условный UPDATE, поэтому параллельные реплики
+    не могут потратить один и тот же токен дважды. Таблицу rate_limit_buckets
+    в общей базе создаёт миграция data_service, в локальной SQLite — create_local_store.
+    """
+
+    blocking = True
+
+    def __init__(self, url, sweep_seconds=None):
+        self.engine = serving.create_engine(url)
+        self._sweeper = _Sweeper(_sweep_seconds() if sweep_seconds is None else sweep_seconds)
+
+    def take(self, key, capacity, rate, now=None):
+        now = time.time() if now is None else now
+        if self._sweeper.due(capacity, rate, now):
+            self.sweep(now)
+        try:
+            return self._take(key, capacity, rate, now)
+        except IntegrityError:
+            # Корзину с этим ключом одновременно создала другая реплика
+            return self._take(key, capacity, rate, now)
+
+    def _take(self, key, capacity, rate, now):
+        c = buckets_table.c
+        refilled = c.tokens + (now - c.updated_at) * rate
+        available = case((refilled > capacity, capacity), else_=refilled)
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(buckets_table)
+                .where(c.key == key, available >= 1)
+                .values(tokens=available - 1, updated_at=now)
+            )
+            if result.rowcount:
+                return 0.0
+            tokens = conn.execute(select(available).where(c.key == key)).scalar_one_or_none()
+            if tokens is None:
+                conn.execute(insert(buckets_table).values(key=key, tokens=capacity - 1, updated_at=now))
+                return 0.0
+        return max(1 - tokens, 0) / rate
+
+    def sweep(self, now):
+        """Удаляет корзины, пополнившиеся до полной; каждая реплика чистит раз в sweep_seconds"""
+        with self.engine.begin() as conn:
+            conn.execute(delete(buckets_table).where(buckets_table.c.updated_at <= self._sweeper.cutoff(now)))
+
+
+def create_local_store(path):
+    """SQLite-база корзин для рабочих процессов одного пода (см. gunicorn_conf.py).
+    Она живёт вне общей базы и миграций, поэтому таблица создаётся здесь; возвращает адрес базы"""
+    url = f"sqlite:///{path}"
+    engine = serving.create_engine(url)
+    try:
+        _metadata.create_all(engine, checkfirst=True)
+    finally:
+        engine.dispose()
+    return url
+
+
+def create_backend():
+    kind = os.getenv("RATE_LIMIT_BACKEND", "none").lower()
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "database":
+        return DatabaseBackend(os.getenv("RATE_LIMIT_DATABASE_URL") or os.getenv("DATABASE_URL"))
+    return None
+
+
+def _trusted_networks():
+    value = os.getenv("TRUSTED_PROXIES", DEFAULT_TRUSTED_PROXIES)
+    return [ipaddress.ip_network(net.strip()) for net in value.split(",") if net.strip()]
+
+
+def client_ip(request: Request, trusted=None):
+    """IP клиента; заголовкам прокси верим, только если запрос пришёл от доверенного адреса"""
+    peer = request.client.host if request.client else ""
+    trusted = _trusted_networks() if trusted is None else trusted
+    try:
+        from_proxy = any(ipaddress.ip_address(peer) in net for net in trusted)
+    except ValueError:
+        from_proxy = False
+    if from_proxy:
+        forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+    return peer
+
+
+def token_subject(request: Request):
+    """sub из JWT, подписанного сервисом аутентификации, или None"""
+    authorization = request.headers.get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        return None
+    import jwt
+    try:
+        payload = jwt.decode(authorization.split(" ", 1)[1], os.getenv("JWT_SECRET", "myjwtsecret"), algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+    return payload.get("sub")
+
+
+def install(app: FastAPI, expensive_routes=(), backend=None):
+    """Подключает ограничитель к приложению; без настроенного бэкенда ничего не делает.
+
+    expensive_routes — регулярные выражения путей с дорогим бюджетом (re.match).
+    """
+    backend = backend or create_backend()
+    if backend is None:
+        return
+    budgets = {
+        "expensive": parse_rate(os.getenv("RATE_LIMIT_EXPENSIVE", "30/60")),
+        "cheap": parse_rate(os.getenv("RATE_LIMIT_CHEAP", "600/60")),
+    }
+    trusted = _trusted_networks()
+    expensive = re.compile("|".join(f"(?:{pattern})" for pattern in expensive_routes)) if expensive_routes else None
+    app.state.rate_limiter = backend
+
+    @app.middleware("http")
+    async def rate_limit(request: Request, call_next):
+        path = request.url.path
+        if request.method == "OPTIONS" or path.startswith(EXEMPT_PATHS):
+            return await call_next(request)
+
+        route_class = "expensive" if expensive and expensive.match(path) else "cheap"
+        subject = token_subject(request)
+        key = f"{route_class}:user:{subject}" if subject else f"{route_class}:ip:{client_ip(request, trusted)}"
+        capacity, rate = budgets[route_class]
+
+        if backend.blocking:
+            retry_after = await run_in_threadpool(backend.take, key, capacity, rate)
+        else:
+            retry_after = backend.take(key, capacity, rate)
+        if retry_after:
+            RATE_LIMITED.labels(route_class).inc()
+            return JSONResponse(
+                status_code=429,
+                content={"detail": "Слишком много запросов, повторите позже"},
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+        return await call_next(request)
@@ -0,0 +1,39 @@
+"""Запуск сервиса в нескольких рабочих процессах одного пода.
+
+Сервисы запускаются gunicorn с рабочими процессами uvicorn (см. gunicorn_conf.py).
+Приложение импортируется один раз в главном процессе (preload), и рабочие
+процессы получают его через fork. Подключения к базе, открытые до fork,
+нельзя делить между процессами, поэтому движки создаются через create_engine
+отсюда: после fork дочерний процесс забывает унаследованные подключения,
+не закрывая их у родителя.
+
+Пул подключений считается на рабочий процесс:
+
+    DB_POOL_SIZE    — постоянных подключений (по умолчанию 5)
+    DB_MAX_OVERFLOW — дополнительных подключений сверх пула (по умолчанию 10)
+
+Подключений к базе от пода — WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+"""
+import os
+
+import sqlalchemy
+
+
+def pool_options(url):
+    if str(url).startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_pre_ping": True,
+    }
+
+
+def fork_safe(engine):
+    """После fork пул дочернего процесса начинается с пустого"""
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+    return engine
+
+
+def create_engine(url, **kwargs):
+    return fork_safe(sqlalchemy.create_engine(url, **{**pool_options(url), **kwargs}))
@@ -0,0 +1,318 @@
+"""Состояние, общее для рабочих процессов одного пода.
+
+Под gunicorn с несколькими рабочими процессами (см. common/gunicorn_conf.py)
+запрос может попасть в любой из них, поэтому состояние между запросами —
+сессии приближённого анализа и состояния дозаписи анализа — хранится
+в каталоге SHARED_STATE_DIR. На tmpfs (/dev/shm) это общая память процессов
+пода: значения сериализуются pickle и записываются атомарной заменой файла.
+Без SHARED_STATE_DIR (один процесс, тесты) используется словарь в памяти.
+
+Хранилище — LRU ограниченного размера. Значения не блокируются: два процесса,
+одновременно изменившие одно значение, не портят его, побеждает последняя запись.
+У значения может быть метка (например, путь файла), по которой значения
+удаляются все сразу.
+
+Там же лежат блокировки flock: слоты (не больше N владельцев на под) и
+блокировка ведущего процесса для фоновой работы, нужной поду один раз,
+а также журнал — общая для процессов пода последовательность записей
+с номерами версий (см. Journal).
+"""
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+
+def _digest(value):
+    return hashlib.blake2b(repr(value).encode("utf-8"), digest_size=12).hexdigest()
+
+
+class MemoryStore:
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, tag=None):
+        with self._lock:
+            self._items[key] = (value, tag)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def pop_tag(self, tag):
+        with self._lock:
+            for key in [key for key, (_, item_tag) in self._items.items() if item_tag == tag]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._items))
+
+
+class DirectoryStore:
+    """Файл на значение: <хеш ключа>.<хеш метки>.pkl; порядок LRU — по mtime"""
+
+    def __init__(self, path, max_items):
+        self.path = path
+        self.max_items = max_items
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def _files(self, key="*", tag="*"):
+        return glob.glob(os.path.join(self.path, f"{key}.{tag}.pkl"))
+
+    def get(self, key):
+        for path in self._files(key=_digest(key)):
+            try:
+                with open(path, "rb") as f:
+                    value = pickle.load(f)
+                os.utime(path)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # Значение удалил или вытеснил другой процесс
+                return None
+            return value
+        return None
+
+    def put(self, key, value, tag=None):
+        self.pop(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, os.path.join(self.path, f"{_digest(key)}.{_digest(tag)}.pkl"))
+        except BaseException:
+            _remove(temp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        files = self._files()
+        if len(files) <= self.max_items:
+            return
+        by_age = sorted(files, key=lambda path: _mtime(path))
+        for path in by_age[:len(files) - self.max_items]:
+            _remove(path)
+
+    def pop(self, key):
+        for path in self._files(key=_digest(key)):
+            _remove(path)
+
+    def pop_tag(self, tag):
+        for path in self._files(tag=_digest(tag)):
+            _remove(path)
+
+    def clear(self):
+        for path in self._files():
+            _remove(path)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def create_store(name, max_items):
+    root = os.getenv("SHARED_STATE_DIR")
+    if not root:
+        return MemoryStore(max_items)
+    return DirectoryStore(os.path.join(root, name), max_items)
+
+
+class MemorySlots:
+    def __init__(self, count):
+        self._semaphore = threading.BoundedSemaphore(count)
+
+    def try_acquire(self):
+        """Маркер занятого слота или None, если свободных нет"""
+        return True if self._semaphore.acquire(blocking=False) else None
+
+    def release(self, token):
+        self._semaphore.release()
+
+
+class FileSlots:
+    """Слот — flock на одном из count файлов. Блокировка принадлежит открытому
+    файлу, поэтому слоты делят и потоки одного процесса, и процессы пода;
+    слот упавшего процесса освобождает ядро"""
+
+    def __init__(self, path, count):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self.paths = [os.path.join(path, f"slot-{i}.lock") for i in range(count)]
+
+    def try_acquire(self):
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def release(self, token):
+        os.close(token)
+
+
+def create_slots(name, count):
+    root = os.getenv("SHARED_STATE_DIR")
+    if not root:
+        return MemorySlots(count)
+    return FileSlots(os.path.join(root, name), count)
+
+
+class LeaderLock:
+    """Из процессов пода блокировку держит один; без SHARED_STATE_DIR процесс
+    считается единственным и всегда ведущий"""
+
+    def __init__(self, name):
+        root = os.getenv("SHARED_STATE_DIR")
+        self.path = os.path.join(root, f"{name}.lock") if root else None
+        self._fd = None
+
+    def acquire(self):
+        """Пытается стать ведущим, не дожидаясь; True, если блокировка у этого процесса"""
+        if self.path is None or self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Journal:
+    """Записи (словари с возрастающим "version") в файле JSON Lines, общем для процессов пода.
+    Пишут под flock, поэтому номера версий у всех процессов одни и те же; читает каждый
+    процесс сам, продолжая с места прошлого чтения. Файл хранит от max_items до 2 * max_items
+    последних записей: при переходе через кратное max_items он переписывается с последними.
+    Первая строка файла — его поколение: по нему читатель узнаёт, что файл переписан.
+    Без SHARED_STATE_DIR процесс считается единственным и журнал не ведётся"""
+
+    def __init__(self, name, max_items):
+        root = os.getenv("SHARED_STATE_DIR")
+        self.path = os.path.join(root, name) if root else None
+        self.max_items = max_items
+        self.rewind()
+        if self.path is not None:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    @property
+    def shared(self):
+        return self.path is not None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _flock(self):
+        fd = os.open(self._file("journal.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def locked(self):
+        """Блокировка записи; записи других процессов, прочитанные под ней, последние"""
+        return self._flock() if self.shared else nullcontext()
+
+    def epoch(self):
+        """Идентификатор журнала: меняется, только если журнал создан заново"""
+        if not self.shared:
+            return uuid.uuid4().hex[:12]
+        with self._flock():
+            try:
+                with open(self._file("epoch")) as f:
+                    return f.read()
+            except FileNotFoundError:
+                epoch = uuid.uuid4().hex[:12]
+                with open(self._file("epoch"), "w") as f:
+                    f.write(epoch)
+                return epoch
+
+    def rewind(self):
+        """Следующее чтение вернёт все записи файла"""
+        self._generation = None
+        self._offset = 0
+
+    def read(self):
+        """Записи, добавленные после прошлого чтения этого процесса. Если файл переписан,
+        он читается с начала: записи, уже известные процессу, вызывающий пропускает по version"""
+        if not self.shared:
+            return []
+        try:
+            f = open(self._file("journal.jsonl"), "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            generation = f.readline()
+            if generation != self._generation:
+                self._generation, self._offset = generation, len(generation)
+            f.seek(self._offset)
+            data = f.read()
+        # Строку, которую другой процесс ещё дописывает, прочитаем в следующий раз
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        return [json.loads(line) for line in data[:end].splitlines()]
+
+    def _rewrite(self, lines):
+        fd, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(uuid.uuid4().hex.encode("ascii") + b"\n" + b"".join(lines))
+        os.replace(temp_path, self._file("journal.jsonl"))
+
+    def append(self, items):
+        """Дописывает записи; вызывается под locked() после read()"""
+        if not self.shared or not items:
+            return
+        path = self._file("journal.jsonl")
+        if not os.path.exists(path):
+            self._rewrite([])
+        with open(path, "ab") as f:
+            f.write(b"".join(json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n" for item in items))
+        first, last = items[0]["version"], items[-1]["version"]
+        if (first - 1) // self.max_items != last // self.max_items:
+            with open(path, "rb") as f:
+                lines = f.read().splitlines(keepends=True)[1:]
+            self._rewrite(lines[-self.max_items:])
@@ -0,0 +1,142 @@
+"""Трассировка запросов в стиле OpenTelemetry.
+
+Входящий заголовок traceparent (W3C Trace Context) продолжает трассу,
+начатую nginx или другим сервисом; исходящие вызовы получают его через inject_headers.
+Экспорт настраивается переменными окружения:
+
+    OTEL_TRACES_EXPORTER=otlp   — в коллектор OTLP/HTTP (OTEL_EXPORTER_OTLP_ENDPOINT, по умолчанию http://localhost:4318)
+    OTEL_TRACES_EXPORTER=file   — JSON-строки в файл TRACE_FILE (по умолчанию traces.jsonl)
+    OTEL_TRACES_EXPORTER=none   — спаны не экспортируются (по умолчанию)
+
+Доля сохраняемых трасс задаётся стандартными OTEL_TRACES_SAMPLER/OTEL_TRACES_SAMPLER_ARG.
+"""
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi import FastAPI, Request
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+tracer = trace.get_tracer("projectsw")
+provider = None
+
+
+class FileSpanExporter(SpanExporter):
+    """Пишет завершённые спаны в файл по одному JSON-объекту на строку"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(span.to_json(indent=None) + "\n")
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def _create_exporter():
+    kind = os.getenv("OTEL_TRACES_EXPORTER", "none").lower()
+    if kind == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    if kind == "file":
+        return FileSpanExporter(os.getenv("TRACE_FILE", "traces.jsonl"))
+    return None
+
+
+def configure(service_name: str):
+    """Создаёт провайдер трассировки процесса; повторные вызовы ничего не меняют"""
+    global provider
+    if provider is not None:
+        return provider
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    exporter = _create_exporter()
+    if exporter is not None:
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return provider
+
+
+@contextmanager
+def span(name: str, **attributes):
+    with tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+def traced(name: str):
+    """Декоратор: выполняет функцию внутри спана с заданным именем"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attributes(**attributes):
+    current = trace.get_current_span()
+    for key, value in attributes.items():
+        current.set_attribute(key, value)
+
+
+def record_phases(phases, end_time=None):
+    """Добавляет к текущему спану дочерние спаны фаз, идущие подряд.
+
+    Используется там, где фазы чередуются в горячем цикле (разбор и агрегирование
+    порций строк): длительности накапливаются без спанов на каждую порцию,
+    а потом откладываются друг за другом, заканчиваясь в end_time.
+    """
+    end_ns = end_time or time.time_ns()
+    start_ns = end_ns - int(sum(seconds for _, seconds in phases) * 1e9)
+    for name, seconds in phases:
+        phase_end = start_ns + int(seconds * 1e9)
+        phase = tracer.start_span(name, start_time=start_ns, attributes={"phase.accumulated": True})
+        phase.end(end_time=phase_end)
+        start_ns = phase_end
+
+
+def inject_headers(headers=None):
+    """Заголовки с текущим контекстом трассы для исходящего HTTP-запроса"""
+    headers = dict(headers or {})
+    propagate.inject(headers)
+    return headers
+
+
+def install(app: FastAPI, service_name: str):
+    """Включает трассировку входящих запросов приложения"""
+    configure(service_name)
+
+    @app.middleware("http")
+    async def trace_request(request: Request, call_next):
+        context = propagate.extract(request.headers)
+        with tracer.start_as_current_span(request.method, context=context, kind=SpanKind.SERVER) as current:
+            current.set_attribute("http.request.method", request.method)
+            current.set_attribute("url.path", request.url.path)
+            request_id = request.headers.get("x-request-id")
+            if request_id:
+                current.set_attribute("http.request.id", request_id)
+            try:
+                response = await call_next(request)
+            except Exception as e:
+                current.record_exception(e)
+                current.set_status(Status(StatusCode.ERROR))
+                raise
+            route = request.scope.get("route")
+            if route is not None:
+                current.update_name(f"{request.method} {route.path}")
+                current.set_attribute("http.route", route.path)
+            current.set_attribute("http.response.status_code", response.status_code)
+            if response.status_code >= 500:
+                current.set_status(Status(StatusCode.ERROR))
+            return response
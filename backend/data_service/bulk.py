@@ -0,0 +1,186 @@
+"""Пакетная загрузка: много файлов одним запросом.
+
+Файлы приходят частями multipart или членами архива tar (в том числе
+tar.gz/bz2/xz) или zip. Каждый файл потоково копируется во временный
+файл в storage; после проверки всех файлов временные файлы переименовываются,
+а метаданные вставляются одним INSERT в одной транзакции.
+"""
+import hashlib
+import os
+import tarfile
+import uuid
+import zipfile
+import zlib
+
+from fastapi import HTTPException
+
+COPY_CHUNK = 1024 * 1024
+
+
+def get_max_files():
+    return int(os.getenv("BULK_MAX_FILES", "10000"))
+
+
+def get_max_bytes():
+    """Общий объём распакованных файлов пакета (защита от zip-бомб)"""
+    return int(os.getenv("BULK_MAX_BYTES", str(1024 ** 3)))
+
+
+class StagedFile:
+    def __init__(self, filename, part_path=None, size=0, status="pending", detail=None):
+        self.filename = filename
+        self.part_path = part_path
+        self.size = size
+        self.status = status
+        self.detail = detail
+        self.filetype = None
+        self.sha256 = None
+        self.id = None
+        self.published = None
+
+    def fail(self, status, detail):
+        self.status = status
+        self.detail = detail
+        self.discard()
+
+    def discard(self):
+        if self.part_path and os.path.exists(self.part_path):
+            os.remove(self.part_path)
+        self.part_path = None
+
+    def as_dict(self):
+        result = {"filename": self.filename, "status": self.status, "size": self.size}
+        if self.id is not None:
+            result["id"] = self.id
+            result["filetype"] = self.filetype
+            result["sha256"] = self.sha256
+        if self.detail:
+            result["detail"] = self.detail
+        return result
+
+
+def multipart_members(files):
+    for upload in files:
+        yield upload.filename, upload.file
+
+
+def archive_members(fileobj):
+    """(имя, поток) для обычных файлов архива zip или tar; поток нужно прочитать до следующего члена"""
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as stream:
+                        yield info.filename, stream
+        return
+
+    fileobj.seek(0)
+    try:
+        archive = tarfile.open(fileobj=fileobj, mode="r|*")
+    except tarfile.TarError:
+        raise HTTPException(status_code=400, detail="Архив должен быть в формате zip или tar")
+    with archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
+
+
+def part_path(storage_dir, filename):
+    """Временный файл рядом с итоговым: переименование на месте атомарно"""
+    return os.path.join(storage_dir, f".{filename}.{uuid.uuid4().hex}.part")
+
+
+def _copy_limited(stream, out, limit):
+    """Копирует поток порциями, попутно считая SHA-256; возвращает (размер, сумма)
+    или (None, None), если превышен limit"""
+    size = 0
+    digest = hashlib.sha256()
+    while True:
+        chunk = stream.read(COPY_CHUNK)
+        if not chunk:
+            return size, digest.hexdigest()
+        size += len(chunk)
+        if size > limit:
+            return None, None
+        digest.update(chunk)
+        out.write(chunk)
+
+
+def stage(members, storage_dir):
+    """Потоково записывает файлы пакета во временные файлы storage;
+    при ошибке уже записанные временные файлы удаляются"""
+    staged = []
+    try:
+        _stage(members, storage_dir, staged)
+    except (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError):
+        discard_all(staged)
+        raise HTTPException(status_code=400, detail="Архив повреждён")
+    except BaseException:
+        discard_all(staged)
+        raise
+    return staged
+
+
+def _stage(members, storage_dir, staged):
+    seen = set()
+    budget = get_max_bytes()
+    max_files = get_max_files()
+    for name, stream in members:
+        filename = os.path.basename(name.replace("\\", "/"))
+        if len(staged) >= max_files:
+            raise HTTPException(status_code=413, detail=f"В пакете больше {max_files} файлов")
+        if not filename or filename.startswith("."):
+            staged.append(StagedFile(name, status="error", detail="Некорректное имя файла"))
+            continue
+        if filename in seen:
+            staged.append(StagedFile(filename, status="error", detail="Имя файла повторяется в пакете"))
+            continue
+        seen.add(filename)
+
+        item = StagedFile(filename, part_path(storage_dir, filename))
+        with open(item.part_path, "wb") as out:
+            size, item.sha256 = _copy_limited(stream, out, budget)
+        if size is None:
+            item.fail("error", "Превышен общий размер пакета")
+            budget = 0
+        else:
+            item.size = size
+            budget -= size
+        staged.append(item)
+
+
+def discard_all(staged):
+    for item in staged:
+        item.discard()
+
+
+def link_exclusive(part_location, final_path):
+    """Публикует временный файл под итоговым именем, не заменяя существующий файл:
+    жёсткая ссылка создаётся, только если имени ещё нет. False, если имя занято"""
+    try:
+        os.link(part_location, final_path)
+    except FileExistsError:
+        return False
+    os.remove(part_location)
+    return True
+
+
+def publish(item, storage_dir):
+    """Переносит проверенный файл на постоянное место; если файл с таким именем
+    успела записать параллельная загрузка, файл пакета отклоняется"""
+    final_path = os.path.join(storage_dir, item.filename)
+    if not link_exclusive(item.part_path, final_path):
+        item.fail("exists", "Файл с таким именем уже существует")
+        return None
+    item.part_path = None
+    item.published = final_path
+    return final_path
+
+
+def remove_published(items):
+    """Удаляет только файлы, опубликованные этим пакетом"""
+    for item in items:
+        if item.published and os.path.exists(item.published):
+            os.remove(item.published)
+        item.published = None
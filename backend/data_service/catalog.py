@@ -0,0 +1,276 @@
+"""Каталог файлов в памяти процесса.
+
+/files отдаётся из снимка, а не из базы: снимок загружается при первом
+обращении и обновляется на месте при загрузке, изменении и удалении файлов
+в этом процессе. Каждое изменение увеличивает версию и попадает в журнал
+изменений ограниченной длины, по которому /files/changes отдаёт клиенту только
+разницу с его версией.
+
+Изменения, сделанные другими репликами и обработчиком фоновых задач
+(worker.py: суммы дописанных файлов, результаты проверки целостности),
+подхватываются повторным чтением базы не чаще раза в CATALOG_REFRESH_SECONDS:
+новый снимок сравнивается со старым, и разница попадает в тот же журнал.
+По умолчанию 0 — база не перечитывается, этого достаточно одному процессу
+без обработчика; docker-compose и k8s, где базу меняют и другие, задают 5.
+
+Рабочие процессы пода (см. common/gunicorn_conf.py) нумеруют изменения вместе:
+каждое изменение записывается в журнал в SHARED_STATE_DIR (sharedstate.Journal),
+и остальные процессы дочитывают его при следующем обращении к каталогу. Поэтому
+у процессов пода одна эпоха и одни версии, и ETag и курсор, выданные одним
+процессом, понимает любой другой.
+
+Версии разных подов несравнимы, поэтому курсор — "эпоха.версия", где эпоха
+случайна для каждого журнала (без SHARED_STATE_DIR — для каждого процесса).
+Курсор чужой эпохи или слишком старый приводит к полному ответу (reset).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from fastapi.concurrency import run_in_threadpool
+
+import crud
+from common import sharedstate, tracing
+
+FIELDS = ("id", "filename", "filetype", "title", "description", "sha256", "size", "verified_at", "integrity_error")
+# Как часто ожидающий запрос дочитывает журнал других процессов пода
+JOURNAL_POLL_SECONDS = 0.2
+
+
+def _plain(value):
+    # Снимок отдаётся готовым JSON, поэтому даты хранятся строками, как их отдавал бы FastAPI
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def as_entry(db_file):
+    return {field: _plain(getattr(db_file, field)) for field in FIELDS}
+
+
+class Catalog:
+    def __init__(self, refresh_seconds=0.0, max_changes=1000):
+        self.refresh_seconds = refresh_seconds
+        self.max_changes = max_changes
+        self.journal = sharedstate.Journal("catalog", max_changes)
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            refresh_seconds=float(os.getenv("CATALOG_REFRESH_SECONDS", "0")),
+            max_changes=int(os.getenv("CATALOG_MAX_CHANGES", "1000")),
+        )
+
+    def reset(self):
+        """Забывает снимок; следующее обращение перечитает базу"""
+        with self._lock:
+            self.journal.rewind()
+            self.epoch = self.journal.epoch()
+            self.version = 0
+            self._files = None
+            self._loaded_at = 0.0
+            self._reload = False
+            self._changes = deque(maxlen=self.max_changes)
+            self._touched = None
+            self._pending = None
+            self._body = None
+            self._waiters = []
+
+    @property
+    def cursor(self):
+        return f"{self.epoch}.{self.version}"
+
+    def _store(self, change):
+        """Добавляет изменение с уже назначенной версией в журнал процесса; вызывается под блокировкой"""
+        self.version = change["version"]
+        self._changes.append(change)
+        if self._touched is not None:
+            self._touched.add(change["filename"])
+        self._body = None
+
+    def _record(self, op, filename, entry):
+        """Применяет изменение к снимку; вызывается под блокировкой"""
+        if self._files is not None:
+            if op == "delete":
+                if self._files.pop(filename, None) is None:
+                    return
+            else:
+                if self._files.get(filename) == entry:
+                    return
+                self._files[filename] = entry
+        # Без снимка изменение всё равно нумеруется: другие процессы пода его применят
+        change = {"version": self.version + 1, "op": op, "filename": filename, "file": entry}
+        self._store(change)
+        if self._pending is not None:
+            self._pending.append(change)
+
+    def _sync(self):
+        """Применяет изменения, записанные другими процессами пода; вызывается под блокировкой"""
+        applied = False
+        for change in self.journal.read():
+            if change["version"] <= self.version:
+                continue
+            applied = True
+            if change["version"] > self.version + 1:
+                # Журнал уже не помнит пропущенные изменения: снимок будет перечитан из базы,
+                # а курсоры до пропуска получат полный список
+                self._reload = True
+                self._changes.clear()
+            if self._files is not None:
+                if change["op"] == "delete":
+                    self._files.pop(change["filename"], None)
+                else:
+                    self._files[change["filename"]] = change["file"]
+            self._store(change)
+        if applied:
+            self._notify()
+
+    @contextmanager
+    def _writing(self):
+        """Изменения внутри блока получают версии после всех записей журнала и попадают в него;
+        вызывается под блокировкой"""
+        with self.journal.locked():
+            self._sync()
+            self._pending = []
+            try:
+                yield
+            finally:
+                pending, self._pending = self._pending, None
+                self.journal.append(pending)
+
+    def _notify(self):
+        waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def _apply(self, changes):
+        with self._lock, self._writing():
+            for op, filename, entry in changes:
+                self._record(op, filename, entry)
+            self._notify()
+
+    def upsert(self, entries):
+        self._apply([("upsert", entry["filename"], entry) for entry in entries])
+
+    def update(self, filenames, values):
+        with self._lock, self._writing():
+            if self._files is None:
+                # Прежних значений нет: другие процессы увидят изменение при перечитывании базы
+                return
+            for filename in filenames:
+                current = self._files.get(filename)
+                if current is not None:
+                    self._record("upsert", filename, {**current, **values})
+            self._notify()
+
+    def delete(self, filenames):
+        self._apply([("delete", filename, None) for filename in filenames])
+
+    def _stale(self):
+        if self._files is None or self._reload:
+            return True
+        return self.refresh_seconds > 0 and time.monotonic() - self._loaded_at >= self.refresh_seconds
+
+    @tracing.traced("catalog.refresh")
+    def refresh(self, db, force=False):
+        """Перечитывает базу, если снимок устарел, и записывает разницу в журнал"""
+        with self._lock:
+            self._sync()
+            if not force and not self._stale():
+                return
+            # Пока идёт чтение, другие запросы пользуются прежним снимком,
+            # а имена файлов, изменённых за это время, запоминаются
+            self._loaded_at = time.monotonic()
+            self._reload = False
+            self._touched = set()
+            loaded_from = self.version
+
+        loaded = {f.filename: as_entry(f) for f in crud.get_all_files(db)}
+
+        with self._lock, self._writing():
+            recent, self._touched = self._touched, None
+            if self._files is None:
+                # Изменения, записанные во время чтения, могли в него не попасть
+                for change in self._changes:
+                    if change["version"] > loaded_from and change["filename"] in recent:
+                        if change["op"] == "delete":
+                            loaded.pop(change["filename"], None)
+                        else:
+                            loaded[change["filename"]] = change["file"]
+                self._files = loaded
+                self._body = None
+                return
+            # Локальные изменения, сделанные во время чтения, новее прочитанного
+            for filename in list(self._files):
+                if filename not in loaded and filename not in recent:
+                    self._record("delete", filename, None)
+            for filename, entry in loaded.items():
+                if filename not in recent:
+                    self._record("upsert", filename, entry)
+            self._notify()
+
+    def body(self, db):
+        """JSON списка файлов (по возрастанию id) и его курсор; сериализуется один раз на версию"""
+        self.refresh(db)
+        with self._lock:
+            if self._body is None:
+                files = sorted(self._files.values(), key=lambda entry: entry["id"])
+                self._body = json.dumps(files, ensure_ascii=False).encode("utf-8")
+            return self._body, self.cursor
+
+    def changes_since(self, cursor):
+        """Изменения после курсора клиента; если курсор чужой или журнал его уже
+        не помнит — полный список с флагом reset"""
+        epoch, _, version = (cursor or "").partition(".")
+        with self._lock:
+            self._sync()
+            known = epoch == self.epoch and version.isdigit() and int(version) <= self.version
+            oldest = self._changes[0]["version"] if self._changes else self.version + 1
+            if known and (int(version) == self.version or oldest <= int(version) + 1):
+                changes = [change for change in self._changes if change["version"] > int(version)]
+                return {"cursor": self.cursor, "reset": False, "changes": changes}
+            files = sorted(self._files.values(), key=lambda entry: entry["id"])
+            return {"cursor": self.cursor, "reset": True, "files": files}
+
+    async def wait(self, db, cursor, timeout):
+        """Ждёт изменения после курсора не дольше timeout секунд; пока ждёт,
+        перечитывает базу с периодом refresh_seconds, чтобы заметить изменения других реплик"""
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            future = loop.create_future()
+            with self._lock:
+                self._sync()
+                if self._has_news(cursor):
+                    return
+                self._waiters.append((loop, future))
+            step = min(remaining, self.refresh_seconds) if self.refresh_seconds > 0 else remaining
+            if self.journal.shared:
+                step = min(step, JOURNAL_POLL_SECONDS)
+            try:
+                await asyncio.wait_for(future, step)
+                return
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self._waiters = [waiter for waiter in self._waiters if waiter[1] is not future]
+            await run_in_threadpool(self.refresh, db)
+
+    def _has_news(self, cursor):
+        epoch, _, version = (cursor or "").partition(".")
+        return epoch != self.epoch or not version.isdigit() or int(version) != self.version
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+catalog = Catalog.from_env()
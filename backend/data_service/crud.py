@@ -1,26 +1,134 @@
+from sqlalchemy import delete, insert, update
 from sqlalchemy.orm import Session
+import jobs
 import models
 import schemas
+from common import events, tracing
 
+@tracing.traced("crud.create_file_metadata")
 def create_file_metadata(db: Session, file_metadata: schemas.FileMetadataCreate):
     db_file = models.FileMetadata(
         filename=file_metadata.filename,
         filetype=file_metadata.filetype,
         title=file_metadata.title,
-        description=file_metadata.description
+        description=file_metadata.description,
+        sha256=file_metadata.sha256,
+        size=file_metadata.size
     )
     db.add(db_file)
+    events.publish(db, events.FILE_UPLOADED, [{"filename": db_file.filename, "filetype": db_file.filetype}])
+    jobs.enqueue(db, [(db_file.filename, db_file.filetype, db_file.sha256 is not None)])
     db.commit()
     db.refresh(db_file)
     return db_file
 
+@tracing.traced("crud.create_derived_file")
+def create_derived_file(db: Session, derived: schemas.DerivedFileCreate):
+    """Метаданные производного файла и запись о его происхождении сохраняются одной транзакцией"""
+    db_file = models.FileMetadata(
+        filename=derived.filename,
+        filetype=derived.filetype,
+        title=derived.title,
+        description=derived.description
+    )
+    db.add(db_file)
+    db.add(models.FileLineage(
+        filename=derived.filename,
+        source_filename=derived.source_filename,
+        operation=derived.operation
+    ))
+    events.publish(db, events.FILE_UPLOADED, [{"filename": derived.filename, "filetype": derived.filetype}])
+    jobs.enqueue(db, [(derived.filename, derived.filetype, False)])
+    db.commit()
+    db.refresh(db_file)
+    return db_file
+
+@tracing.traced("crud.get_file_lineage")
+def get_file_lineage(db: Session, filename: str):
+    return db.query(models.FileLineage).filter(models.FileLineage.filename == filename).all()
+
+@tracing.traced("crud.get_file_metadata")
+def get_file_metadata(db: Session, filename: str):
+    return db.query(models.FileMetadata).filter(models.FileMetadata.filename == filename).first()
+
+@tracing.traced("crud.mark_file_content_changed")
+def mark_file_content_changed(db: Session, filename: str, size: int):
+    """CSV дописан: прежние сумма и статистика недействительны, их пересчитают фоновые задачи"""
+    db.execute(
+        update(models.FileMetadata).where(models.FileMetadata.filename == filename)
+        .values(sha256=None, size=size, verified_at=None, integrity_error=None)
+    )
+    jobs.enqueue(db, [(filename, "csv", False)])
+    events.publish(db, events.FILE_UPDATED, [{"filename": filename, "filetype": "csv", "size": size}])
+    db.commit()
+
+@tracing.traced("crud.get_file_jobs")
+def get_file_jobs(db: Session, filename: str):
+    return db.query(models.FileJob).filter(models.FileJob.filename == filename).order_by(models.FileJob.id).all()
+
+@tracing.traced("crud.get_existing_filenames")
+def get_existing_filenames(db: Session, filenames):
+    if not filenames:
+        return set()
+    rows = db.query(models.FileMetadata.filename).filter(models.FileMetadata.filename.in_(filenames)).all()
+    return {row.filename for row in rows}
+
+@tracing.traced("crud.create_files_metadata")
+def create_files_metadata(db: Session, files):
+    """Вставляет метаданные многих файлов одним INSERT ... RETURNING и одной транзакцией;
+    возвращает {имя файла: id}"""
+    rows = db.execute(
+        insert(models.FileMetadata).returning(models.FileMetadata.id, models.FileMetadata.filename),
+        [file.model_dump() for file in files],
+    ).all()
+    events.publish(db, events.FILE_UPLOADED, [{"filename": file.filename, "filetype": file.filetype} for file in files])
+    jobs.enqueue(db, [(file.filename, file.filetype, file.sha256 is not None) for file in files])
+    db.commit()
+    return {row.filename: row.id for row in rows}
+
+@tracing.traced("crud.get_all_files")
 def get_all_files(db: Session):
     return db.query(models.FileMetadata).all()
 
+@tracing.traced("crud.delete_file_metadata")
 def delete_file_metadata(db: Session, filename: str):
     file_obj = db.query(models.FileMetadata).filter(models.FileMetadata.filename == filename).first()
     if not file_obj:
         return False
     db.delete(file_obj)
+    events.publish(db, events.FILE_DELETED, [{"filename": filename}])
+    jobs.forget(db, [filename])
+    db.commit()
+    return True
+
+def _selector_clauses(selector: schemas.FileSelector):
+    """Условия WHERE для набора файлов; условия объединяются через AND"""
+    columns = models.FileMetadata
+    clauses = []
+    if selector.filenames is not None:
+        clauses.append(columns.filename.in_(selector.filenames))
+    if selector.filetype is not None:
+        clauses.append(columns.filetype == selector.filetype)
+    if selector.filename_prefix:
+        clauses.append(columns.filename.startswith(selector.filename_prefix, autoescape=True))
+    return clauses
+
+@tracing.traced("crud.delete_files_metadata")
+def delete_files_metadata(db: Session, selector: schemas.FileSelector):
+    """Удаляет метаданные всех подходящих файлов одним DELETE ... RETURNING; возвращает имена"""
+    rows = db.execute(
+        delete(models.FileMetadata).where(*_selector_clauses(selector)).returning(models.FileMetadata.filename)
+    ).all()
+    events.publish(db, events.FILE_DELETED, [{"filename": row.filename} for row in rows])
+    jobs.forget(db, [row.filename for row in rows])
+    db.commit()
+    return [row.filename for row in rows]
+
+@tracing.traced("crud.update_files_metadata")
+def update_files_metadata(db: Session, selector: schemas.FileSelector, values):
+    """Меняет поля всех подходящих файлов одним UPDATE ... RETURNING; возвращает имена"""
+    rows = db.execute(
+        update(models.FileMetadata).where(*_selector_clauses(selector)).values(**values).returning(models.FileMetadata.filename)
+    ).all()
     db.commit()
-    return True
\ No newline at end of file
+    return [row.filename for row in rows]
@@ -0,0 +1,163 @@
+"""Контрольные суммы файлов в storage.
+
+SHA-256 считается при потоковой записи загрузки на диск, без повторного
+чтения файла, и хранится в FileMetadata вместе с размером. /download отдаёт
+его в заголовках ETag, Digest и Repr-Digest и перед отдачей сверяет размер файла.
+
+Scrubber заново читает файлы с ограничением скорости ввода-вывода и сверяет
+суммы; у файлов без суммы (загруженных раньше) сумма досчитывается.
+Включается в worker.py переменными окружения:
+
+    SCRUB_BYTES_PER_SECOND — скорость чтения; 0 (по умолчанию) — scrubber выключен
+    SCRUB_INTERVAL_SECONDS — пауза между полными проходами, по умолчанию сутки
+"""
+import base64
+import hashlib
+import os
+import threading
+import time
+
+from sqlalchemy import func, select, update
+
+import models
+
+COPY_CHUNK = 1024 * 1024
+SCRUB_BATCH = 100
+
+
+class Throttle:
+    """Выдерживает среднюю скорость не выше bytes_per_second (0 — без ограничения)"""
+
+    def __init__(self, bytes_per_second, stop=None):
+        self.bytes_per_second = bytes_per_second
+        self.stop = stop or threading.Event()
+        self.started = time.monotonic()
+        self.total = 0
+
+    def consume(self, size):
+        if not self.bytes_per_second:
+            return
+        self.total += size
+        ahead = self.total / self.bytes_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            self.stop.wait(ahead)
+
+
+def sha256_file(path, throttle=None):
+    """SHA-256 и размер файла"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK):
+            digest.update(chunk)
+            size += len(chunk)
+            if throttle is not None:
+                throttle.consume(len(chunk))
+                if throttle.stop.is_set():
+                    return None, size
+    return digest.hexdigest(), size
+
+
+def digest_headers(sha256_hex):
+    encoded = base64.b64encode(bytes.fromhex(sha256_hex)).decode("ascii")
+    return {
+        "ETag": f'"{sha256_hex}"',
+        "Digest": f"sha-256={encoded}",
+        "Repr-Digest": f"sha-256=:{encoded}:",
+    }
+
+
+def check_size(db_file, file_path):
+    """Ошибка целостности, заметная без чтения файла, или None"""
+    if db_file.integrity_error:
+        return db_file.integrity_error
+    if db_file.size is not None and os.path.getsize(file_path) != db_file.size:
+        return f"размер {os.path.getsize(file_path)} байт вместо {db_file.size}"
+    return None
+
+
+class Scrubber:
+    def __init__(self, session_factory, storage_dir, bytes_per_second, interval_seconds=86400.0):
+        self.session_factory = session_factory
+        self.storage_dir = storage_dir
+        self.bytes_per_second = bytes_per_second
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls, session_factory):
+        rate = float(os.getenv("SCRUB_BYTES_PER_SECOND", "0"))
+        if rate <= 0:
+            return None
+        return cls(
+            session_factory,
+            os.getenv("STORAGE_DIR", "storage"),
+            rate,
+            interval_seconds=float(os.getenv("SCRUB_INTERVAL_SECONDS", "86400")),
+        )
+
+    def _record(self, db, row, **values):
+        # Файл могли перезаписать или дописать во время чтения — тогда результат не записывается
+        c = models.FileMetadata
+        same_sha256 = c.sha256.is_(None) if row.sha256 is None else c.sha256 == row.sha256
+        same_size = c.size.is_(None) if row.size is None else c.size == row.size
+        db.execute(update(c).where(c.id == row.id, same_sha256, same_size).values(**values))
+        db.commit()
+
+    def verify(self, db, row, throttle):
+        """Проверяет один файл; возвращает описание ошибки или None"""
+        file_path = os.path.join(self.storage_dir, row.filename)
+        if not os.path.exists(file_path):
+            error = "файл отсутствует в хранилище"
+        else:
+            sha256, size = sha256_file(file_path, throttle)
+            if sha256 is None:
+                return None
+            if row.sha256 is None:
+                self._record(db, row, sha256=sha256, size=size, verified_at=func.now(), integrity_error=None)
+                return None
+            if sha256 == row.sha256 and size == row.size:
+                self._record(db, row, verified_at=func.now(), integrity_error=None)
+                return None
+            error = f"контрольная сумма не совпадает (размер {size} байт, записан {row.size})"
+        print(f"Нарушена целостность {row.filename}: {error}")
+        self._record(db, row, integrity_error=error)
+        return error
+
+    def run_pass(self):
+        """Один проход по всем файлам порциями по id; возвращает число файлов с ошибками"""
+        throttle = Throttle(self.bytes_per_second, self._stop)
+        c = models.FileMetadata
+        last_id, errors = 0, 0
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                rows = db.execute(
+                    select(c.id, c.filename, c.sha256, c.size).where(c.id > last_id).order_by(c.id).limit(SCRUB_BATCH)
+                ).all()
+                if not rows:
+                    return errors
+                for row in rows:
+                    if self._stop.is_set():
+                        break
+                    errors += self.verify(db, row, throttle) is not None
+                    last_id = row.id
+            finally:
+                db.close()
+        return errors
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pass()
+            except Exception as e:
+                print(f"Ошибка проверки целостности: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, name="scrubber", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self, *args):
+        self._stop.set()
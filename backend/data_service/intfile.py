@@ -1,14 +1,25 @@
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, APIRouter, Request, Form
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, APIRouter, Request, Form, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 import models
 import schemas
 import crud
 from database import engine, SessionLocal
-import os, csv
+from common import auth, csvio, filetypes, metrics, tracing
+from typing import List
+import bulk, integrity, jobs, search
+from catalog import as_entry, catalog
+import codecs, fcntl, hashlib, logging, os, time
+from urllib.parse import quote, urlencode
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+UPLOAD_CHUNK = 1024 * 1024
+
 def get_storage_dir():
     """Получает путь к папке storage из переменной окружения"""
     return os.getenv("STORAGE_DIR", "storage")
@@ -20,6 +31,30 @@ def get_db():
     finally:
         db.close()
 
+def detect_filetype(filename):
+    if filename.endswith((".jpeg", ".png", ".jpg")):
+        return "photo"
+    if csvio.is_csv_filename(filename):
+        return "csv"
+    return filetypes.columnar_filetype(filename) or "other"
+
+def validate_stored_file(file_location, filename, filetype):
+    """Проверяет записанный файл по его типу: у CSV должен читаться заголовок,
+    Parquet/Arrow должны иметь корректную сигнатуру"""
+    if filetype == "csv":
+        try:
+            with tracing.span("upload.validate_header"):
+                fmt = csvio.sniff(file_location, filename)
+                with csvio.open_text(file_location, fmt) as csvfile:
+                    header = next(csvio.reader(csvfile, fmt), None)
+        except (OSError, EOFError):
+            raise HTTPException(status_code=400, detail="Некорректный gzip-архив")
+        if header is None:
+            raise HTTPException(status_code=400, detail="Файл пустой")
+
+    if filetype in ("parquet", "arrow") and filetypes.sniff_columnar(file_location, filename) is None:
+        raise HTTPException(status_code=400, detail="Файл повреждён или не является файлом Parquet/Arrow")
+
 @router.post("/upload")
 async def upload_data(
     file: UploadFile = File(...),
@@ -27,13 +62,48 @@ async def upload_data(
     description: str = Form(None),
     db: Session = Depends(get_db)
 ):
-    os.makedirs(get_storage_dir(), exist_ok=True)
-    
-    file_location = os.path.join(get_storage_dir(), file.filename)
-    with open(file_location, "wb") as f:
-        f.write(await file.read())
+    storage_dir = get_storage_dir()
+    os.makedirs(storage_dir, exist_ok=True)
 
-    filetype = "photo" if file.filename.endswith(".jpeg") or file.filename.endswith(".png") or file.filename.endswith(".jpg") else "csv" if file.filename.endswith(".csv") else "other"
+    # Существующий файл не перезаписывается: его строка хранит прежние sha256 и размер
+    if crud.get_existing_filenames(db, [file.filename]):
+        raise HTTPException(status_code=409, detail="Файл с таким именем уже существует")
+
+    file_location = os.path.join(storage_dir, file.filename)
+    part_location = bulk.part_path(storage_dir, file.filename)
+    try:
+        db_file = await _store_upload(file, title, description, db, part_location, file_location)
+    finally:
+        # Временный файл остаётся, если клиент оборвал передачу или файл не прошёл проверку
+        if os.path.exists(part_location):
+            os.remove(part_location)
+    catalog.upsert([as_entry(db_file)])
+    return db_file
+
+async def _store_upload(file, title, description, db, part_location, file_location):
+    started = time.perf_counter()
+    with tracing.span("upload.stream"):
+        # Тело читается порциями: SHA-256 считается по пути на диск, без повторного чтения файла
+        digest = hashlib.sha256()
+        size = 0
+        read_seconds = write_seconds = 0.0
+        with open(part_location, "wb") as f:
+            while True:
+                chunk_started = time.perf_counter()
+                chunk = await file.read(UPLOAD_CHUNK)
+                read_done = time.perf_counter()
+                read_seconds += read_done - chunk_started
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+                write_seconds += time.perf_counter() - read_done
+        tracing.set_attributes(size=size)
+        tracing.record_phases([("upload.read_body", read_seconds), ("upload.write_file", write_seconds)])
+    metrics.observe_upload(size, time.perf_counter() - started)
+
+    filetype = detect_filetype(file.filename)
 
     # Если title не указан, используем имя файла
     if title is None:
@@ -44,39 +114,331 @@ async def upload_data(
         title=title,
         description=description,
         filetype=filetype,
+        sha256=digest.hexdigest(),
+        size=size,
     )
 
-    if filetype == "csv":
-        with open(file_location, "r", encoding="utf-8", newline="") as csvfile:
-            reader = csv.reader(csvfile)
-            header = next(reader, None)
-            if header is None:
-                raise HTTPException(status_code=400, detail="Файл пустой")
+    validate_stored_file(part_location, file.filename, filetype)
+    # Файл появляется под своим именем только целиком и не заменяет файл параллельной загрузки
+    if not bulk.link_exclusive(part_location, file_location):
+        raise HTTPException(status_code=409, detail="Файл с таким именем уже существует")
 
-    db_file = crud.create_file_metadata(db, metadata)
-    return db_file
+    try:
+        return crud.create_file_metadata(db, metadata)
+    except IntegrityError:
+        db.rollback()
+        # Файл под этим именем создан этим запросом: ссылка была исключительной
+        os.remove(file_location)
+        raise HTTPException(status_code=409, detail="Файл с таким именем был загружен параллельно, повторите запрос")
+
+def store_bulk(members, description, db):
+    """Записывает пакет: каждый файл проверяется отдельно, ошибки одного файла
+    не мешают остальным; метаданные всех принятых файлов вставляются одной транзакцией"""
+    storage_dir = get_storage_dir()
+    started = time.perf_counter()
+    with tracing.span("upload.bulk_stage"):
+        staged = bulk.stage(members, storage_dir)
+
+    pending = [item for item in staged if item.status == "pending"]
+    existing = crud.get_existing_filenames(db, [item.filename for item in pending])
+    valid = []
+    for item in pending:
+        if item.filename in existing:
+            item.fail("exists", "Файл с таким именем уже существует")
+            continue
+        item.filetype = detect_filetype(item.filename)
+        try:
+            validate_stored_file(item.part_path, item.filename, item.filetype)
+        except HTTPException as e:
+            item.fail("error", e.detail)
+            continue
+        valid.append(item)
+
+    with tracing.span("upload.bulk_publish", files=len(valid)):
+        valid = [item for item in valid if bulk.publish(item, storage_dir)]
+    rows = [
+        schemas.FileMetadataCreate(
+            filename=item.filename, title=item.filename, description=description, filetype=item.filetype,
+            sha256=item.sha256, size=item.size,
+        )
+        for item in valid
+    ]
+    try:
+        ids = crud.create_files_metadata(db, rows) if rows else {}
+    except IntegrityError:
+        db.rollback()
+        bulk.remove_published(valid)
+        raise HTTPException(status_code=409, detail="Файлы с такими именами были загружены параллельно, повторите запрос")
+    for item in valid:
+        item.status = "created"
+        item.id = ids[item.filename]
+    catalog.upsert([{**row.model_dump(), "id": ids[row.filename]} for row in rows])
+    metrics.observe_upload(sum(item.size for item in valid), time.perf_counter() - started)
+
+    return {
+        "created": len(valid),
+        "failed": len(staged) - len(valid),
+        "files": [item.as_dict() for item in staged],
+    }
+
+@router.post("/upload/bulk")
+async def upload_bulk(
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    description: str = Form(None),
+    db: Session = Depends(get_db)
+):
+    """Загружает много файлов одним запросом: частями multipart (files) или архивом
+    zip/tar (archive). В ответе — статус каждого файла"""
+    if not files and archive is None:
+        raise HTTPException(status_code=400, detail="Передайте файлы (files) или архив (archive)")
+    os.makedirs(get_storage_dir(), exist_ok=True)
+
+    members = bulk.archive_members(archive.file) if archive is not None else bulk.multipart_members(files)
+    return await run_in_threadpool(store_bulk, members, description, db)
+
+@router.post("/files/{filename}/append")
+async def append_data(filename: str, file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """Дописывает строки в конец несжатого CSV. Если порция начинается с той же строки
+    заголовка, что и файл, заголовок отбрасывается"""
+    db_file = crud.get_file_metadata(db, filename)
+    file_location = os.path.join(get_storage_dir(), filename)
+    if db_file is None or not os.path.exists(file_location):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    if db_file.filetype != "csv" or csvio.is_gzip(file_location):
+        raise HTTPException(status_code=400, detail="Дозапись поддерживается только для несжатых CSV")
+
+    started = time.perf_counter()
+    with open(file_location, "r+b") as f:
+        # Одновременные дозаписи одного файла выполняются по очереди и не перемешивают строки
+        await run_in_threadpool(fcntl.flock, f, fcntl.LOCK_EX)
+        try:
+            header_line = f.readline()
+            original_size = f.seek(0, os.SEEK_END)
+            with tracing.span("upload.append_file"):
+                try:
+                    appended = await _append_body(file, f, header_line, original_size)
+                except BaseException:
+                    # Оборванная передача не оставляет в файле неполной строки
+                    f.truncate(original_size)
+                    raise
+                size = f.tell()
+                tracing.set_attributes(size=appended)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    metrics.observe_upload(appended, time.perf_counter() - started)
+    # Сумму всего файла заново считает фоновая задача checksum
+    crud.mark_file_content_changed(db, filename, size)
+    catalog.update([filename], {"sha256": None, "size": size, "verified_at": None, "integrity_error": None})
+
+    return {"filename": filename, "appended_bytes": appended, "size": size}
+
+async def _append_body(file, f, header_line, size):
+    """Пишет тело запроса порциями UPLOAD_CHUNK в конец f (размер size);
+    возвращает число дописанных байт"""
+    # Первая строка нужна целиком, чтобы сравнить её с заголовком файла
+    head = b""
+    while b"\n" not in head:
+        chunk = await file.read(UPLOAD_CHUNK)
+        if not chunk:
+            break
+        head += chunk
+    head = head.removeprefix(codecs.BOM_UTF8)
+    first_line, _, rest = head.partition(b"\n")
+    if first_line.rstrip(b"\r") == header_line.removeprefix(codecs.BOM_UTF8).rstrip(b"\r\n"):
+        head = rest or await file.read(UPLOAD_CHUNK)
+    if not head:
+        return 0
+
+    if size > 0:
+        f.seek(size - 1)
+        if f.read(1) not in (b"\n", b"\r"):
+            head = b"\n" + head
+    f.seek(size)
+    appended = 0
+    chunk = head
+    while chunk:
+        f.write(chunk)
+        appended += len(chunk)
+        chunk = await file.read(UPLOAD_CHUNK)
+    return appended
 
 @router.get("/download/{filename}")
-async def download_data(filename: str):
+async def download_data(filename: str, request: Request, db: Session = Depends(get_db)):
+    """Отдаёт файл с SHA-256 в ETag, Digest и Repr-Digest; файл, размер которого
+    не совпадает с записанным при загрузке, не отдаётся"""
     file_path = os.path.join(get_storage_dir(), filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Файл не найден")
-    
-    return FileResponse(file_path)
+
+    db_file = crud.get_file_metadata(db, filename)
+    if db_file is None or db_file.sha256 is None:
+        return FileResponse(file_path)
+    error = integrity.check_size(db_file, file_path)
+    if error:
+        raise HTTPException(status_code=500, detail=f"Файл в хранилище повреждён: {error}")
+    headers = integrity.digest_headers(db_file.sha256)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(file_path, headers=headers)
+
+@router.get("/files/{filename}/download-link")
+async def download_link(filename: str):
+    """Подписанная ссылка на скачивание без заголовка Authorization (для <img> и
+    ссылок в браузере); url задан относительно корня сервиса"""
+    if not os.path.exists(os.path.join(get_storage_dir(), filename)):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    params = auth.sign_path(f"/download/{filename}")
+    return {"url": f"download/{quote(filename)}?{urlencode(params)}", **params}
+
+def etag_matches(request: Request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
 
 @router.get("/files")
-async def list_files(db: Session = Depends(get_db)):
-    return crud.get_all_files(db)
+async def list_files(request: Request, db: Session = Depends(get_db)):
+    """Список файлов из каталога в памяти; ETag — версия каталога"""
+    body, cursor = catalog.body(db)
+    headers = {"ETag": f'"{cursor}"', "Cache-Control": "no-cache"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/files/changes")
+async def file_changes(
+    since: str = Query(None, description="Курсор из предыдущего ответа (или ETag списка без кавычек)"),
+    timeout: float = Query(0, ge=0, le=60, description="Сколько секунд ждать изменений, если их ещё нет (long-poll)"),
+    db: Session = Depends(get_db)
+):
+    """Изменения каталога после курсора: upsert и delete по именам файлов.
+    Без курсора или при устаревшем курсоре возвращается полный список с reset=true"""
+    catalog.refresh(db)
+    if since and timeout:
+        await catalog.wait(db, since, timeout)
+    return catalog.changes_since(since)
+
+@router.get("/files/search")
+async def search_files(
+    q: str = Query(None, description="Слова для поиска в названии и описании"),
+    prefix: str = Query(None, description="Начало имени файла"),
+    filetype: str = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db)
+):
+    """Поиск по каталогу с ранжированием и постраничной выдачей"""
+    if not search.terms(q or "") and not prefix and not filetype:
+        raise HTTPException(status_code=400, detail="Укажите q, prefix или filetype")
+    items, has_more = search.search_files(db, q, prefix, filetype, limit, offset)
+    return {"items": items, "limit": limit, "offset": offset, "has_more": has_more}
+
+@router.post("/files/derived")
+async def register_derived_file(derived: schemas.DerivedFileCreate, db: Session = Depends(get_db)):
+    """Регистрирует файл, уже записанный в storage другим сервисом, вместе с его происхождением"""
+    if not os.path.exists(os.path.join(get_storage_dir(), derived.filename)):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    if derived.title is None:
+        derived.title = derived.filename
+    try:
+        db_file = crud.create_derived_file(db, derived)
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Файл с таким именем уже существует")
+    catalog.upsert([as_entry(db_file)])
+    return db_file
+
+@router.get("/files/{filename}/lineage")
+async def file_lineage(filename: str, db: Session = Depends(get_db)):
+    return crud.get_file_lineage(db, filename)
+
+@router.get("/files/{filename}/jobs")
+async def file_jobs(filename: str, db: Session = Depends(get_db)):
+    """Состояние фоновых задач файла: контрольная сумма, статистика, миниатюра"""
+    if crud.get_file_metadata(db, filename) is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return [
+        {
+            "kind": job.kind,
+            "status": job.status,
+            "attempts": job.attempts,
+            "result": job.result,
+            "error": job.last_error,
+        }
+        for job in crud.get_file_jobs(db, filename)
+    ]
+
+@router.get("/files/{filename}/thumbnail")
+async def file_thumbnail(filename: str):
+    path = jobs.thumbnail_path(get_storage_dir(), filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Миниатюра не найдена")
+    return FileResponse(path, media_type="image/png")
+
+def check_selector(selector: schemas.FileSelector):
+    """Пакетная операция без условий затронула бы все файлы — такой запрос отклоняется"""
+    if not selector.filenames and selector.filetype is None and not selector.filename_prefix:
+        raise HTTPException(status_code=400, detail="Укажите filenames, filetype или filename_prefix")
+
+def remove_from_storage(filenames):
+    """Удаляет файлы из storage после ответа клиенту"""
+    storage_dir = get_storage_dir()
+    with tracing.span("storage.remove_batch", files=len(filenames)):
+        for filename in filenames:
+            for path in (os.path.join(storage_dir, filename), jobs.thumbnail_path(storage_dir, filename)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error("Не удалось удалить %s из storage: %s", path, e)
+
+@router.post("/files/batch/delete")
+async def delete_files(selector: schemas.FileSelector, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Удаляет метаданные всех подходящих файлов одной транзакцией;
+    файлы из storage удаляются в фоне после ответа"""
+    check_selector(selector)
+    deleted = crud.delete_files_metadata(db, selector)
+    catalog.delete(deleted)
+    background_tasks.add_task(remove_from_storage, deleted)
+
+    response = {"deleted": len(deleted), "files": deleted, "storage_removal": "scheduled" if deleted else "none"}
+    if selector.filenames is not None:
+        response["not_found"] = sorted(set(selector.filenames) - set(deleted))
+    return response
+
+@router.post("/files/batch/update")
+async def update_files(batch: schemas.BatchUpdate, db: Session = Depends(get_db)):
+    """Меняет title и/или description всех подходящих файлов одной транзакцией.
+    Переданное значение null очищает поле, непереданное поле не меняется"""
+    check_selector(batch)
+    values = batch.model_dump(include={"title", "description"}, exclude_unset=True)
+    if not values:
+        raise HTTPException(status_code=400, detail="Укажите title или description")
+    updated = crud.update_files_metadata(db, batch, values)
+    catalog.update(updated, values)
+
+    response = {"updated": len(updated), "files": updated}
+    if batch.filenames is not None:
+        response["not_found"] = sorted(set(batch.filenames) - set(updated))
+    return response
 
 @router.delete("/files/{filename}")
 async def delete_file(filename: str, db: Session = Depends(get_db)):
     file_path = os.path.join(get_storage_dir(), filename)
     if os.path.exists(file_path):
-        os.remove(file_path)
+        with tracing.span("storage.remove"):
+            os.remove(file_path)
+    thumbnail = jobs.thumbnail_path(get_storage_dir(), filename)
+    if os.path.exists(thumbnail):
+        os.remove(thumbnail)
 
     deleted = crud.delete_file_metadata(db, filename)
     if not deleted:
         raise HTTPException(status_code=404, detail="Файл не найден в базе данных")
+    catalog.delete([filename])
 
     return {"detail": f"Файл {filename} удалён полностью"}
  
\ No newline at end of file
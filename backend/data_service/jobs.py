@@ -0,0 +1,290 @@
+"""Очередь фоновых задач обработки файлов после загрузки.
+
+Задачи хранятся в таблице file_jobs и ставятся в очередь в той же транзакции,
+что и метаданные файла, поэтому загрузка отвечает сразу, а обработка
+не теряется при перезапуске. Обработчик (worker.py) забирает готовые задачи
+через SELECT ... FOR UPDATE SKIP LOCKED в PostgreSQL; в SQLite, где такой
+блокировки нет, захват защищён условием status в UPDATE.
+
+Неудачная задача повторяется с экспоненциальной задержкой до max_attempts
+раз, затем получает статус failed. Задача, захваченная упавшим обработчиком,
+снова становится доступной через JOB_LEASE_SECONDS.
+
+Сумма SHA-256 файлов, загруженных через /upload, считается при записи;
+задача checksum ставится для производных и дописанных файлов.
+
+Статусы: queued, running, done, failed. Состояние видно в FileMetadata.jobs
+и через GET /files/{filename}/jobs.
+
+Настройка обработчика переменными окружения:
+
+    JOB_WORKER_CONCURRENCY — одновременных задач в процессе (по умолчанию 2)
+    JOB_POLL_SECONDS       — период опроса очереди (по умолчанию 1)
+    JOB_LEASE_SECONDS      — через сколько секунд захват считается потерянным (по умолчанию 300)
+    JOB_MAX_ATTEMPTS       — попыток на задачу (по умолчанию 5)
+    JOB_BACKOFF_SECONDS    — задержка перед первым повтором, удваивается (по умолчанию 5)
+    JOB_BACKOFF_MAX_SECONDS — предел задержки (по умолчанию 600)
+"""
+import os
+import random
+import signal
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import delete, insert, select, update
+
+import integrity
+import models
+from common import csvio, tracing
+
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_DIR = ".thumbnails"
+
+
+def _env(name, default, cast=float):
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+
+def checksum(file_path, filename):
+    """Сумма файлов, записанных не через /upload (производные, дописанные)"""
+    sha256, size = integrity.sha256_file(file_path)
+    return {"sha256": sha256, "size": size}
+
+
+def store_checksum(db, filename, result):
+    # Если файл успели дописать ещё раз, размер в метаданных уже другой, и сумма не записывается
+    c = models.FileMetadata
+    db.execute(
+        update(c).where(c.filename == filename, (c.size == result["size"]) | c.size.is_(None))
+        .values(sha256=result["sha256"], size=result["size"])
+    )
+
+
+def csv_stats(file_path, filename):
+    """Число строк и столбцов CSV; строки считаются потоково"""
+    fmt = csvio.sniff(file_path, filename)
+    rows = 0
+    with csvio.open_text(file_path, fmt) as stream:
+        reader = csvio.reader(stream, fmt)
+        header = next(reader, None) or []
+        for row in reader:
+            if row:
+                rows += 1
+    return {"size": os.path.getsize(file_path), "rows": rows, "columns": len(header), "encoding": fmt.encoding, "delimiter": fmt.delimiter}
+
+
+def thumbnail_path(storage_dir, filename):
+    return os.path.join(storage_dir, THUMBNAIL_DIR, filename + ".png")
+
+
+def thumbnail(file_path, filename):
+    try:
+        from PIL import Image
+    except ImportError:
+        return {"skipped": "Pillow не установлен"}
+    target = thumbnail_path(os.path.dirname(file_path), filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(file_path) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        image.save(target, "PNG")
+    return {"thumbnail": os.path.basename(target)}
+
+
+class Task:
+    """run(путь, имя) возвращает результат задачи; on_done(db, имя, результат)
+    сохраняет его в метаданных в той же транзакции, что и статус done"""
+
+    def __init__(self, run, concurrency, on_done=None):
+        self.run = run
+        self.concurrency = concurrency
+        self.on_done = on_done
+
+
+# Тяжёлым задачам меньше параллелизма, чтобы не отнимать CPU у обработки запросов
+TASKS = {
+    "checksum": Task(checksum, concurrency=2, on_done=store_checksum),
+    "stats": Task(csv_stats, concurrency=1),
+    "thumbnail": Task(thumbnail, concurrency=1),
+}
+
+FILETYPE_TASKS = {
+    "csv": ("stats",),
+    "photo": ("thumbnail",),
+}
+
+
+def kinds_for(filetype, has_checksum):
+    """Сумма загруженного файла считается при записи; задача checksum нужна остальным"""
+    return (() if has_checksum else ("checksum",)) + FILETYPE_TASKS.get(filetype, ())
+
+
+def enqueue(db, files, now=None):
+    """Добавляет задачи для файлов в текущую транзакцию;
+    files — тройки (имя, тип, известна ли уже контрольная сумма)"""
+    now = time.time() if now is None else now
+    max_attempts = _env("JOB_MAX_ATTEMPTS", 5, int)
+    rows = [
+        {"filename": filename, "kind": kind, "status": "queued", "attempts": 0, "max_attempts": max_attempts, "run_after": now}
+        for filename, filetype, has_checksum in files
+        for kind in kinds_for(filetype, has_checksum)
+    ]
+    if rows:
+        db.execute(insert(models.FileJob), rows)
+
+
+def forget(db, filenames):
+    """Удаляет задачи удалённых файлов в текущей транзакции"""
+    if filenames:
+        db.execute(delete(models.FileJob).where(models.FileJob.filename.in_(filenames)))
+
+
+def backoff(attempts):
+    base = _env("JOB_BACKOFF_SECONDS", 5.0)
+    delay = min(base * 2 ** (attempts - 1), _env("JOB_BACKOFF_MAX_SECONDS", 600.0))
+    # Разброс, чтобы повторы задач, упавших одновременно, не совпадали
+    return delay * random.uniform(0.8, 1.0)
+
+
+def _ready(now):
+    c = models.FileJob
+    lease = _env("JOB_LEASE_SECONDS", 300.0)
+    return ((c.status == "queued") & (c.run_after <= now)) | ((c.status == "running") & (c.locked_at < now - lease))
+
+
+@tracing.traced("jobs.claim")
+def claim(db, worker_id, kind, limit, now=None):
+    """Захватывает до limit готовых задач вида kind; возвращает их строки"""
+    now = time.time() if now is None else now
+    c = models.FileJob
+    ids = db.execute(
+        select(c.id).where(c.kind == kind, _ready(now)).order_by(c.run_after, c.id).limit(limit)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not ids:
+        db.rollback()
+        return []
+    claimed = db.execute(
+        update(c).where(c.id.in_(ids), _ready(now))
+        .values(status="running", locked_by=worker_id, locked_at=now, attempts=c.attempts + 1)
+        .returning(c.id, c.filename, c.kind, c.attempts, c.max_attempts)
+    ).all()
+    db.commit()
+    return claimed
+
+
+def complete(db, job, worker_id, result):
+    c = models.FileJob
+    done = db.execute(
+        update(c).where(c.id == job.id, c.locked_by == worker_id)
+        .values(status="done", result=result, last_error=None, locked_by=None, locked_at=None)
+    )
+    on_done = TASKS[job.kind].on_done
+    # Задачу, захваченную другим обработчиком после истечения аренды, завершит он
+    if done.rowcount and on_done is not None:
+        on_done(db, job.filename, result)
+    db.commit()
+
+
+def fail(db, job, worker_id, error, now=None):
+    now = time.time() if now is None else now
+    c = models.FileJob
+    values = {"last_error": error, "locked_by": None, "locked_at": None}
+    if job.attempts >= job.max_attempts:
+        values["status"] = "failed"
+    else:
+        values.update(status="queued", run_after=now + backoff(job.attempts))
+    db.execute(update(c).where(c.id == job.id, c.locked_by == worker_id).values(**values))
+    db.commit()
+
+
+class Worker:
+    """Забирает задачи из очереди и выполняет их в пуле потоков с ограничением
+    параллелизма по процессу и по виду задачи"""
+
+    def __init__(self, session_factory, storage_dir, concurrency=2, poll_seconds=1.0):
+        self.session_factory = session_factory
+        self.storage_dir = storage_dir
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._running = {kind: 0 for kind in TASKS}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls, session_factory):
+        return cls(
+            session_factory,
+            os.getenv("STORAGE_DIR", "storage"),
+            concurrency=_env("JOB_WORKER_CONCURRENCY", 2, int),
+            poll_seconds=_env("JOB_POLL_SECONDS", 1.0),
+        )
+
+    def _free_slots(self, kind):
+        with self._lock:
+            return min(TASKS[kind].concurrency - self._running[kind], self.concurrency - sum(self._running.values()))
+
+    def _claim(self):
+        """Захватывает задачи в пределах свободных слотов и помечает слоты занятыми"""
+        db = self.session_factory()
+        try:
+            claimed = []
+            for kind in TASKS:
+                free = self._free_slots(kind)
+                if free <= 0:
+                    continue
+                jobs = claim(db, self.worker_id, kind, free)
+                with self._lock:
+                    self._running[kind] += len(jobs)
+                claimed.extend(jobs)
+            return claimed
+        finally:
+            db.close()
+
+    @tracing.traced("jobs.run")
+    def execute(self, job):
+        db = self.session_factory()
+        try:
+            file_path = os.path.join(self.storage_dir, job.filename)
+            try:
+                result = TASKS[job.kind].run(file_path, job.filename)
+            except Exception as e:
+                fail(db, job, self.worker_id, f"{type(e).__name__}: {e}")
+            else:
+                complete(db, job, self.worker_id, result)
+        finally:
+            db.close()
+            with self._lock:
+                self._running[job.kind] -= 1
+
+    def run_once(self):
+        """Выполняет один набор задач синхронно; возвращает их число"""
+        jobs = self._claim()
+        for job in jobs:
+            self.execute(job)
+        return len(jobs)
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"Обработчик задач {self.worker_id} запущен")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while not self._stop.is_set():
+                try:
+                    jobs = self._claim()
+                except Exception as e:
+                    print(f"Не удалось получить задачи: {e}")
+                    jobs = []
+                for job in jobs:
+                    pool.submit(self.execute, job)
+                if not jobs:
+                    self._stop.wait(self.poll_seconds)
+            # Выход из with дожидается уже начатых задач
+        print(f"Обработчик задач {self.worker_id} остановлен")
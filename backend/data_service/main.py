@@ -1,24 +1,15 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware import Middleware
 from fastapi import Request
 from fastapi.responses import JSONResponse
 from intfile import router
-import models
-from database import engine
-from contextlib import asynccontextmanager
+from common import auth, metrics, profiling, ratelimit, tracing
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    try:
-        models.Base.metadata.create_all(bind=engine)
-        print("Database tables created successfully")
-    except Exception as e:
-        print(f"Error creating database tables: {e}")
-    yield
-    print("Application shutdown")
-
-app = FastAPI(title="Data Service", lifespan=lifespan)
+# Схему базы создают миграции (alembic upgrade head, см. common/migrations.py),
+# а не каждый под при старте
+# Токен проверяется локально, отзыв — пакетно через auth_service (см. common/auth.py)
+app = FastAPI(title="Data Service", dependencies=[Depends(auth.current_user)])
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,6 +28,11 @@ async def limit_upload_size(request: Request, call_next):
         return JSONResponse(content={"detail": "File too large"}, status_code=413)
     return await call_next(request)
 
+ratelimit.install(app, expensive_routes=(r"/upload", r"/download/", r"/files/[^/]+/append$", r"/files/batch/"))
+metrics.install(app)
+tracing.install(app, "data-service")
+profiling.install(app, "data-service", profile_paths=("/upload",))
+
 app.include_router(router, prefix="", tags=["data"])
 
 @app.get("/health")
@@ -0,0 +1,84 @@
+"""Метаданные файлов, происхождение, очередь задач и журнал событий
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from common.migrations import has_table
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Таблицы, уже созданные прежним create_all, пропускаются
+    bind = op.get_bind()
+    if not has_table(bind, "file_metadata"):
+        op.create_table(
+            "file_metadata",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("filename", sa.String()),
+            sa.Column("filetype", sa.String()),
+            sa.Column("title", sa.String(), nullable=True),
+            sa.Column("description", sa.Text(), nullable=True),
+        )
+        op.create_index("ix_file_metadata_id", "file_metadata", ["id"])
+        op.create_index("ix_file_metadata_filename", "file_metadata", ["filename"], unique=True)
+
+    if not has_table(bind, "file_lineage"):
+        op.create_table(
+            "file_lineage",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("filename", sa.String(), nullable=False),
+            sa.Column("source_filename", sa.String(), nullable=False),
+            sa.Column("operation", sa.JSON(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+        )
+        op.create_index("ix_file_lineage_id", "file_lineage", ["id"])
+        op.create_index("ix_file_lineage_filename", "file_lineage", ["filename"])
+        op.create_index("ix_file_lineage_source_filename", "file_lineage", ["source_filename"])
+
+    if not has_table(bind, "file_jobs"):
+        op.create_table(
+            "file_jobs",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("filename", sa.String(), nullable=False),
+            sa.Column("kind", sa.String(), nullable=False),
+            sa.Column("status", sa.String(), nullable=False),
+            sa.Column("attempts", sa.Integer(), nullable=False),
+            sa.Column("max_attempts", sa.Integer(), nullable=False),
+            sa.Column("run_after", sa.Float(), nullable=False),
+            sa.Column("locked_by", sa.String(), nullable=True),
+            sa.Column("locked_at", sa.Float(), nullable=True),
+            sa.Column("last_error", sa.Text(), nullable=True),
+            sa.Column("result", sa.JSON(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), server_default=sa.func.now()),
+            sa.Column("updated_at", sa.DateTime(), server_default=sa.func.now()),
+        )
+        op.create_index("ix_file_jobs_id", "file_jobs", ["id"])
+        op.create_index("ix_file_jobs_filename", "file_jobs", ["filename"])
+        op.create_index("ix_file_jobs_ready", "file_jobs", ["status", "kind", "run_after"])
+
+    if not has_table(bind, "event_outbox"):
+        op.create_table(
+            "event_outbox",
+            sa.Column("id", sa.BigInteger().with_variant(sa.Integer(), "sqlite"), primary_key=True, autoincrement=True),
+            sa.Column("type", sa.String(), nullable=False),
+            sa.Column("filename", sa.String(), nullable=False),
+            sa.Column("payload", sa.JSON(), nullable=True),
+            sa.Column("created_at", sa.Float(), nullable=False),
+        )
+        op.create_index("ix_event_outbox_filename", "event_outbox", ["filename"])
+        op.create_index("ix_event_outbox_created_at", "event_outbox", ["created_at"])
+
+
+def downgrade():
+    op.drop_table("event_outbox")
+    op.drop_table("file_jobs")
+    op.drop_table("file_lineage")
+    op.drop_table("file_metadata")
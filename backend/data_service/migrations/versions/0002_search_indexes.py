@@ -0,0 +1,60 @@
+"""Индексы поиска по каталогу (см. search.py)
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+# Выражение должно совпадать с search.PG_DOCUMENT, иначе планировщик не использует индекс
+PG_DOCUMENT = "to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(description, ''))"
+
+PG_UPGRADE = [
+    f"CREATE INDEX IF NOT EXISTS ix_file_metadata_fts ON file_metadata USING GIN ({PG_DOCUMENT})",
+    "CREATE INDEX IF NOT EXISTS ix_file_metadata_filename_prefix ON file_metadata (filename text_pattern_ops)",
+]
+PG_DOWNGRADE = [
+    "DROP INDEX IF EXISTS ix_file_metadata_filename_prefix",
+    "DROP INDEX IF EXISTS ix_file_metadata_fts",
+]
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS file_metadata_fts USING fts5("
+    "title, description, content='file_metadata', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS file_metadata_fts_ai AFTER INSERT ON file_metadata BEGIN "
+    "INSERT INTO file_metadata_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS file_metadata_fts_ad AFTER DELETE ON file_metadata BEGIN "
+    "INSERT INTO file_metadata_fts(file_metadata_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS file_metadata_fts_au AFTER UPDATE ON file_metadata BEGIN "
+    "INSERT INTO file_metadata_fts(file_metadata_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO file_metadata_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    # Наполняет индекс строками, которые были в таблице до миграции
+    "INSERT INTO file_metadata_fts(file_metadata_fts) VALUES ('rebuild')",
+]
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS file_metadata_fts_au",
+    "DROP TRIGGER IF EXISTS file_metadata_fts_ad",
+    "DROP TRIGGER IF EXISTS file_metadata_fts_ai",
+    "DROP TABLE IF EXISTS file_metadata_fts",
+]
+
+
+def _execute(statements):
+    dialect = op.get_bind().dialect.name
+    for statement in statements.get(dialect, ()):
+        op.execute(statement)
+
+
+def upgrade():
+    _execute({"postgresql": PG_UPGRADE, "sqlite": SQLITE_UPGRADE})
+
+
+def downgrade():
+    _execute({"postgresql": PG_DOWNGRADE, "sqlite": SQLITE_DOWNGRADE})
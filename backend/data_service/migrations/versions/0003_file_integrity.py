@@ -0,0 +1,35 @@
+"""Контрольная сумма, размер и результат проверки целостности файла (см. integrity.py)
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from common.migrations import has_column
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+COLUMNS = {
+    "sha256": lambda: sa.String(64),
+    "size": sa.BigInteger,
+    "verified_at": sa.DateTime,
+    "integrity_error": sa.Text,
+}
+
+
+def upgrade():
+    # Столбцы могли уже добавиться при старте сервиса до перехода на миграции
+    bind = op.get_bind()
+    for name, column_type in COLUMNS.items():
+        if not has_column(bind, "file_metadata", name):
+            op.add_column("file_metadata", sa.Column(name, column_type(), nullable=True))
+
+
+def downgrade():
+    for name in reversed(COLUMNS):
+        op.drop_column("file_metadata", name)
@@ -0,0 +1,30 @@
+"""Корзины ограничителя частоты запросов всех сервисов (см. common/ratelimit.py)
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from common.migrations import has_table
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Таблицу мог уже создать ограничитель частоты при старте сервиса до этой миграции
+    if not has_table(op.get_bind(), "rate_limit_buckets"):
+        op.create_table(
+            "rate_limit_buckets",
+            sa.Column("key", sa.String(), primary_key=True),
+            sa.Column("tokens", sa.Float(), nullable=False),
+            sa.Column("updated_at", sa.Float(), nullable=False),
+        )
+
+
+def downgrade():
+    op.drop_table("rate_limit_buckets")
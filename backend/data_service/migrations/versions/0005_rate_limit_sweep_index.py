@@ -0,0 +1,20 @@
+"""Индекс для удаления пополнившихся корзин ограничителя частоты (см. common/ratelimit.py)
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_rate_limit_buckets_updated_at", "rate_limit_buckets", ["updated_at"])
+
+
+def downgrade():
+    op.drop_index("ix_rate_limit_buckets_updated_at", table_name="rate_limit_buckets")
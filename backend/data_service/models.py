@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, JSON
+from sqlalchemy import BigInteger, Column, Integer, String, Text, JSON, DateTime, Float, Index, func
+from sqlalchemy.orm import relationship
 from database import Base
+from common import events, ratelimit
 
 class FileMetadata(Base):
     __tablename__ = "file_metadata"
@@ -8,4 +10,48 @@ class FileMetadata(Base):
     filetype = Column(String)
     title = Column(String, nullable=True)
     description = Column(Text, nullable=True)
+    # SHA-256 и размер, посчитанные при записи файла (см. integrity.py)
+    sha256 = Column(String(64), nullable=True)
+    size = Column(BigInteger, nullable=True)
+    verified_at = Column(DateTime, nullable=True)
+    integrity_error = Column(Text, nullable=True)
+    # Задачи после загрузки связаны по имени файла: они переживают пересоздание записи
+    jobs = relationship(
+        "FileJob", primaryjoin="FileMetadata.filename == foreign(FileJob.filename)",
+        viewonly=True, order_by="FileJob.id",
+    )
 
+class FileLineage(Base):
+    """Происхождение производного файла: исходный файл и параметры выгрузки"""
+    __tablename__ = "file_lineage"
+    id = Column(Integer, primary_key=True, index=True)
+    filename = Column(String, index=True, nullable=False)
+    source_filename = Column(String, index=True, nullable=False)
+    operation = Column(JSON, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+
+class FileJob(Base):
+    """Фоновая задача обработки загруженного файла (см. jobs.py)"""
+    __tablename__ = "file_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    filename = Column(String, index=True, nullable=False)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_after = Column(Float, nullable=False)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(Float, nullable=True)
+    last_error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (Index("ix_file_jobs_ready", "status", "kind", "run_after"),)
+
+# Журнал событий жизненного цикла файлов (см. common/events.py) входит в схему data_service
+OutboxEvent = events.outbox_table.to_metadata(Base.metadata)
+
+# Корзины ограничителя частоты (см. common/ratelimit.py) в общей базе: все сервисы
+# пишут в одну таблицу, а схему ведут миграции data_service
+RateLimitBucket = ratelimit.buckets_table.to_metadata(Base.metadata)
@@ -1,8 +1,24 @@
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 class FileMetadataCreate(BaseModel):
     filename: str
     filetype: str
     title: Optional[str] = None
-    description: Optional[str] = None
\ No newline at end of file
+    description: Optional[str] = None
+    sha256: Optional[str] = None
+    size: Optional[int] = None
+
+class DerivedFileCreate(FileMetadataCreate):
+    source_filename: str
+    operation: Optional[Dict[str, Any]] = None
+
+class FileSelector(BaseModel):
+    """Набор файлов для пакетной операции: список имён и/или фильтр"""
+    filenames: Optional[List[str]] = None
+    filetype: Optional[str] = None
+    filename_prefix: Optional[str] = None
+
+class BatchUpdate(FileSelector):
+    title: Optional[str] = None
+    description: Optional[str] = None
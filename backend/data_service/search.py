@@ -0,0 +1,123 @@
+"""Поиск по каталогу файлов: полнотекстовый по title/description и по префиксу имени.
+
+В PostgreSQL используется функциональный GIN-индекс по to_tsvector, в SQLite —
+таблица FTS5 с внешним содержимым, которую синхронизируют триггеры. Индексы
+создаёт миграция 0002_search_indexes; при create_all (в тестах) — функция
+create_index вместе с таблицей file_metadata.
+
+Слова запроса ищутся все сразу (AND), каждое — как префикс слова документа,
+поэтому «отч прод» находит «Отчёт о продажах».
+"""
+import re
+
+from sqlalchemy import DDL, column, event, func, literal, literal_column, select, table
+from sqlalchemy.orm import Session
+
+import models
+from common import tracing
+
+TS_CONFIG = "simple"
+# Выражение должно совпадать с выражением индекса, иначе планировщик его не использует
+PG_DOCUMENT = f"to_tsvector('{TS_CONFIG}', coalesce(title, '') || ' ' || coalesce(description, ''))"
+
+PG_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_file_metadata_fts ON file_metadata USING GIN ({PG_DOCUMENT})",
+    # Индекс по имени с text_pattern_ops нужен для LIKE 'префикс%' при любой collation
+    "CREATE INDEX IF NOT EXISTS ix_file_metadata_filename_prefix ON file_metadata (filename text_pattern_ops)",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS file_metadata_fts USING fts5("
+    "title, description, content='file_metadata', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS file_metadata_fts_ai AFTER INSERT ON file_metadata BEGIN "
+    "INSERT INTO file_metadata_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS file_metadata_fts_ad AFTER DELETE ON file_metadata BEGIN "
+    "INSERT INTO file_metadata_fts(file_metadata_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS file_metadata_fts_au AFTER UPDATE ON file_metadata BEGIN "
+    "INSERT INTO file_metadata_fts(file_metadata_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO file_metadata_fts(rowid, title, description) VALUES (new.id, new.title, new.description); END",
+]
+
+fts_table = table("file_metadata_fts", column("rowid"), column("rank"), column("file_metadata_fts"))
+
+
+def create_index(connection):
+    """Создаёт поисковые индексы, если их ещё нет; DDL повторяет миграцию 0002_search_indexes"""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        for statement in PG_DDL:
+            connection.exec_driver_sql(statement)
+    elif dialect == "sqlite":
+        for statement in SQLITE_DDL:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql("INSERT INTO file_metadata_fts(file_metadata_fts) VALUES ('rebuild')")
+
+
+event.listen(models.FileMetadata.__table__, "after_create", lambda target, connection, **kw: create_index(connection))
+event.listen(
+    models.FileMetadata.__table__, "before_drop",
+    DDL("DROP TABLE IF EXISTS file_metadata_fts").execute_if(dialect="sqlite"),
+)
+
+
+def terms(query):
+    return re.findall(r"\w+", query.lower())
+
+
+def _fulltext(statement, dialect, words):
+    """Добавляет условие полнотекстового поиска и выражение релевантности (больше — лучше)"""
+    if dialect == "postgresql":
+        document = literal_column(PG_DOCUMENT)
+        tsquery = func.to_tsquery(literal_column(f"'{TS_CONFIG}'"), " & ".join(f"{word}:*" for word in words))
+        return statement.where(document.op("@@")(tsquery)), func.ts_rank(document, tsquery)
+    if dialect == "sqlite":
+        match = " ".join(f'"{word}"*' for word in words)
+        statement = statement.join(fts_table, fts_table.c.rowid == models.FileMetadata.id)
+        # rank в FTS5 — bm25, у которого меньшее значение означает лучшее совпадение
+        return statement.where(fts_table.c.file_metadata_fts.op("MATCH")(match)), -fts_table.c.rank
+    # Прочие СУБД: без индекса, подстроки в любом из полей
+    for word in words:
+        pattern = f"%{word}%"
+        statement = statement.where(
+            func.lower(models.FileMetadata.title).like(pattern) | func.lower(models.FileMetadata.description).like(pattern)
+        )
+    return statement, None
+
+
+@tracing.traced("crud.search_files")
+def search_files(db: Session, query=None, prefix=None, filetype=None, limit=20, offset=0):
+    """Страница результатов поиска, упорядоченная по релевантности, затем по имени;
+    возвращает (файлы с полем rank, есть ли следующая страница)"""
+    columns = models.FileMetadata
+    statement = select(columns)
+    rank = None
+    words = terms(query or "")
+    if words:
+        statement, rank = _fulltext(statement, db.get_bind().dialect.name, words)
+    if prefix:
+        # Шаблон собирается целиком на клиенте: с константным шаблоном PostgreSQL использует индекс
+        pattern = re.sub(r"([\\%_])", r"\\\1", prefix) + "%"
+        statement = statement.where(columns.filename.like(pattern, escape="\\"))
+    if filetype:
+        statement = statement.where(columns.filetype == filetype)
+
+    if rank is None:
+        statement = statement.add_columns(literal(0.0).label("rank")).order_by(columns.filename)
+    else:
+        statement = statement.add_columns(rank.label("rank")).order_by(rank.desc(), columns.filename)
+    # Лишняя строка показывает, есть ли следующая страница, без отдельного COUNT
+    rows = db.execute(statement.limit(limit + 1).offset(offset)).all()
+    items = [
+        {
+            "id": file.id,
+            "filename": file.filename,
+            "filetype": file.filetype,
+            "title": file.title,
+            "description": file.description,
+            "rank": round(float(rank_value), 6),
+        }
+        for file, rank_value in rows[:limit]
+    ]
+    return items, len(rows) > limit
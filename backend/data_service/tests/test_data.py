@@ -5,7 +5,8 @@ import shutil
 import sys
 from pathlib import Path
 
-# Добавляем родительский каталог в путь для импорта
+# Добавляем каталог сервиса и backend (общий пакет common) в путь для импорта
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from fastapi.testclient import TestClient
@@ -13,6 +14,14 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from unittest.mock import patch, mock_open
 import json
+import base64
+import gzip
+import hashlib
+import io
+import tarfile
+import zipfile
+import threading
+import time
 
 from main import app
 from database import Base
@@ -28,10 +37,6 @@ TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engin
 import database
 database.engine = engine
 
-# Переопределяем engine в main тоже
-import main
-main.engine = engine
-
 # Переопределяем engine в intfile тоже
 import intfile
 intfile.engine = engine
@@ -52,6 +57,7 @@ app.dependency_overrides[get_db] = override_get_db
 @pytest.fixture(scope="function")
 def setup_database():
     Base.metadata.create_all(bind=engine)
+    intfile.catalog.reset()
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -145,6 +151,35 @@ class TestFileUpload:
         assert result["title"] == "auto_name.csv"
         assert result["description"] == "Auto named file"
 
+    def test_upload_existing_name_conflicts(self, client, setup_database, temp_storage, sample_csv_content):
+        """Повторная загрузка под тем же именем — 409; прежний файл и его контрольная сумма не меняются"""
+        client.post("/upload", files={"file": ("dup.csv", sample_csv_content, "text/csv")})
+
+        response = client.post("/upload", files={"file": ("dup.csv", "a,b\n1,2\n", "text/csv")})
+        assert response.status_code == 409
+        with open(os.path.join(temp_storage, "dup.csv")) as f:
+            assert f.read() == sample_csv_content
+        assert os.listdir(temp_storage) == ["dup.csv"]
+        assert client.get("/download/dup.csv").status_code == 200
+
+    def test_upload_does_not_replace_concurrent_file(self, client, setup_database, temp_storage, sample_csv_content):
+        """Файл, записанный параллельной загрузкой после проверки имени, не заменяется и не удаляется"""
+        with open(os.path.join(temp_storage, "race.csv"), "w") as f:
+            f.write("winner\n")
+
+        response = client.post("/upload", files={"file": ("race.csv", sample_csv_content, "text/csv")})
+        assert response.status_code == 409
+        with open(os.path.join(temp_storage, "race.csv")) as f:
+            assert f.read() == "winner\n"
+        assert os.listdir(temp_storage) == ["race.csv"]
+
+    def test_interrupted_upload_leaves_no_part_file(self, client, setup_database, temp_storage):
+        """Если чтение тела прервалось, временный файл удаляется"""
+        with patch("starlette.datastructures.UploadFile.read", side_effect=OSError("соединение разорвано")):
+            with pytest.raises(OSError):
+                client.post("/upload", files={"file": ("cut.csv", "a,b\n1,2\n", "text/csv")})
+        assert os.listdir(temp_storage) == []
+
 class TestFileDownload:
     """Тесты скачивания файлов"""
     
@@ -175,6 +210,23 @@ class TestFileDownload:
         response = client.get(f"/download/{filename}")
         assert response.status_code == 200
 
+    def test_signed_download_link(self, client, setup_database, temp_storage, sample_csv_content):
+        """При AUTH_REQUIRED файл без токена скачивается только по неистёкшей подписанной ссылке"""
+        files = {"file": ("signed link.csv", sample_csv_content, "text/csv")}
+        filename = client.post("/upload", files=files).json()["filename"]
+        link = client.get(f"/files/{filename}/download-link").json()
+
+        with patch.dict(os.environ, {"AUTH_REQUIRED": "true"}):
+            assert client.get(f"/download/{filename}").status_code == 401
+            response = client.get(f"/{link['url']}")
+            assert response.status_code == 200
+            assert response.content.decode() == sample_csv_content
+            forged = f"/download/other.csv?expires={link['expires']}&signature={link['signature']}"
+            assert client.get(forged).status_code == 401
+            assert client.get(f"/files/{filename}/download-link").status_code == 401
+            with patch("time.time", return_value=link["expires"] + 1):
+                assert client.get(f"/{link['url']}").status_code == 401
+
 class TestFileListing:
     """Тесты получения списка файлов"""
     
@@ -257,6 +309,655 @@ class TestFileDeletion:
         
         assert not os.path.exists(file_path)
 
+class TestBatchOperations:
+    """Тесты пакетного удаления и изменения метаданных"""
+
+    def upload(self, client, names, content):
+        client.post("/upload/bulk", files=[("files", (name, content, "text/csv")) for name in names])
+
+    def test_batch_delete_by_names(self, client, setup_database, temp_storage, sample_csv_content):
+        """Удаляются только перечисленные файлы; отсутствующие имена попадают в not_found"""
+        self.upload(client, ["a.csv", "b.csv", "c.csv"], sample_csv_content)
+
+        response = client.post("/files/batch/delete", json={"filenames": ["a.csv", "b.csv", "missing.csv"]})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["deleted"] == 2
+        assert sorted(data["files"]) == ["a.csv", "b.csv"]
+        assert data["not_found"] == ["missing.csv"]
+        assert data["storage_removal"] == "scheduled"
+
+        assert [f["filename"] for f in client.get("/files").json()] == ["c.csv"]
+        assert os.listdir(temp_storage) == ["c.csv"]
+
+    def test_batch_delete_by_filter(self, client, setup_database, temp_storage, sample_csv_content, sample_image_content):
+        """Фильтр по префиксу и типу; символы LIKE в префиксе не являются шаблоном"""
+        self.upload(client, ["tmp_1.csv", "tmp_2.csv", "tmpx.csv"], sample_csv_content)
+        client.post("/upload", files={"file": ("tmp_3.jpg", sample_image_content, "image/jpeg")})
+
+        response = client.post("/files/batch/delete", json={"filename_prefix": "tmp_", "filetype": "csv"})
+        assert response.json()["deleted"] == 2
+        assert sorted(f["filename"] for f in client.get("/files").json()) == ["tmp_3.jpg", "tmpx.csv"]
+
+    def test_batch_delete_requires_selector(self, client, setup_database, temp_storage, sample_csv_content):
+        """Запрос без условий не удаляет все файлы"""
+        self.upload(client, ["a.csv"], sample_csv_content)
+        assert client.post("/files/batch/delete", json={}).status_code == 400
+        assert client.post("/files/batch/delete", json={"filenames": []}).status_code == 400
+        assert len(client.get("/files").json()) == 1
+
+    def test_batch_update(self, client, setup_database, temp_storage, sample_csv_content):
+        """Меняются только переданные поля подходящих файлов"""
+        self.upload(client, ["a.csv", "b.csv", "c.csv"], sample_csv_content)
+        client.post("/files/batch/update", json={"filenames": ["a.csv", "b.csv", "c.csv"], "description": "старое"})
+
+        response = client.post("/files/batch/update", json={"filenames": ["a.csv", "b.csv"], "title": "Отчёт"})
+        assert response.status_code == 200
+        assert response.json()["updated"] == 2
+
+        files = {f["filename"]: f for f in client.get("/files").json()}
+        assert files["a.csv"]["title"] == "Отчёт"
+        assert files["a.csv"]["description"] == "старое"
+        assert files["c.csv"]["title"] == "c.csv"
+
+        response = client.post("/files/batch/update", json={"filenames": ["a.csv"]})
+        assert response.status_code == 400
+
+class TestFileSearch:
+    """Тесты поиска по каталогу"""
+
+    def upload(self, client, filename, title, description, content):
+        client.post("/upload", files={"file": (filename, content, "text/csv")}, data={"title": title, "description": description})
+
+    def test_fulltext_search_ranked(self, client, setup_database, temp_storage, sample_csv_content):
+        """Все слова запроса ищутся как префиксы; более релевантные файлы идут первыми"""
+        self.upload(client, "sales.csv", "Отчёт о продажах", "Продажи по регионам, продажи по месяцам", sample_csv_content)
+        self.upload(client, "costs.csv", "Отчёт о затратах", "Затраты на продажи", sample_csv_content)
+        self.upload(client, "weather.csv", "Погода", "Температура", sample_csv_content)
+
+        response = client.get("/files/search", params={"q": "отч продаж"})
+        assert response.status_code == 200
+        names = [item["filename"] for item in response.json()["items"]]
+        assert names == ["sales.csv", "costs.csv"]
+
+        response = client.get("/files/search", params={"q": "температура"})
+        assert [item["filename"] for item in response.json()["items"]] == ["weather.csv"]
+
+    def test_search_index_follows_updates_and_deletes(self, client, setup_database, temp_storage, sample_csv_content):
+        """Изменения метаданных и удаление сразу видны в поиске"""
+        self.upload(client, "a.csv", "Черновик", "", sample_csv_content)
+        client.post("/files/batch/update", json={"filenames": ["a.csv"], "title": "Итоги года"})
+
+        assert client.get("/files/search", params={"q": "черновик"}).json()["items"] == []
+        assert len(client.get("/files/search", params={"q": "итоги"}).json()["items"]) == 1
+
+        client.delete("/files/a.csv")
+        assert client.get("/files/search", params={"q": "итоги"}).json()["items"] == []
+
+    def test_prefix_search_and_pagination(self, client, setup_database, temp_storage, sample_csv_content):
+        """Поиск по началу имени с постраничной выдачей по имени"""
+        client.post("/upload/bulk", files=[("files", (f"run_{i}.csv", sample_csv_content, "text/csv")) for i in range(5)])
+        client.post("/upload", files={"file": ("runs.csv", sample_csv_content, "text/csv")})
+
+        first = client.get("/files/search", params={"prefix": "run_", "limit": 3}).json()
+        assert [item["filename"] for item in first["items"]] == ["run_0.csv", "run_1.csv", "run_2.csv"]
+        assert first["has_more"] is True
+
+        second = client.get("/files/search", params={"prefix": "run_", "limit": 3, "offset": 3}).json()
+        assert [item["filename"] for item in second["items"]] == ["run_3.csv", "run_4.csv"]
+        assert second["has_more"] is False
+
+    def test_search_requires_criteria(self, client, setup_database):
+        """Пустой запрос не выгружает весь каталог"""
+        assert client.get("/files/search").status_code == 400
+        assert client.get("/files/search", params={"q": "  ;; "}).status_code == 400
+
+class TestFileCatalog:
+    """Тесты каталога в памяти: ETag у /files и журнал изменений"""
+
+    def test_etag_and_not_modified(self, client, setup_database, temp_storage, sample_csv_content):
+        """Повтор с тем же ETag получает 304, после загрузки — новый список"""
+        first = client.get("/files")
+        etag = first.headers["etag"]
+        assert first.json() == []
+
+        response = client.get("/files", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        response = client.get("/files", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert [f["filename"] for f in response.json()] == ["a.csv"]
+
+    def test_changes_since_cursor(self, client, setup_database, temp_storage, sample_csv_content):
+        """Клиент получает только изменения после своего курсора"""
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        initial = client.get("/files/changes").json()
+        assert initial["reset"] is True
+        assert [f["filename"] for f in initial["files"]] == ["a.csv"]
+
+        client.post("/upload", files={"file": ("b.csv", sample_csv_content, "text/csv")})
+        client.post("/files/batch/update", json={"filenames": ["b.csv"], "title": "Б"})
+        client.delete("/files/a.csv")
+
+        data = client.get("/files/changes", params={"since": initial["cursor"]}).json()
+        assert data["reset"] is False
+        assert [(c["op"], c["filename"]) for c in data["changes"]] == [("upsert", "b.csv"), ("upsert", "b.csv"), ("delete", "a.csv")]
+        assert data["changes"][1]["file"]["title"] == "Б"
+
+        assert client.get("/files/changes", params={"since": data["cursor"]}).json()["changes"] == []
+        assert client.get("/files/changes", params={"since": "other.1"}).json()["reset"] is True
+
+    def test_long_poll_wakes_on_change(self, client, setup_database, temp_storage, sample_csv_content):
+        """Ожидающий запрос возвращается сразу после изменения, не дожидаясь таймаута"""
+        cursor = client.get("/files/changes").json()["cursor"]
+
+        def upload_later():
+            time.sleep(0.3)
+            client.post("/upload", files={"file": ("late.csv", sample_csv_content, "text/csv")})
+
+        uploader = threading.Thread(target=upload_later)
+        uploader.start()
+        started = time.perf_counter()
+        data = client.get("/files/changes", params={"since": cursor, "timeout": 10}).json()
+        uploader.join()
+
+        assert time.perf_counter() - started < 5
+        assert [c["filename"] for c in data["changes"]] == ["late.csv"]
+
+    def test_refresh_picks_up_external_changes(self, client, setup_database, temp_storage):
+        """Записи, добавленные в базу мимо этого процесса, появляются после перечитывания"""
+        cursor = client.get("/files/changes").json()["cursor"]
+        db = TestingSessionLocal()
+        try:
+            crud.create_file_metadata(db, schemas.FileMetadataCreate(filename="ext.csv", filetype="csv", title="ext.csv"))
+        finally:
+            db.close()
+        assert client.get("/files").json() == []
+
+        with patch.object(intfile.catalog, "refresh_seconds", 0.01):
+            time.sleep(0.02)
+            assert [f["filename"] for f in client.get("/files").json()] == ["ext.csv"]
+        changes = client.get("/files/changes", params={"since": cursor}).json()["changes"]
+        assert [(c["op"], c["filename"]) for c in changes] == [("upsert", "ext.csv")]
+
+    def test_files_include_integrity_fields(self, client, setup_database, temp_storage, sample_csv_content):
+        """/files отдаёт результаты проверки целостности; дата — в ISO 8601"""
+        from datetime import datetime
+        from sqlalchemy import update
+        client.post("/upload", files={"file": ("checked.csv", sample_csv_content, "text/csv")})
+        entry = client.get("/files").json()[0]
+        assert entry["verified_at"] is None and entry["integrity_error"] is None
+
+        db = TestingSessionLocal()
+        try:
+            db.execute(update(FileMetadata).values(verified_at=datetime(2026, 10, 19, 12, 30), integrity_error="файл отсутствует в хранилище"))
+            db.commit()
+        finally:
+            db.close()
+        with patch.object(intfile.catalog, "refresh_seconds", 0.01):
+            time.sleep(0.02)
+            entry = client.get("/files").json()[0]
+        assert entry["verified_at"] == "2026-10-19T12:30:00"
+        assert entry["integrity_error"] == "файл отсутствует в хранилище"
+
+    def test_workers_share_cursors(self, setup_database, temp_storage):
+        """Рабочие процессы пода с общим журналом выдают одни курсоры и понимают курсоры друг друга"""
+        from catalog import Catalog, as_entry
+
+        def add(name):
+            db_file = crud.create_file_metadata(db, schemas.FileMetadataCreate(filename=name, filetype="csv", title=name))
+            return as_entry(db_file)
+
+        with patch.dict(os.environ, {"SHARED_STATE_DIR": temp_storage}):
+            first, second = Catalog(refresh_seconds=0, max_changes=3), Catalog(refresh_seconds=0, max_changes=3)
+        db = TestingSessionLocal()
+        try:
+            assert first.body(db)[1] == second.body(db)[1]
+            cursor = first.cursor
+
+            first.upsert([add("a.csv")])
+            body, etag = second.body(db)
+            assert etag == first.cursor != cursor
+            assert [f["filename"] for f in json.loads(body)] == ["a.csv"]
+
+            db.query(FileMetadata).filter_by(filename="a.csv").update({"title": "А"})
+            db.commit()
+            second.update(["a.csv"], {"title": "А"})
+            data = first.changes_since(cursor)
+            assert data["reset"] is False
+            assert [(c["op"], c["file"]["title"]) for c in data["changes"]] == [("upsert", "a.csv"), ("upsert", "А")]
+            assert second.changes_since(cursor) == data
+
+            # Журнал хранит только последние изменения: процесс, отставший сильнее, перечитывает базу
+            for name in ("b.csv", "c.csv", "d.csv", "e.csv"):
+                first.upsert([add(name)])
+            with patch.dict(os.environ, {"SHARED_STATE_DIR": temp_storage}):
+                third = Catalog(refresh_seconds=0, max_changes=3)
+            etag = second.body(db)[1]
+            assert third.body(db)[1] == first.body(db)[1] == etag
+            assert len(json.loads(third.body(db)[0])) == len(json.loads(second.body(db)[0])) == 5
+            assert second.changes_since(cursor)["reset"] is True
+        finally:
+            db.close()
+
+class TestFileEvents:
+    """Тесты журнала событий (outbox)"""
+
+    def outbox(self):
+        from common import events
+        from sqlalchemy import select
+        with engine.connect() as conn:
+            rows = conn.execute(select(events.outbox_table).order_by(events.outbox_table.c.id)).all()
+        return [(row.type, row.filename) for row in rows]
+
+    def test_events_written_with_metadata(self, client, setup_database, temp_storage, sample_csv_content):
+        """Загрузка и удаление записывают file.uploaded и file.deleted"""
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        client.post("/upload/bulk", files=[("files", (name, sample_csv_content, "text/csv")) for name in ("b.csv", "c.csv")])
+        client.delete("/files/a.csv")
+        client.post("/files/batch/delete", json={"filenames": ["b.csv", "c.csv"]})
+
+        assert self.outbox() == [
+            ("file.uploaded", "a.csv"), ("file.uploaded", "b.csv"), ("file.uploaded", "c.csv"),
+            ("file.deleted", "a.csv"), ("file.deleted", "b.csv"), ("file.deleted", "c.csv"),
+        ]
+
+    def test_no_event_for_rejected_upload(self, client, setup_database, temp_storage):
+        """Отклонённый файл не попадает в журнал"""
+        client.post("/upload", files={"file": ("empty.csv", "", "text/csv")})
+        assert self.outbox() == []
+
+class TestFileJobs:
+    """Тесты очереди фоновых задач после загрузки"""
+
+    def worker(self, temp_storage):
+        import jobs
+        return jobs.Worker(TestingSessionLocal, temp_storage)
+
+    def test_upload_enqueues_and_worker_completes(self, client, setup_database, temp_storage, sample_csv_content):
+        """Загрузка ставит задачи в очередь, обработчик выполняет их"""
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        queued = client.get("/files/a.csv/jobs").json()
+        # Сумма загруженного файла уже посчитана при записи
+        assert [(job["kind"], job["status"]) for job in queued] == [("stats", "queued")]
+
+        assert self.worker(temp_storage).run_once() == 1
+        done = {job["kind"]: job for job in client.get("/files/a.csv/jobs").json()}
+        assert done["stats"]["status"] == "done"
+        assert done["stats"]["result"]["rows"] == 3
+        assert done["stats"]["result"]["columns"] == 3
+
+        db = TestingSessionLocal()
+        try:
+            assert [job.status for job in crud.get_file_metadata(db, "a.csv").jobs] == ["done"]
+        finally:
+            db.close()
+
+    def test_derived_file_gets_checksum_job(self, client, setup_database, temp_storage):
+        """Сумма производного файла считается задачей checksum и записывается в метаданные"""
+        with open(os.path.join(temp_storage, "derived.csv"), "w") as f:
+            f.write("a\n1\n")
+        client.post("/files/derived", json={"filename": "derived.csv", "filetype": "csv", "source_filename": "s.csv"})
+        assert [job["kind"] for job in client.get("/files/derived.csv/jobs").json()] == ["checksum", "stats"]
+
+        self.worker(temp_storage).run_once()
+        db = TestingSessionLocal()
+        try:
+            db_file = crud.get_file_metadata(db, "derived.csv")
+            assert db_file.sha256 == hashlib.sha256(b"a\n1\n").hexdigest()
+            assert db_file.size == 4
+        finally:
+            db.close()
+
+    def test_retry_with_backoff_then_failed(self, client, setup_database, temp_storage, sample_csv_content):
+        """Ошибка откладывает задачу, после последней попытки — failed"""
+        import jobs
+
+        def broken(file_path, filename):
+            raise ValueError("сломано")
+
+        worker = self.worker(temp_storage)
+        with patch.dict(jobs.TASKS, {"stats": jobs.Task(broken, concurrency=1)}), \
+             patch.dict(os.environ, {"JOB_MAX_ATTEMPTS": "2", "JOB_BACKOFF_SECONDS": "0"}):
+            client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+            worker.run_once()
+            stats = client.get("/files/a.csv/jobs").json()[0]
+            assert (stats["status"], stats["attempts"]) == ("queued", 1)
+            assert "сломано" in stats["error"]
+
+            worker.run_once()
+            stats = client.get("/files/a.csv/jobs").json()[0]
+            assert (stats["status"], stats["attempts"]) == ("failed", 2)
+
+    def test_concurrency_limit_per_kind(self, client, setup_database, temp_storage, sample_csv_content):
+        """За один проход берётся не больше задач, чем позволяют лимиты"""
+        client.post("/upload/bulk", files=[("files", (f"f{i}.csv", sample_csv_content, "text/csv")) for i in range(3)])
+        worker = self.worker(temp_storage)
+        worker.concurrency = 2
+        # stats допускает одну задачу за проход
+        assert [worker.run_once() for _ in range(4)] == [1, 1, 1, 0]
+
+    def test_delete_drops_jobs(self, client, setup_database, temp_storage, sample_csv_content):
+        """Задачи удалённого файла не выполняются"""
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        client.delete("/files/a.csv")
+        assert self.worker(temp_storage).run_once() == 0
+        assert client.get("/files/a.csv/jobs").status_code == 404
+
+class TestIntegrity:
+    """Тесты контрольных сумм при загрузке, отдаче и фоновой проверке"""
+
+    def test_upload_records_sha256(self, client, setup_database, temp_storage, sample_csv_content):
+        """Сумма и размер считаются при записи загрузки"""
+        response = client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        assert response.status_code == 200
+        expected = hashlib.sha256(sample_csv_content.encode()).hexdigest()
+        files = client.get("/files").json()
+        assert (files[0]["sha256"], files[0]["size"]) == (expected, len(sample_csv_content.encode()))
+        assert os.listdir(temp_storage) == ["a.csv"]
+
+    def test_download_digest_headers(self, client, setup_database, temp_storage, sample_csv_content):
+        """Отдача с ETag, Digest и Repr-Digest; совпавший If-None-Match — 304"""
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        digest = hashlib.sha256(sample_csv_content.encode())
+        encoded = base64.b64encode(digest.digest()).decode()
+
+        response = client.get("/download/a.csv")
+        assert response.status_code == 200
+        assert response.headers["etag"] == f'"{digest.hexdigest()}"'
+        assert response.headers["digest"] == f"sha-256={encoded}"
+        assert response.headers["repr-digest"] == f"sha-256=:{encoded}:"
+
+        response = client.get("/download/a.csv", headers={"If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+
+    def test_truncated_file_not_served(self, client, setup_database, temp_storage, sample_csv_content):
+        """Файл с другим размером не отдаётся"""
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        with open(os.path.join(temp_storage, "a.csv"), "r+b") as f:
+            f.truncate(5)
+        response = client.get("/download/a.csv")
+        assert response.status_code == 500
+        assert "повреждён" in response.json()["detail"]
+
+    def test_append_rehashed_by_job(self, client, setup_database, temp_storage, sample_csv_content):
+        """После дозаписи сумма сбрасывается и пересчитывается задачей checksum"""
+        import jobs
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        client.post("/files/a.csv/append", files={"file": ("part.csv", "Ann,40,Rome\n", "text/csv")})
+        assert client.get("/files").json()[0]["sha256"] is None
+        assert "digest" not in client.get("/download/a.csv").headers
+
+        worker = jobs.Worker(TestingSessionLocal, temp_storage)
+        while worker.run_once():
+            pass
+        with open(os.path.join(temp_storage, "a.csv"), "rb") as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        assert client.get("/download/a.csv").headers["etag"] == f'"{expected}"'
+
+    def test_scrubber_detects_corruption_and_backfills(self, client, setup_database, temp_storage, sample_csv_content):
+        """Проверка находит испорченный файл и досчитывает отсутствующую сумму"""
+        import integrity
+        client.post("/upload", files={"file": ("a.csv", sample_csv_content, "text/csv")})
+        client.post("/upload", files={"file": ("b.csv", sample_csv_content, "text/csv")})
+        with open(os.path.join(temp_storage, "a.csv"), "r+b") as f:
+            f.write(b"X")
+        db = TestingSessionLocal()
+        try:
+            db.query(FileMetadata).filter(FileMetadata.filename == "b.csv").update({"sha256": None, "size": None})
+            db.commit()
+        finally:
+            db.close()
+
+        assert integrity.Scrubber(TestingSessionLocal, temp_storage, bytes_per_second=0).run_pass() == 1
+
+        db = TestingSessionLocal()
+        try:
+            corrupted = crud.get_file_metadata(db, "a.csv")
+            assert "не совпадает" in corrupted.integrity_error
+            backfilled = crud.get_file_metadata(db, "b.csv")
+            assert backfilled.sha256 == hashlib.sha256(sample_csv_content.encode()).hexdigest()
+            assert backfilled.verified_at is not None
+        finally:
+            db.close()
+        assert client.get("/download/a.csv").status_code == 500
+
+class TestMigrations:
+    """Тесты миграций схемы"""
+
+    @pytest.fixture
+    def migration_db(self, tmp_path):
+        url = f"sqlite:///{tmp_path / 'migrated.db'}"
+        with patch.dict(os.environ, {"DATABASE_URL": url}):
+            yield create_engine(url)
+
+    def upgrade(self):
+        from common import migrations
+        migrations.upgrade(str(Path(__file__).parent.parent))
+
+    def test_upgrade_matches_models(self, migration_db):
+        """Схема после миграций совпадает с моделями"""
+        from alembic.autogenerate import compare_metadata
+        from alembic.migration import MigrationContext
+        from common import migrations
+
+        self.upgrade()
+        with migration_db.connect() as connection:
+            context = MigrationContext.configure(connection, opts={"include_object": migrations.include_object})
+            assert compare_metadata(context, Base.metadata) == []
+            assert connection.exec_driver_sql("SELECT version_num FROM alembic_version_data").scalar() == "0005"
+
+    def test_upgrade_adopts_existing_database(self, migration_db):
+        """База прежнего create_all получает новые столбцы и поисковый индекс, строки сохраняются"""
+        with migration_db.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE file_metadata (id INTEGER PRIMARY KEY, filename VARCHAR UNIQUE, "
+                "filetype VARCHAR, title VARCHAR, description TEXT)"
+            )
+            connection.exec_driver_sql("INSERT INTO file_metadata VALUES (1, 'old.csv', 'csv', 'Старый отчёт', NULL)")
+
+        self.upgrade()
+        self.upgrade()
+        with migration_db.connect() as connection:
+            columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(file_metadata)")}
+            assert {"sha256", "size", "verified_at", "integrity_error"} <= columns
+            found = connection.exec_driver_sql("SELECT rowid FROM file_metadata_fts WHERE file_metadata_fts MATCH 'отчёт'").all()
+            assert found == [(1,)]
+
+class TestDerivedFiles:
+    """Тесты регистрации производных файлов и их происхождения"""
+
+    def test_register_derived_file(self, client, setup_database, temp_storage):
+        """Регистрация файла, записанного processing_service"""
+        with open(os.path.join(temp_storage, "derived.csv"), "w") as f:
+            f.write("a\n1\n")
+
+        payload = {
+            "filename": "derived.csv",
+            "filetype": "csv",
+            "source_filename": "source.csv",
+            "operation": {"columns": "1", "where": ["a>0"]},
+        }
+        response = client.post("/files/derived", json=payload)
+        assert response.status_code == 200
+        assert response.json()["title"] == "derived.csv"
+
+        lineage = client.get("/files/derived.csv/lineage").json()
+        assert len(lineage) == 1
+        assert lineage[0]["source_filename"] == "source.csv"
+        assert lineage[0]["operation"]["where"] == ["a>0"]
+
+    def test_register_derived_missing_file(self, client, setup_database, temp_storage):
+        """Файл отсутствует в storage"""
+        payload = {"filename": "missing.csv", "filetype": "csv", "source_filename": "source.csv"}
+        response = client.post("/files/derived", json=payload)
+        assert response.status_code == 404
+
+    def test_register_derived_duplicate(self, client, setup_database, temp_storage, sample_csv_content):
+        """Имя уже занято другим файлом"""
+        client.post("/upload", files={"file": ("taken.csv", sample_csv_content, "text/csv")})
+
+        payload = {"filename": "taken.csv", "filetype": "csv", "source_filename": "source.csv"}
+        response = client.post("/files/derived", json=payload)
+        assert response.status_code == 409
+
+class TestFileAppend:
+    """Тесты дозаписи строк в CSV"""
+
+    def test_append_rows(self, client, setup_database, temp_storage, sample_csv_content):
+        """Строки дописываются с новой строки, повторный заголовок отбрасывается"""
+        client.post("/upload", files={"file": ("log.csv", sample_csv_content, "text/csv")})
+
+        response = client.post("/files/log.csv/append", files={"file": ("part.csv", "name,age,city\nAnn,40,Rome\n", "text/csv")})
+        assert response.status_code == 200
+        data = response.json()
+
+        with open(os.path.join(temp_storage, "log.csv"), encoding="utf-8") as f:
+            content = f.read()
+        assert content == sample_csv_content + "\nAnn,40,Rome\n"
+        assert data["size"] == len(content.encode())
+
+    def test_append_streams_in_chunks(self, client, setup_database, temp_storage, sample_csv_content):
+        """Тело читается порциями: заголовок, разбитый между порциями, всё равно отбрасывается"""
+        client.post("/upload", files={"file": ("log.csv", sample_csv_content, "text/csv")})
+        rows = "".join(f"Ann{i},40,Rome\n" for i in range(100))
+
+        with patch("intfile.UPLOAD_CHUNK", 5):
+            response = client.post("/files/log.csv/append", files={"file": ("part.csv", "name,age,city\n" + rows, "text/csv")})
+
+        assert response.json()["appended_bytes"] == len(rows) + 1
+        with open(os.path.join(temp_storage, "log.csv"), encoding="utf-8") as f:
+            assert f.read() == sample_csv_content + "\n" + rows
+
+    def test_append_publishes_update(self, client, setup_database, temp_storage, sample_csv_content):
+        """Дозапись записывает событие file.updated и обновляет размер в каталоге"""
+        from common import events
+        from sqlalchemy import select
+        client.post("/upload", files={"file": ("log.csv", sample_csv_content, "text/csv")})
+        size = client.post("/files/log.csv/append", files={"file": ("part.csv", "Ann,40,Rome\n", "text/csv")}).json()["size"]
+
+        with engine.connect() as conn:
+            rows = conn.execute(select(events.outbox_table).order_by(events.outbox_table.c.id)).all()
+        assert [(row.type, row.filename) for row in rows] == [("file.uploaded", "log.csv"), ("file.updated", "log.csv")]
+        entry = next(item for item in client.get("/files").json() if item["filename"] == "log.csv")
+        assert entry["size"] == size
+
+    def test_interrupted_append_is_rolled_back(self, client, setup_database, temp_storage, sample_csv_content):
+        """Если передача оборвалась, дописанная часть отрезается"""
+        client.post("/upload", files={"file": ("log.csv", sample_csv_content, "text/csv")})
+        from starlette.datastructures import UploadFile
+        read = UploadFile.read
+        calls = []
+
+        async def flaky_read(self, size=-1):
+            calls.append(size)
+            # Строка Ann и начало Bob уже записаны, когда передача обрывается
+            if len(calls) > 4:
+                raise OSError("соединение разорвано")
+            return await read(self, size)
+
+        with patch("intfile.UPLOAD_CHUNK", 4), patch.object(UploadFile, "read", flaky_read):
+            with pytest.raises(OSError):
+                client.post("/files/log.csv/append", files={"file": ("part.csv", "Ann,40,Rome\nBob,1,Oslo\n", "text/csv")})
+
+        with open(os.path.join(temp_storage, "log.csv"), encoding="utf-8") as f:
+            assert f.read() == sample_csv_content
+
+    def test_append_to_missing_or_unsupported_file(self, client, setup_database, temp_storage, sample_image_content):
+        """Дозапись в неизвестный файл — 404, в изображение или gzip — 400"""
+        response = client.post("/files/missing.csv/append", files={"file": ("part.csv", "a\n", "text/csv")})
+        assert response.status_code == 404
+
+        client.post("/upload", files={"file": ("photo.jpg", sample_image_content, "image/jpeg")})
+        response = client.post("/files/photo.jpg/append", files={"file": ("part.csv", "a\n", "text/csv")})
+        assert response.status_code == 400
+
+        client.post("/upload", files={"file": ("packed.csv.gz", gzip.compress(b"a,b\n1,2\n"), "application/gzip")})
+        response = client.post("/files/packed.csv.gz/append", files={"file": ("part.csv", "3,4\n", "text/csv")})
+        assert response.status_code == 400
+
+class TestBulkUpload:
+    """Тесты пакетной загрузки"""
+
+    def test_bulk_multipart(self, client, setup_database, temp_storage, sample_csv_content, sample_image_content):
+        """Все файлы пакета сохраняются и регистрируются одним запросом"""
+        response = client.post("/upload/bulk", files=[
+            ("files", ("a.csv", sample_csv_content, "text/csv")),
+            ("files", ("b.csv", sample_csv_content, "text/csv")),
+            ("files", ("c.jpg", sample_image_content, "image/jpeg")),
+        ], data={"description": "пакет"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["created"] == 3
+        assert data["failed"] == 0
+        assert [item["status"] for item in data["files"]] == ["created"] * 3
+        assert data["files"][2]["filetype"] == "photo"
+
+        files = client.get("/files").json()
+        assert {f["filename"] for f in files} == {"a.csv", "b.csv", "c.jpg"}
+        assert all(f["description"] == "пакет" for f in files)
+        assert sorted(os.listdir(temp_storage)) == ["a.csv", "b.csv", "c.jpg"]
+
+    def test_bulk_zip_and_tar(self, client, setup_database, temp_storage, sample_csv_content):
+        """Архивы zip и tar.gz распаковываются потоково, каталоги в именах отбрасываются"""
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, "w") as archive:
+            archive.writestr("data/z1.csv", sample_csv_content)
+            archive.writestr("z2.csv", sample_csv_content)
+        response = client.post("/upload/bulk", files={"archive": ("batch.zip", zipped.getvalue(), "application/zip")})
+        assert response.status_code == 200
+        assert response.json()["created"] == 2
+
+        tarred = io.BytesIO()
+        with tarfile.open(fileobj=tarred, mode="w:gz") as archive:
+            for name in ("t1.csv", "t2.csv"):
+                payload = sample_csv_content.encode()
+                info = tarfile.TarInfo(name)
+                info.size = len(payload)
+                archive.addfile(info, io.BytesIO(payload))
+        response = client.post("/upload/bulk", files={"archive": ("batch.tar.gz", tarred.getvalue(), "application/gzip")})
+        assert response.status_code == 200
+        assert response.json()["created"] == 2
+
+        assert {f["filename"] for f in client.get("/files").json()} == {"z1.csv", "z2.csv", "t1.csv", "t2.csv"}
+
+    def test_bulk_partial_failures(self, client, setup_database, temp_storage, sample_csv_content):
+        """Ошибка одного файла не мешает остальным, временные файлы не остаются"""
+        client.post("/upload", files={"file": ("old.csv", sample_csv_content, "text/csv")})
+
+        response = client.post("/upload/bulk", files=[
+            ("files", ("ok.csv", sample_csv_content, "text/csv")),
+            ("files", ("empty.csv", "", "text/csv")),
+            ("files", ("ok.csv", sample_csv_content, "text/csv")),
+            ("files", ("old.csv", sample_csv_content, "text/csv")),
+        ])
+        assert response.status_code == 200
+        data = response.json()
+        assert data["created"] == 1
+        assert data["failed"] == 3
+        assert [item["status"] for item in data["files"]] == ["created", "error", "error", "exists"]
+        assert sorted(os.listdir(temp_storage)) == ["ok.csv", "old.csv"]
+
+    def test_bulk_bad_request(self, client, setup_database, temp_storage):
+        """Без файлов или с архивом неизвестного формата — 400"""
+        assert client.post("/upload/bulk").status_code == 400
+        response = client.post("/upload/bulk", files={"archive": ("batch.rar", b"not an archive", "application/octet-stream")})
+        assert response.status_code == 400
+        assert os.listdir(temp_storage) == []
+
+    def test_bulk_too_many_files(self, client, setup_database, temp_storage, sample_csv_content):
+        """Пакет больше BULK_MAX_FILES отклоняется целиком"""
+        with patch.dict(os.environ, {"BULK_MAX_FILES": "1"}):
+            response = client.post("/upload/bulk", files=[
+                ("files", ("a.csv", sample_csv_content, "text/csv")),
+                ("files", ("b.csv", sample_csv_content, "text/csv")),
+            ])
+        assert response.status_code == 413
+        assert os.listdir(temp_storage) == []
+
 class TestCRUDOperations:
     """Тесты CRUD операций"""
     
@@ -350,6 +1051,59 @@ class TestFileTypeDetection:
         result = response.json()
         assert result["filetype"] == "photo"
     
+    def test_gzip_csv_file_type_detection(self, client, setup_database, temp_storage):
+        """Сжатый CSV определяется как csv и хранится без распаковки"""
+        content = gzip.compress(b"id,value\n1,2\n")
+        files = {"file": ("compressed.csv.gz", content, "application/gzip")}
+        response = client.post("/upload", files=files)
+
+        assert response.status_code == 200
+        assert response.json()["filetype"] == "csv"
+        with open(os.path.join(temp_storage, "compressed.csv.gz"), "rb") as f:
+            assert f.read() == content
+
+    def test_cp1251_csv_upload(self, client, setup_database, temp_storage):
+        """CSV в cp1251 с разделителем ';' принимается без перекодировки"""
+        content = "имя;значение\nА;1\n".encode("cp1251")
+        files = {"file": ("cp1251.csv", content, "text/csv")}
+        response = client.post("/upload", files=files)
+
+        assert response.status_code == 200
+        assert response.json()["filetype"] == "csv"
+
+    def test_corrupted_gzip_csv_upload(self, client, setup_database, temp_storage):
+        """Повреждённый gzip-архив отклоняется"""
+        files = {"file": ("broken.csv.gz", b"\x1f\x8bnot really gzip", "application/gzip")}
+        response = client.post("/upload", files=files)
+
+        assert response.status_code == 400
+        assert "gzip" in response.json()["detail"]
+
+    def test_parquet_file_type_detection(self, client, setup_database, temp_storage):
+        """Определение типа Parquet файла по расширению и сигнатуре"""
+        content = b"PAR1" + b"\x00" * 16 + b"PAR1"
+        files = {"file": ("export.parquet", content, "application/octet-stream")}
+        response = client.post("/upload", files=files)
+
+        assert response.status_code == 200
+        assert response.json()["filetype"] == "parquet"
+
+    def test_arrow_file_type_detection(self, client, setup_database, temp_storage):
+        """Определение типа Arrow/Feather файла"""
+        content = b"ARROW1" + b"\x00" * 16 + b"ARROW1"
+        files = {"file": ("export.feather", content, "application/octet-stream")}
+        response = client.post("/upload", files=files)
+
+        assert response.status_code == 200
+        assert response.json()["filetype"] == "arrow"
+
+    def test_invalid_parquet_upload(self, client, setup_database, temp_storage):
+        """Файл с расширением .parquet без сигнатуры отклоняется"""
+        files = {"file": ("fake.parquet", b"name,age\n", "application/octet-stream")}
+        response = client.post("/upload", files=files)
+
+        assert response.status_code == 400
+
     def test_other_file_type_detection(self, client, setup_database, temp_storage):
         """Определение типа других файлов"""
         files = {"file": ("test.txt", "some text content", "text/plain")}
@@ -370,6 +1124,40 @@ class TestHealthCheck:
         assert data["service"] == "data-service"
 
 
+class TestMetrics:
+    """Тесты эндпоинта метрик"""
+
+    def test_metrics_endpoint(self, client, setup_database, temp_storage, sample_csv_content):
+        """Объём загрузок и задержки по шаблону маршрута"""
+        client.post("/upload", files={"file": ("metrics.csv", sample_csv_content, "text/csv")})
+        client.get("/download/metrics.csv")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        body = response.text
+        assert "upload_bytes_total" in body
+        assert 'route="/download/{filename}"' in body
+        assert "metrics.csv" not in body
+
+class TestTracing:
+    """Тесты трассировки загрузки"""
+
+    def test_upload_spans(self, client, setup_database, temp_storage, sample_csv_content):
+        """Чтение тела, запись на диск и crud-вызовы видны отдельными спанами"""
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        from common import tracing
+
+        exporter = InMemorySpanExporter()
+        tracing.provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+        client.post("/upload", files={"file": ("traced.csv", sample_csv_content, "text/csv")})
+
+        names = [span.name for span in exporter.get_finished_spans()]
+        for name in ("upload.read_body", "upload.write_file", "upload.validate_header", "crud.create_file_metadata", "POST /upload"):
+            assert name in names
+        exporter.clear()
+
 class TestIntegration:
     """Интеграционные тесты полного цикла"""
     
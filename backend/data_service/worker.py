@@ -0,0 +1,15 @@
+"""Обработчик фоновых задач data_service (очередь file_jobs, см. jobs.py).
+
+Запуск: python worker.py — отдельным процессом рядом с API; обработчиков
+может быть несколько, задачи между ними не дублируются. Если задан
+SCRUB_BYTES_PER_SECOND, здесь же в фоне работает проверка целостности storage.
+"""
+import integrity
+import jobs
+from database import SessionLocal
+
+if __name__ == "__main__":
+    scrubber = integrity.Scrubber.from_env(SessionLocal)
+    if scrubber is not None:
+        scrubber.start()
+    jobs.Worker.from_env(SessionLocal).run_forever()
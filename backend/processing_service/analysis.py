@@ -0,0 +1,319 @@
+from fastapi import HTTPException
+from itertools import islice
+from common import csvio, metrics, sharedstate, tracing
+import limits
+import copy, csv, hashlib, io, json, os, time
+
+UNDEFINED = "невозможно определить"
+BATCH_ROWS = 1024
+# Сколько файлов хранят состояние для дозаписи и размер образцов для проверки, что файл не подменён
+MAX_RESUMABLE_FILES = 16
+FINGERPRINT_BYTES = 4096
+# Превью ограничено первыми строками файла: раньше в ответ попадал весь файл
+PREVIEW_MAX_ROWS = int(os.getenv("ANALYZE_PREVIEW_ROWS", "1000"))
+
+# Общие для рабочих процессов пода, если задан SHARED_STATE_DIR
+_states = sharedstate.create_store("analysis", MAX_RESUMABLE_FILES)
+
+
+def check_columns(selected_columns, col_count):
+    """Проверяет номера столбцов после чтения заголовка и возвращает индексы для анализа"""
+    if selected_columns:
+        for col in selected_columns:
+            if col < 0 or col >= col_count:
+                raise HTTPException(status_code=400, detail="Некорректный номер столбца")
+        return sorted(set(selected_columns))
+    return list(range(col_count))
+
+
+class ColumnAggregates:
+    """Накопленные сумма, количество и максимум числовых значений по столбцам"""
+
+    def __init__(self, col_count: int):
+        self.sums = [0.0] * col_count
+        self.counts = [0] * col_count
+        self.maxima = [float("-inf")] * col_count
+        self.non_numeric = [False] * col_count
+
+    def add_row(self, row, indices):
+        row_len = len(row)
+        for j in indices:
+            if j >= row_len:
+                continue
+            try:
+                num = float(row[j])
+            except (ValueError, TypeError):
+                self.non_numeric[j] = True
+                continue
+            self.sums[j] += num
+            self.counts[j] += 1
+            if num > self.maxima[j]:
+                self.maxima[j] = num
+
+    def results(self, header, indices):
+        results = []
+        for j in indices:
+            column = header[j] if header else f"Колонка {j+1}"
+            if self.counts[j] == 0:
+                results.append({
+                    "column": column,
+                    "sum": UNDEFINED if self.non_numeric[j] else 0,
+                    "average": UNDEFINED,
+                    "max": UNDEFINED
+                })
+            else:
+                results.append({
+                    "column": column,
+                    "sum": round(self.sums[j], 2),
+                    "average": round(self.sums[j] / self.counts[j], 2),
+                    "max": round(self.maxima[j], 2)
+                })
+        return results
+
+
+def build_response(filename, header, selected_columns, preview_lines, results, **extra):
+    response = {
+        "filename": filename,
+        "columns_total": len(header),
+        "columns_selected": [header[i] for i in selected_columns] if selected_columns else "Все",
+    }
+    response.update(extra)
+    response["preview"] = "\n".join(preview_lines)
+    response["analysis"] = results
+    return response
+
+
+class AnalysisState:
+    """Результат анализа файла до байта offset; следующий анализ дочитывает только хвост"""
+
+    def __init__(self, header, indices, aggregates, preview_lines, rows_total, offset, fingerprint):
+        self.header = header
+        self.indices = indices
+        self.aggregates = aggregates
+        self.preview_lines = preview_lines
+        self.rows_total = rows_total
+        self.offset = offset
+        self.fingerprint = fingerprint
+        self.preview_bytes = sum(len(line) for line in preview_lines)
+
+    def add_preview(self, row):
+        if len(self.preview_lines) <= PREVIEW_MAX_ROWS:
+            line = ", ".join(row)
+            self.preview_lines.append(line)
+            self.preview_bytes += len(line)
+
+    @property
+    def preview_truncated(self):
+        return self.rows_total > len(self.preview_lines) - 1
+
+
+def _fingerprint(file_path, offset):
+    """Хеш начала файла и байтов перед offset: меняется, если файл перезаписан, а не дописан"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        digest.update(f.read(min(offset, FINGERPRINT_BYTES)))
+        f.seek(max(offset - FINGERPRINT_BYTES, 0))
+        digest.update(f.read(min(offset, FINGERPRINT_BYTES)))
+    return digest.digest()
+
+
+def _ends_with_newline(file_path, size):
+    with open(file_path, "rb") as f:
+        f.seek(size - 1)
+        return f.read(1) in (b"\n", b"\r")
+
+
+def _resume(key, file_path):
+    """Копия сохранённого состояния: проход меняет агрегаты на месте, а одновременные
+    проходы одного файла не должны дописывать хвост в общий объект"""
+    state = _states.get(key)
+    if state is None:
+        return None
+    if os.path.getsize(file_path) < state.offset or _fingerprint(file_path, state.offset) != state.fingerprint:
+        _states.pop(key)
+        return None
+    return copy.deepcopy(state)
+
+
+def _remember(key, file_path, state):
+    """Сохраняет состояние, только если файл не менялся во время чтения и заканчивается целой строкой"""
+    size = state.offset
+    if size == 0 or os.path.getsize(file_path) != size or not _ends_with_newline(file_path, size):
+        _states.pop(key)
+        return
+    state.fingerprint = _fingerprint(file_path, size)
+    _states.put(key, state, tag=file_path)
+
+
+def forget(file_path):
+    """Удаляет сохранённые состояния анализа файла"""
+    _states.pop_tag(file_path)
+
+
+class CsvAnalysis:
+    """Один проход анализа CSV. Несжатый файл, который только дописывался,
+    дочитывается с места прошлого прохода, и хвост сливается с прежними агрегатами.
+
+    Строки обрабатываются порциями: batches() отдаёт управление после каждой порции,
+    поэтому проход можно выполнить целиком или с промежуточным прогрессом и прервать.
+    Перед каждой порцией проверяется бюджет (limits.Budget); при превышении проход
+    останавливается, результат помечается как partial и не сохраняется для дозаписи.
+    """
+
+    def __init__(self, file_path, filename, selected_columns, fmt: csvio.CsvFormat, budget: limits.Budget = None):
+        self.budget = budget or limits.Budget()
+        self.file_path = file_path
+        self.filename = filename
+        self.selected_columns = selected_columns
+        self.fmt = fmt
+        self.resumable = csvio.is_line_seekable(fmt)
+        self.key = (file_path, fmt.encoding, fmt.delimiter, tuple(sorted(set(selected_columns or ()))))
+        self.size = os.path.getsize(file_path)
+        self.state = _resume(self.key, file_path) if self.resumable else None
+        self.resumed_from = self.state.offset if self.state else 0
+        self.rows = 0
+        self.parse_seconds = self.aggregate_seconds = 0.0
+        self.finished = False
+        try:
+            self._open()
+        except (OSError, EOFError):
+            raise HTTPException(status_code=400, detail="Некорректный gzip-архив")
+
+    def _open(self):
+        if self.state is not None:
+            f = open(self.file_path, "rb")
+            f.seek(self.state.offset)
+            self.stream = io.TextIOWrapper(f, encoding=self.fmt.encoding, errors="replace", newline="")
+            self.reader = csvio.reader(self.stream, self.fmt)
+            return
+
+        self.stream = csvio.open_text(self.file_path, self.fmt)
+        try:
+            self.reader = csvio.reader(self.stream, self.fmt)
+            header = next(self.reader, None)
+            if header is None:
+                raise HTTPException(status_code=400, detail="Файл пустой")
+            self.budget.check_columns(len(header))
+            indices = check_columns(self.selected_columns, len(header))
+        except csv.Error as e:
+            self.stream.close()
+            raise HTTPException(status_code=413, detail=f"Заголовок не разобран: {e}")
+        except BaseException:
+            self.stream.close()
+            raise
+        self.state = AnalysisState(header, indices, ColumnAggregates(len(header)), [", ".join(header)], 0, 0, None)
+
+    def batches(self):
+        """Время разбора и агрегирования меряется на порцию, а не на каждую строку.
+        Размер порции уменьшается, если строки широкие, чтобы порция укладывалась в бюджет памяти"""
+        state, budget = self.state, self.budget
+        batch_rows = BATCH_ROWS
+        batch_bytes = 0
+        try:
+            while not budget.check(self.rows, state.preview_bytes + batch_bytes):
+                cpu_started = time.thread_time()
+                position = self.stream.buffer.tell()
+                started = time.perf_counter()
+                try:
+                    batch = list(islice(self.reader, budget.rows_left(self.rows, batch_rows)))
+                except csv.Error:
+                    # Поле больше csv.field_size_limit: дальше строки не читаются
+                    budget.exceeded = "field_size"
+                    break
+                parsed = time.perf_counter()
+                self.parse_seconds += parsed - started
+                if not batch:
+                    break
+                for row in batch:
+                    state.add_preview(row)
+                    state.aggregates.add_row(row, state.indices)
+                self.aggregate_seconds += time.perf_counter() - parsed
+                self.rows += len(batch)
+                budget.add_cpu(time.thread_time() - cpu_started)
+
+                batch_bytes = self.stream.buffer.tell() - position
+                if budget.memory_bytes and batch_bytes:
+                    bytes_per_row = batch_bytes / len(batch)
+                    batch_rows = max(1, min(BATCH_ROWS, int(budget.memory_bytes / 4 / bytes_per_row)))
+                yield
+            self._finish()
+        except (OSError, EOFError):
+            raise HTTPException(status_code=400, detail="Некорректный gzip-архив")
+        finally:
+            self.stream.close()
+            if not self.finished:
+                # Прерванный проход оставил агрегаты неполными
+                _states.pop(self.key)
+
+    def _finish(self):
+        self.state.rows_total += self.rows
+        if self.resumable and self.budget.exceeded is None:
+            self.state.offset = self.size
+            _remember(self.key, self.file_path, self.state)
+        else:
+            _states.pop(self.key)
+        metrics.observe_analysis("csv", self.rows, self.size - self.resumed_from, self.parse_seconds, self.aggregate_seconds)
+        self.finished = True
+
+    def bytes_read(self):
+        buffer = self.stream.buffer
+        return getattr(buffer, "fileobj", buffer).tell()
+
+    def progress(self):
+        state = self.state
+        return {
+            "bytes_read": self.bytes_read(),
+            "bytes_total": self.size,
+            "rows": state.rows_total + self.rows,
+            "analysis": state.aggregates.results(state.header, state.indices),
+        }
+
+    def result(self):
+        state = self.state
+        return build_response(
+            self.filename, state.header, self.selected_columns, state.preview_lines,
+            state.aggregates.results(state.header, state.indices),
+            format="csv",
+            encoding=self.fmt.encoding,
+            delimiter=self.fmt.delimiter,
+            compressed=self.fmt.compressed,
+            rows_total=state.rows_total,
+            resumed_from_offset=self.resumed_from,
+            preview_truncated=state.preview_truncated,
+            **self.budget.report(),
+        )
+
+
+@tracing.traced("analyze.csv")
+def analyze_csv(file_path, filename, selected_columns, fmt: csvio.CsvFormat, budget: limits.Budget = None):
+    run = CsvAnalysis(file_path, filename, selected_columns, fmt, budget)
+    for _ in run.batches():
+        pass
+
+    tracing.set_attributes(**{
+        "analyze.rows": run.rows,
+        "analyze.encoding": fmt.encoding,
+        "analyze.resumed_from": run.resumed_from,
+        "analyze.limit_exceeded": run.budget.exceeded or "",
+    })
+    tracing.record_phases([("analyze.parse", run.parse_seconds), ("analyze.aggregate", run.aggregate_seconds)])
+    return run.result()
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_csv(run: CsvAnalysis, interval: float):
+    """События SSE: progress не чаще раза в interval секунд, затем result или error"""
+    last = time.perf_counter()
+    try:
+        for _ in run.batches():
+            now = time.perf_counter()
+            if now - last >= interval:
+                last = now
+                yield sse_event("progress", run.progress())
+    except HTTPException as e:
+        yield sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+        return
+    yield sse_event("result", run.result())
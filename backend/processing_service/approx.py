@@ -0,0 +1,240 @@
+"""Приближённый анализ CSV по случайной выборке блоков.
+
+Область данных файла делится на блоки фиксированного размера; блоки читаются
+в случайном порядке (блочная, или кластерная, выборка). Строка относится
+к блоку, в котором она начинается. По накопленным суммам по блокам
+оцениваются сумма (N * среднее по блокам) и среднее (отношение сумм)
+с доверительными интервалами с поправкой на конечную совокупность.
+Максимум по выборке — нижняя граница истинного максимума.
+
+Состояние выборки хранится в сессии: повторный запрос с тем же session
+дочитывает новые блоки и сужает интервалы. Когда прочитаны все блоки,
+результат совпадает с точным.
+"""
+import copy
+import csv
+import math
+import os
+import random
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from analysis import UNDEFINED, ColumnAggregates, check_columns, build_response
+from common import csvio, sharedstate, tracing
+
+BLOCK_SIZE = 256 * 1024
+PREVIEW_ROWS = 20
+MAX_SESSIONS = 64
+Z_95 = 1.959964
+
+# Уточняющий запрос может прийти в другой рабочий процесс: сессии общие, если задан SHARED_STATE_DIR
+_sessions = sharedstate.create_store("approx", MAX_SESSIONS)
+
+
+class _Moments:
+    """Суммы по блокам, достаточные для оценок и их дисперсий"""
+
+    __slots__ = ("y", "yy", "c", "cc", "yc", "maximum", "non_numeric")
+
+    def __init__(self):
+        self.y = self.yy = self.c = self.cc = self.yc = 0.0
+        self.maximum = float("-inf")
+        self.non_numeric = False
+
+    def add_block(self, total, count, maximum, non_numeric):
+        self.y += total
+        self.yy += total * total
+        self.c += count
+        self.cc += count * count
+        self.yc += total * count
+        if maximum > self.maximum:
+            self.maximum = maximum
+        self.non_numeric = self.non_numeric or non_numeric
+
+
+class ApproxSession:
+    def __init__(self, file_path, fmt, header, header_end, selected_columns, seed):
+        stat = os.stat(file_path)
+        self.id = uuid.uuid4().hex
+        self.file_path = file_path
+        self.signature = (stat.st_size, stat.st_mtime_ns)
+        self.fmt = fmt
+        self.header = header
+        self.selected_columns = selected_columns
+        self.indices = check_columns(selected_columns, len(header))
+        self.header_end = header_end
+        self.blocks_total = max(1, math.ceil((stat.st_size - header_end) / BLOCK_SIZE))
+        self.order = list(range(self.blocks_total))
+        random.Random(seed).shuffle(self.order)
+        self.sampled = 0
+        self.rows = _Moments()
+        self.columns = {j: _Moments() for j in self.indices}
+
+    def _read_block(self, f, block):
+        start = self.header_end + block * BLOCK_SIZE
+        end = start + BLOCK_SIZE
+        if block > 0:
+            # Дочитываем строку, начавшуюся в предыдущем блоке
+            f.seek(start - 1)
+            f.readline()
+        else:
+            f.seek(start)
+        lines = []
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line.decode(self.fmt.encoding, errors="replace"))
+        return csv.reader(lines, delimiter=self.fmt.delimiter)
+
+    def _add_block(self, rows):
+        block = ColumnAggregates(len(self.header))
+        row_count = 0
+        for row in rows:
+            if not row:
+                continue
+            row_count += 1
+            block.add_row(row, self.indices)
+        self.rows.add_block(row_count, row_count, float("-inf"), False)
+        for j in self.indices:
+            self.columns[j].add_block(block.sums[j], block.counts[j], block.maxima[j], block.non_numeric[j])
+
+    def refine(self, max_seconds, target_error):
+        deadline = time.perf_counter() + max_seconds
+        with open(self.file_path, "rb") as f:
+            while self.sampled < self.blocks_total:
+                self._add_block(self._read_block(f, self.order[self.sampled]))
+                self.sampled += 1
+                if time.perf_counter() >= deadline or self._relative_error() <= target_error:
+                    break
+
+    def _fpc(self):
+        return 1 - self.sampled / self.blocks_total
+
+    def _total(self, m):
+        """Оценка суммы по совокупности и половина ширины доверительного интервала"""
+        n, big_n = self.sampled, self.blocks_total
+        estimate = big_n * m.y / n
+        if n < 2:
+            return estimate, (0.0 if n == big_n else math.inf)
+        variance_y = max(m.yy - m.y * m.y / n, 0.0) / (n - 1)
+        return estimate, Z_95 * big_n * math.sqrt(self._fpc() * variance_y / n)
+
+    def _ratio(self, m):
+        """Оценка среднего как отношения сумм и половина ширины интервала"""
+        n, big_n = self.sampled, self.blocks_total
+        ratio = m.y / m.c
+        if n < 2:
+            return ratio, (0.0 if n == big_n else math.inf)
+        residual = max(m.yy - 2 * ratio * m.yc + ratio * ratio * m.cc, 0.0) / (n - 1)
+        mean_count = m.c / n
+        return ratio, Z_95 * math.sqrt(self._fpc() * residual / n) / mean_count
+
+    def rows_estimate(self):
+        return round(self._total(self.rows)[0])
+
+    def _relative_error(self):
+        errors = []
+        for m in self.columns.values():
+            if m.c == 0:
+                continue
+            estimate, half = self._total(m)
+            errors.append(half / abs(estimate) if estimate else (0.0 if half == 0 else math.inf))
+        return max(errors, default=0.0)
+
+    def results(self):
+        results = []
+        for j in self.indices:
+            m = self.columns[j]
+            if m.c == 0:
+                results.append({
+                    "column": self.header[j],
+                    "sum": UNDEFINED if m.non_numeric else 0,
+                    "average": UNDEFINED,
+                    "max": UNDEFINED,
+                })
+                continue
+            total, total_half = self._total(m)
+            average, average_half = self._ratio(m)
+            results.append({
+                "column": self.header[j],
+                "sum": round(total, 2),
+                "average": round(average, 2),
+                "max": round(m.maximum, 2),
+                "sum_ci": _interval(total, total_half),
+                "average_ci": _interval(average, average_half),
+                "max_is_lower_bound": self.sampled < self.blocks_total,
+            })
+        return results
+
+
+def _interval(estimate, half):
+    if math.isinf(half):
+        return None
+    return [round(estimate - half, 2), round(estimate + half, 2)]
+
+
+def _read_header(file_path, fmt):
+    """Заголовок и смещение начала данных (в байтах) вместе с первыми строками для превью"""
+    with open(file_path, "rb") as f:
+        first = f.readline()
+        header_end = f.tell()
+        preview = [first] + [line for line in (f.readline() for _ in range(PREVIEW_ROWS)) if line]
+    decoded = [line.decode(fmt.encoding, errors="replace") for line in preview]
+    rows = list(csv.reader(decoded, delimiter=fmt.delimiter))
+    return (rows[0] if rows else None), header_end, rows[1:]
+
+
+def _get_session(session_id, file_path):
+    """Копия сохранённой сессии: уточнение меняет выборку на месте, а одновременные
+    уточнения одной сессии не должны читать и учитывать блоки в общем объекте"""
+    session = _sessions.get(session_id)
+    if session is None or session.file_path != file_path:
+        raise HTTPException(status_code=404, detail="Сессия приближённого анализа не найдена")
+    stat = os.stat(file_path)
+    if session.signature != (stat.st_size, stat.st_mtime_ns):
+        _sessions.pop(session_id)
+        raise HTTPException(status_code=409, detail="Файл изменился, начните новую сессию")
+    return copy.deepcopy(session)
+
+
+def forget(file_path):
+    """Закрывает сессии приближённого анализа файла"""
+    _sessions.pop_tag(file_path)
+
+
+@tracing.traced("analyze.approx")
+def analyze(file_path, filename, selected_columns, fmt, session_id=None, max_seconds=1.0, target_error=0.01, seed=None):
+    """Приближённый анализ: новая сессия или уточнение существующей"""
+    if not csvio.is_line_seekable(fmt):
+        raise HTTPException(status_code=400, detail="Приближённый режим недоступен для сжатых файлов и кодировок UTF-16/UTF-32")
+
+    header, header_end, preview_rows = _read_header(file_path, fmt)
+    if session_id:
+        session = _get_session(session_id, file_path)
+    else:
+        if header is None:
+            raise HTTPException(status_code=400, detail="Файл пустой")
+        session = ApproxSession(file_path, fmt, header, header_end, selected_columns, seed)
+
+    session.refine(max_seconds, target_error)
+    _sessions.put(session.id, session, tag=file_path)
+    tracing.set_attributes(**{"analyze.sampled_blocks": session.sampled, "analyze.total_blocks": session.blocks_total})
+
+    preview_lines = [", ".join(session.header)] + [", ".join(row) for row in preview_rows]
+    return build_response(
+        filename, session.header, session.selected_columns, preview_lines, session.results(),
+        format="csv",
+        encoding=session.fmt.encoding,
+        delimiter=session.fmt.delimiter,
+        compressed=False,
+        approximate=session.sampled < session.blocks_total,
+        session=session.id,
+        confidence=0.95,
+        sampled_blocks=session.sampled,
+        total_blocks=session.blocks_total,
+        sampled_fraction=round(session.sampled / session.blocks_total, 4),
+        rows_estimate=session.rows_estimate(),
+    )
@@ -0,0 +1,224 @@
+"""Анализ Parquet и Arrow IPC/Feather файлов.
+
+Читаются только выбранные столбцы. Для Parquet максимум и количество значений
+берутся из статистики в футере файла, а данные группы строк читаются только
+ради суммы: у постоянного столбца (min == max) сумма выводится из статистики,
+и он не читается вовсе. Без статистики столбец группы читается целиком.
+"""
+from fastapi import HTTPException
+from analysis import ColumnAggregates, check_columns, build_response
+from common import metrics, tracing
+import limits
+import os, time
+
+PREVIEW_ROWS = 100
+
+
+def _is_numeric(data_type):
+    import pyarrow.types as pat
+    return pat.is_integer(data_type) or pat.is_floating(data_type) or pat.is_decimal(data_type)
+
+
+def _format_value(value):
+    return "" if value is None else str(value)
+
+
+def _preview(header, batch):
+    lines = [", ".join(header)]
+    if batch is not None:
+        for row in zip(*(column.to_pylist() for column in batch.columns)):
+            lines.append(", ".join(_format_value(value) for value in row))
+    return lines
+
+
+def _add_maximum(aggregates, j, maximum):
+    if maximum > aggregates.maxima[j]:
+        aggregates.maxima[j] = maximum
+
+
+def _add_array(aggregates, j, array):
+    import pyarrow.compute as pc
+
+    count = len(array) - array.null_count
+    if count == 0:
+        return
+    aggregates.counts[j] += count
+    aggregates.sums[j] += float(pc.sum(array).as_py())
+    _add_maximum(aggregates, j, float(pc.max(array).as_py()))
+
+
+def _add_sum(aggregates, j, array):
+    """Только сумма: количество и максимум уже взяты из статистики"""
+    import pyarrow.compute as pc
+
+    if len(array) > array.null_count:
+        aggregates.sums[j] += float(pc.sum(array).as_py())
+
+
+def _numeric_columns(schema, indices):
+    return [j for j in indices if _is_numeric(schema.field(j).type)]
+
+
+def _mark_non_numeric(aggregates, indices, numeric, num_rows):
+    if num_rows:
+        for j in indices:
+            if j not in numeric:
+                aggregates.non_numeric[j] = True
+
+
+def _chunk_statistics(chunk):
+    """(count, min, max) из статистики столбца группы строк или None, если её нет"""
+    stats = chunk.statistics
+    if stats is None or not stats.has_null_count:
+        return None
+    count = chunk.num_values - stats.null_count
+    if count == 0:
+        return 0, None, None
+    if not stats.has_min_max:
+        return None
+    return count, float(stats.min), float(stats.max)
+
+
+def analyze_parquet(file_path, filename, selected_columns, budget):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file_path, memory_map=True)
+    schema = parquet_file.schema_arrow
+    metadata = parquet_file.metadata
+    header = schema.names
+
+    indices = check_columns(selected_columns, len(header))
+    aggregates = ColumnAggregates(len(header))
+    numeric = _numeric_columns(schema, indices)
+    _mark_non_numeric(aggregates, indices, numeric, metadata.num_rows)
+
+    # Индексы листовых столбцов Parquet для плоских полей схемы
+    leaf_index = {metadata.schema.column(k).path: k for k in range(metadata.num_columns)}
+
+    from_statistics = 0
+    rows_done = 0
+    parse_seconds = aggregate_seconds = 0.0
+    for rg in range(metadata.num_row_groups):
+        if budget.check(rows_done):
+            break
+        row_group = metadata.row_group(rg)
+        rows_done += row_group.num_rows
+        to_read = []
+        sum_only = set()
+        for j in numeric:
+            k = leaf_index.get(header[j])
+            stats = _chunk_statistics(row_group.column(k)) if k is not None else None
+            if stats is None:
+                to_read.append(j)
+                continue
+            count, minimum, maximum = stats
+            if count == 0:
+                from_statistics += 1
+                continue
+            aggregates.counts[j] += count
+            _add_maximum(aggregates, j, maximum)
+            if minimum != maximum:
+                # Количество и максимум известны из футера, данные нужны только для суммы
+                sum_only.add(j)
+                to_read.append(j)
+                continue
+            # Постоянный столбец: сумма выводится из статистики без чтения данных
+            aggregates.sums[j] += minimum * count
+            from_statistics += 1
+
+        if to_read:
+            cpu_started = time.thread_time()
+            started = time.perf_counter()
+            table = parquet_file.read_row_group(rg, columns=[header[j] for j in to_read])
+            parsed = time.perf_counter()
+            for position, j in enumerate(to_read):
+                add = _add_sum if j in sum_only else _add_array
+                add(aggregates, j, table.column(position))
+            parse_seconds += parsed - started
+            aggregate_seconds += time.perf_counter() - parsed
+            budget.add_cpu(time.thread_time() - cpu_started)
+
+    first_batch = next(parquet_file.iter_batches(batch_size=PREVIEW_ROWS), None)
+    metrics.observe_analysis("parquet", metadata.num_rows, os.path.getsize(file_path), parse_seconds, aggregate_seconds)
+    tracing.set_attributes(**{"analyze.rows": metadata.num_rows, "analyze.chunks_from_statistics": from_statistics})
+    tracing.record_phases([("analyze.parse", parse_seconds), ("analyze.aggregate", aggregate_seconds)])
+
+    return build_response(
+        filename, header, selected_columns, _preview(header, first_batch), aggregates.results(header, indices),
+        format="parquet",
+        row_groups_total=metadata.num_row_groups,
+        chunks_from_statistics=from_statistics,
+        **budget.report(),
+    )
+
+
+def _record_batches(reader, kind):
+    if kind == "arrow_stream":
+        yield from reader
+    else:
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def _aggregate_arrow(filename, size, schema, batches, selected_columns, budget):
+    header = schema.names
+    indices = check_columns(selected_columns, len(header))
+    aggregates = ColumnAggregates(len(header))
+    numeric = _numeric_columns(schema, indices)
+
+    preview_batch = None
+    num_rows = 0
+    parse_seconds = aggregate_seconds = 0.0
+    started = time.perf_counter()
+    for batch in batches:
+        if budget.check(num_rows):
+            break
+        cpu_started = time.thread_time()
+        parsed = time.perf_counter()
+        parse_seconds += parsed - started
+        if preview_batch is None:
+            preview_batch = batch.slice(0, PREVIEW_ROWS)
+        num_rows += batch.num_rows
+        # Файл отображён в память: обращение к столбцу читает только его страницы
+        for j in numeric:
+            _add_array(aggregates, j, batch.column(j))
+        started = time.perf_counter()
+        aggregate_seconds += started - parsed
+        budget.add_cpu(time.thread_time() - cpu_started)
+
+    _mark_non_numeric(aggregates, indices, numeric, num_rows)
+    metrics.observe_analysis("arrow", num_rows, size, parse_seconds, aggregate_seconds)
+    tracing.set_attributes(**{"analyze.rows": num_rows})
+    tracing.record_phases([("analyze.parse", parse_seconds), ("analyze.aggregate", aggregate_seconds)])
+
+    return build_response(
+        filename, header, selected_columns, _preview(header, preview_batch), aggregates.results(header, indices),
+        format="arrow",
+        **budget.report(),
+    )
+
+
+def analyze_arrow(file_path, filename, selected_columns, kind, budget):
+    import pyarrow as pa
+
+    if kind == "feather":
+        import pyarrow.feather as feather
+        table = feather.read_table(file_path, memory_map=True)
+        return _aggregate_arrow(filename, os.path.getsize(file_path), table.schema, table.to_batches(), selected_columns, budget)
+
+    with pa.memory_map(file_path) as source:
+        reader = pa.ipc.open_stream(source) if kind == "arrow_stream" else pa.ipc.open_file(source)
+        return _aggregate_arrow(filename, os.path.getsize(file_path), reader.schema, _record_batches(reader, kind), selected_columns, budget)
+
+
+@tracing.traced("analyze.columnar")
+def analyze(file_path, filename, selected_columns, kind, budget: limits.Budget = None):
+    import pyarrow as pa
+
+    budget = budget or limits.Budget()
+    try:
+        if kind == "parquet":
+            return analyze_parquet(file_path, filename, selected_columns, budget)
+        return analyze_arrow(file_path, filename, selected_columns, kind, budget)
+    except (pa.ArrowException, OSError):
+        raise HTTPException(status_code=400, detail="Файл повреждён или имеет неподдерживаемую структуру")
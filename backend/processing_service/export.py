@@ -0,0 +1,349 @@
+"""Потоковая выгрузка производных наборов данных.
+
+Из исходного файла можно выбрать столбцы, отфильтровать строки или посчитать
+агрегаты по группам. Строки читаются и записываются порциями, поэтому память
+не зависит от размера файла (для агрегатов — только от числа групп).
+"""
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+
+from fastapi import HTTPException
+
+from analysis import ColumnAggregates, check_columns
+from common import csvio, tracing
+
+CHUNK_SIZE = 64 * 1024
+BATCH_ROWS = 1000
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", ".csv"),
+    "ndjson": ("application/x-ndjson", ".ndjson"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+_FILTER_RE = re.compile(r"^\s*(.+?)\s*(>=|<=|!=|=|>|<)\s*(.*?)\s*$")
+
+
+def get_data_service_url():
+    return os.getenv("DATA_SERVICE_URL", "http://data-service:8001")
+
+
+def resolve_column(name, header):
+    """Столбец по номеру (начиная с 1) или по имени из заголовка"""
+    if name.isdigit() and 1 <= int(name) <= len(header):
+        return int(name) - 1
+    if name in header:
+        return header.index(name)
+    raise HTTPException(status_code=400, detail=f"Неизвестный столбец: {name}")
+
+
+def parse_filters(where, header):
+    filters = []
+    for expression in where or []:
+        match = _FILTER_RE.match(expression)
+        if not match:
+            raise HTTPException(status_code=400, detail=f"Некорректное условие фильтра: {expression}")
+        column, op, value = match.groups()
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+        filters.append((resolve_column(column, header), op, value, number))
+    return filters
+
+
+def _compare(cell, op, value, number):
+    if number is not None:
+        try:
+            cell, value = float(cell), number
+        except (ValueError, TypeError):
+            if op not in ("=", "!="):
+                return False
+    if cell is None:
+        return op == "!="
+    if op == "=":
+        return cell == value
+    if op == "!=":
+        return cell != value
+    if isinstance(cell, str) != isinstance(value, str):
+        return False
+    if op == ">":
+        return cell > value
+    if op == ">=":
+        return cell >= value
+    if op == "<":
+        return cell < value
+    return cell <= value
+
+
+def matches(row, filters):
+    for j, op, value, number in filters:
+        cell = row[j] if j < len(row) else None
+        if not _compare(cell, op, value, number):
+            return False
+    return True
+
+
+def read_header(file_path, filename, kind):
+    """Имена и типы столбцов: у CSV все столбцы "string", у колоночных форматов — типы Arrow"""
+    if kind is None:
+        fmt = csvio.sniff(file_path, filename)
+        with csvio.open_text(file_path, fmt) as stream:
+            header = next(csvio.reader(stream, fmt), None)
+        if header is None:
+            raise HTTPException(status_code=400, detail="Файл пустой")
+        return header, ["string"] * len(header)
+    schema = _columnar_schema(file_path, kind)
+    return schema.names, list(schema.types)
+
+
+def _columnar_schema(file_path, kind):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if kind == "parquet":
+        return pq.ParquetFile(file_path).schema_arrow
+    if kind == "feather":
+        import pyarrow.feather as feather
+        return feather.read_table(file_path, memory_map=True).schema
+    with pa.memory_map(file_path) as source:
+        reader = pa.ipc.open_stream(source) if kind == "arrow_stream" else pa.ipc.open_file(source)
+        return reader.schema
+
+
+def iter_rows(file_path, filename, kind, header, needed):
+    """Строки исходного файла; для колоночных форматов читаются только нужные столбцы"""
+    if kind is None:
+        fmt = csvio.sniff(file_path, filename)
+        with csvio.open_text(file_path, fmt) as stream:
+            reader = csvio.reader(stream, fmt)
+            next(reader, None)
+            yield from reader
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = [header[j] for j in needed]
+
+    def rows_from(batches):
+        for batch in batches:
+            columns = [batch.column(name).to_pylist() for name in names]
+            for values in zip(*columns):
+                row = [None] * len(header)
+                for j, value in zip(needed, values):
+                    row[j] = value
+                yield row
+
+    if kind == "parquet":
+        yield from rows_from(pq.ParquetFile(file_path).iter_batches(batch_size=BATCH_ROWS, columns=names))
+    elif kind == "feather":
+        import pyarrow.feather as feather
+        yield from rows_from(feather.read_table(file_path, columns=names, memory_map=True).to_batches(BATCH_ROWS))
+    else:
+        with pa.memory_map(file_path) as source:
+            if kind == "arrow_stream":
+                yield from rows_from(pa.ipc.open_stream(source))
+            else:
+                reader = pa.ipc.open_file(source)
+                yield from rows_from(reader.get_batch(i) for i in range(reader.num_record_batches))
+
+
+class DerivedDataset:
+    """Описание производного набора: заголовок, типы столбцов и генератор строк.
+    Тип — "string", "int", "float" или тип Arrow столбца колоночного источника"""
+
+    def __init__(self, header, types, rows):
+        self.header = header
+        self.types = types
+        self.rows = rows
+
+
+def derive(file_path, filename, kind, selected_columns, where, group_by):
+    header, source_types = read_header(file_path, filename, kind)
+    indices = check_columns(selected_columns, len(header))
+    filters = parse_filters(where, header)
+    group = resolve_column(group_by, header) if group_by else None
+    if group is not None:
+        indices = [j for j in indices if j != group]
+
+    needed = sorted(set(indices) | {j for j, _, _, _ in filters} | ({group} if group is not None else set()))
+    rows = (row for row in iter_rows(file_path, filename, kind, header, needed) if matches(row, filters))
+
+    if group is None:
+        def projected():
+            for row in rows:
+                yield [row[j] if j < len(row) else None for j in indices]
+        return DerivedDataset([header[j] for j in indices], [source_types[j] for j in indices], projected())
+
+    out_header = [header[group], "count"]
+    for j in indices:
+        out_header += [f"{header[j]}_sum", f"{header[j]}_average", f"{header[j]}_max"]
+    types = [source_types[group], "int"] + ["float"] * (len(out_header) - 2)
+
+    def grouped():
+        groups = {}
+        for row in rows:
+            key = row[group] if group < len(row) else None
+            entry = groups.get(key)
+            if entry is None:
+                entry = groups[key] = [ColumnAggregates(len(header)), 0]
+            entry[0].add_row(row, indices)
+            entry[1] += 1
+        for key, (aggregates, count) in groups.items():
+            out = [key, count]
+            for j in indices:
+                if aggregates.counts[j]:
+                    out += [aggregates.sums[j], aggregates.sums[j] / aggregates.counts[j], aggregates.maxima[j]]
+                else:
+                    out += [None, None, None]
+            yield out
+
+    return DerivedDataset(out_header, types, grouped())
+
+
+def _plain(value):
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+
+def write_csv(dataset):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(dataset.header)
+    for row in dataset.rows:
+        writer.writerow(["" if value is None else value for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def write_ndjson(dataset):
+    chunk = []
+    size = 0
+    for row in dataset.rows:
+        line = json.dumps({name: _plain(value) for name, value in zip(dataset.header, row)}, ensure_ascii=False) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(chunk).encode("utf-8")
+            chunk, size = [], 0
+    yield "".join(chunk).encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файлоподобный приёмник, из которого записанные байты забираются порциями"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def write_parquet(dataset):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {"string": pa.string(), "int": pa.int64(), "float": pa.float64()}
+    # Типы колоночного источника переносятся как есть; строками становятся только столбцы CSV
+    types = [arrow_types[t] if isinstance(t, str) else t for t in dataset.types]
+    schema = pa.schema([(name, t) for name, t in zip(dataset.header, types)])
+
+    def to_batch(rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in dataset.header]
+        arrays = []
+        for values, t, declared in zip(columns, types, dataset.types):
+            if declared == "string":
+                values = [None if value is None else str(value) for value in values]
+            arrays.append(pa.array(values, type=t))
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    rows = []
+    for row in dataset.rows:
+        rows.append(row)
+        if len(rows) >= BATCH_ROWS:
+            # Каждая порция — отдельная группа строк, поэтому её байты можно сразу отдать
+            writer.write_batch(to_batch(rows))
+            rows = []
+            yield sink.drain()
+    if rows:
+        writer.write_batch(to_batch(rows))
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {"csv": write_csv, "ndjson": write_ndjson, "parquet": write_parquet}
+
+
+@tracing.traced("export.save_to_storage")
+def save_to_storage(chunks, storage_dir, target):
+    """Записывает выгрузку во временный файл и публикует его под именем target.
+    Публикация — жёсткая ссылка: файл, появившийся под этим именем раньше, не
+    заменяется, а запрос получает 409"""
+    final_path = os.path.join(storage_dir, target)
+    # Уникальное имя: параллельные выгрузки в один target не пишут в общий файл
+    fd, temp_path = tempfile.mkstemp(dir=storage_dir, prefix=f".{target}.", suffix=".part")
+    try:
+        # mkstemp создаёт файл с правами 0600, а читает выгрузку data_service
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        try:
+            os.link(temp_path, final_path)
+        except FileExistsError:
+            raise HTTPException(status_code=409, detail="Файл с таким именем уже существует")
+    finally:
+        os.remove(temp_path)
+    return final_path
+
+
+@tracing.traced("export.register_derived")
+def register_derived(target, output_format, source_filename, operation, title=None, description=None, authorization=None):
+    """Регистрирует сохранённую выгрузку в data_service вместе с происхождением;
+    authorization — заголовок пользователя, от имени которого сделана выгрузка.
+    Любой сбой вызова или отказ data_service — 502"""
+    # requests, как и pyarrow, загружается при первой выгрузке, а не при старте сервиса
+    import requests
+
+    filetype = "csv" if output_format == "csv" else "parquet" if output_format == "parquet" else "other"
+    try:
+        response = requests.post(
+            f"{get_data_service_url()}/files/derived",
+            json={
+                "filename": target,
+                "filetype": filetype,
+                "title": title,
+                "description": description,
+                "source_filename": source_filename,
+                "operation": operation,
+            },
+            headers=tracing.inject_headers({"Authorization": authorization} if authorization else {}),
+            timeout=10,
+        )
+        response.raise_for_status()
+    except requests.RequestException:
+        raise HTTPException(status_code=502, detail="Не удалось зарегистрировать файл в data_service")
+    return response.json()
@@ -0,0 +1,68 @@
+"""Реакция на события жизненного цикла файлов из data_service (см. common/events.py).
+
+После загрузки CSV сразу выполняется полный анализ всех столбцов: его состояние
+сохраняется для дозаписи, и первый запрос /analyze без выбора столбцов
+дочитывает только новые строки. Прогрев не занимает слот, если все слоты
+заняты пользовательскими анализами: он просто пропускается.
+При удалении и повторной загрузке файла его состояния и сессии забываются.
+После дозаписи (file.updated) забываются только сессии приближённого анализа,
+а сохранённое состояние дочитывает новые строки тем же прогревом.
+"""
+import os
+
+from fastapi import HTTPException
+
+import analysis
+import approx
+import limits
+from common import csvio, events, tracing
+
+
+def evict(file_path):
+    analysis.forget(file_path)
+    approx.forget(file_path)
+
+
+@tracing.traced("events.file_uploaded")
+def on_uploaded(file_path, event):
+    evict(file_path)
+    warm_up(file_path, event)
+
+
+@tracing.traced("events.file_updated")
+def on_updated(file_path, event):
+    approx.forget(file_path)
+    warm_up(file_path, event)
+
+
+def warm_up(file_path, event):
+    if event.get("filetype") != "csv" or not os.path.exists(file_path):
+        return
+    try:
+        slot = limits.acquire_slot()
+    except HTTPException:
+        return
+    try:
+        fmt = csvio.sniff(file_path, event["filename"])
+        analysis.analyze_csv(file_path, event["filename"], None, fmt, limits.Budget.from_env())
+    except (HTTPException, OSError, EOFError):
+        # Файл, который не анализируется, получит ту же ошибку и при запросе пользователя
+        pass
+    finally:
+        limits.release_slot(slot)
+
+
+def on_deleted(file_path, event):
+    evict(file_path)
+
+
+def handlers(get_storage_dir):
+    """Обработчики для events.Subscriber; путь к storage берётся в момент события"""
+    def resolve(handler):
+        return lambda event: handler(os.path.join(get_storage_dir(), event["filename"]), event)
+
+    return {
+        events.FILE_UPLOADED: resolve(on_uploaded),
+        events.FILE_UPDATED: resolve(on_updated),
+        events.FILE_DELETED: resolve(on_deleted),
+    }
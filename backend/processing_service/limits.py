@@ -0,0 +1,160 @@
+"""Ограничения ресурсов на один запрос анализа.
+
+Бюджеты задаются переменными окружения (0 — без ограничения):
+
+    ANALYZE_MAX_WALL_SECONDS   — время выполнения (по умолчанию 30)
+    ANALYZE_MAX_CPU_SECONDS    — процессорное время потока анализа (по умолчанию 10)
+    ANALYZE_MAX_ROWS           — число строк (по умолчанию без ограничения)
+    ANALYZE_MAX_MEMORY_MB      — объём строк в памяти: превью и текущая порция (по умолчанию 64)
+    ANALYZE_MAX_COLUMNS        — ширина заголовка CSV (по умолчанию 10000)
+    ANALYZE_MAX_CONCURRENT     — одновременных анализов на процесс (по умолчанию 2);
+                                 с SHARED_STATE_DIR — на все рабочие процессы пода
+
+Запрос может только ужесточить время и число строк (параметры max_seconds и max_rows).
+Превышение бюджета не является ошибкой: анализ останавливается на границе порции
+строк и возвращает накопленный результат с флагом partial.
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from common import sharedstate
+
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+def _env_number(name, default, cast=float):
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+
+def _tightest(configured, requested):
+    if not requested:
+        return configured
+    return min(configured, requested) if configured else requested
+
+
+class Budget:
+    def __init__(self, wall_seconds=0.0, cpu_seconds=0.0, rows=0, memory_bytes=0, columns=0):
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.rows = rows
+        self.memory_bytes = memory_bytes
+        self.columns = columns
+        self.started = time.perf_counter()
+        self.cpu_used = 0.0
+        self.exceeded = None
+        self._cancelled = threading.Event()
+
+    @classmethod
+    def from_env(cls, max_seconds=None, max_rows=None):
+        return cls(
+            wall_seconds=_tightest(_env_number("ANALYZE_MAX_WALL_SECONDS", 30.0), max_seconds),
+            cpu_seconds=_env_number("ANALYZE_MAX_CPU_SECONDS", 10.0),
+            rows=_tightest(_env_number("ANALYZE_MAX_ROWS", 0, int), max_rows),
+            memory_bytes=_env_number("ANALYZE_MAX_MEMORY_MB", 64.0) * 2 ** 20,
+            columns=_env_number("ANALYZE_MAX_COLUMNS", 10000, int),
+        )
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def add_cpu(self, seconds):
+        """Порции могут выполняться в разных потоках пула, поэтому время потока копится по порциям"""
+        self.cpu_used += seconds
+
+    def check_columns(self, col_count):
+        if self.columns and col_count > self.columns:
+            raise HTTPException(status_code=413, detail=f"Слишком много столбцов: {col_count} (допустимо {self.columns})")
+
+    def check(self, rows, memory_bytes=0):
+        """Имя превышенного бюджета или None; результат запоминается в exceeded"""
+        if self.cancelled:
+            self.exceeded = "cancelled"
+        elif self.wall_seconds and time.perf_counter() - self.started > self.wall_seconds:
+            self.exceeded = "wall_time"
+        elif self.cpu_seconds and self.cpu_used > self.cpu_seconds:
+            self.exceeded = "cpu_time"
+        elif self.rows and rows >= self.rows:
+            self.exceeded = "rows"
+        elif self.memory_bytes and memory_bytes > self.memory_bytes:
+            self.exceeded = "memory"
+        return self.exceeded
+
+    def rows_left(self, rows, batch_rows):
+        """Размер следующей порции, чтобы не прочитать строк больше бюджета"""
+        return min(batch_rows, self.rows - rows) if self.rows else batch_rows
+
+    def report(self):
+        return {"partial": self.exceeded is not None, "limit_exceeded": self.exceeded}
+
+
+# Бюджет памяти рассчитан на под, поэтому слоты общие для его рабочих процессов
+_slots = sharedstate.create_slots("analysis-slots", _env_number("ANALYZE_MAX_CONCURRENT", 2, int))
+
+
+def acquire_slot():
+    """Ограничивает число одновременных анализов; при нехватке слотов — 503 с Retry-After.
+    Возвращает маркер слота для release_slot"""
+    token = _slots.try_acquire()
+    if token is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервис занят другими анализами, повторите запрос позже",
+            headers={"Retry-After": "1"},
+        )
+    return token
+
+
+def release_slot(token):
+    _slots.release(token)
+
+
+@contextmanager
+def analysis_slot():
+    token = acquire_slot()
+    try:
+        yield
+    finally:
+        release_slot(token)
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """Потоковый ответ, который освобождает слот token, когда передача закончена
+    или прервана — в том числе если клиент отключился до первого события"""
+
+    def __init__(self, token, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.token = token
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            release_slot(self.token)
+
+
+async def run_cancellable(request: Request, budget: Budget, fn, *args):
+    """Выполняет анализ в пуле потоков, не блокируя цикл событий;
+    если клиент отключился, бюджет отменяется и анализ останавливается на ближайшей порции"""
+
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+        budget.cancel()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        return await run_in_threadpool(fn, *args)
+    finally:
+        watcher.cancel()
@@ -1,8 +1,15 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-import csv, os
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from typing import List
+from urllib.parse import quote
+from common import auth, csvio, events, filetypes, metrics, profiling, ratelimit, tracing
+import analysis, approx, columnar, export, lifecycle, limits
+import os
 
-app = FastAPI()
+# Токен проверяется локально, отзыв — пакетно через auth_service (см. common/auth.py)
+app = FastAPI(dependencies=[Depends(auth.current_user)])
 
 app.add_middleware(
     CORSMiddleware,
@@ -12,91 +19,198 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+ratelimit.install(app, expensive_routes=(r"/analyze/", r"/export/"))
+metrics.install(app)
+tracing.install(app, "processing-service")
+profiling.install(app, "processing-service", profile_paths=("/analyze",))
+
 def get_storage_dir():
     """Получает путь к папке storage из переменной окружения"""
     return os.getenv("STORAGE_DIR", "/app/storage")
 
-@app.get("/analyze/{filename}")
-async def analyze_file(filename: str, columns: str = Query(None, description="Номера столбцов через запятую, начиная с 1")):
+# Подписка на file.uploaded/file.updated/file.deleted из data_service: прогрев и очистка кэшей анализа
+events.install(app, lifecycle.handlers(lambda: get_storage_dir()))
+
+def parse_columns(columns):
+    if not columns:
+        return None
+    try:
+        return [int(i) - 1 for i in columns.split(",") if i.strip().isdigit()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный формат параметра columns")
+
+def resolve_source(filename, encoding, delimiter):
+    """Путь к файлу, тип колоночного формата (или None) и формат CSV"""
     file_path = os.path.join(get_storage_dir(), filename)
 
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Файл не найден")
 
-    selected_columns = None
-    if columns:
+    try:
+        if encoding:
+            encoding = csvio.normalize_encoding(encoding)
+        if delimiter:
+            delimiter = csvio.normalize_delimiter(delimiter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    kind = filetypes.sniff_columnar(file_path, filename)
+    if kind is not None:
+        return file_path, kind, None
+
+    try:
+        fmt = csvio.sniff(file_path, filename, encoding=encoding, delimiter=delimiter)
+    except (OSError, EOFError):
+        raise HTTPException(status_code=400, detail="Некорректный gzip-архив")
+    return file_path, None, fmt
+
+@app.get("/analyze/{filename}")
+async def analyze_file(
+    request: Request,
+    filename: str,
+    columns: str = Query(None, description="Номера столбцов через запятую, начиная с 1"),
+    encoding: str = Query(None, description="Кодировка файла; по умолчанию определяется автоматически"),
+    delimiter: str = Query(None, description="Разделитель столбцов (например ';' или 'tab'); по умолчанию определяется по заголовку"),
+    mode: str = Query("exact", pattern="^(exact|approx)$", description="approx — оценка по случайной выборке блоков с доверительными интервалами"),
+    session: str = Query(None, description="Сессия приближённого анализа для уточнения предыдущей оценки"),
+    max_seconds: float = Query(None, gt=0, le=30, description="Бюджет времени: в режиме approx — на чтение блоков (по умолчанию 1 с), иначе — предел времени анализа"),
+    max_rows: int = Query(None, gt=0, description="Предел числа строк; при превышении возвращается частичный результат"),
+    target_error: float = Query(0.01, ge=0, le=1, description="Относительная полуширина интервала для сумм, при которой чтение останавливается"),
+    seed: int = Query(None, description="Зерно порядка блоков (для воспроизводимости)"),
+):
+    file_path, kind, fmt = resolve_source(filename, encoding, delimiter)
+    selected_columns = parse_columns(columns)
+
+    if mode == "approx" and kind is None:
+        # Чтение блоков ограничено собственным бюджетом времени, но занимает слот анализа наравне с точным
+        with limits.analysis_slot():
+            return await run_in_threadpool(approx.analyze, file_path, filename, selected_columns, fmt, session, max_seconds or 1.0, target_error, seed)
+
+    budget = limits.Budget.from_env(max_seconds, max_rows)
+    with limits.analysis_slot():
+        if kind is not None:
+            # Для Parquet и Arrow точный ответ и так берётся из статистик и нужных столбцов
+            return await limits.run_cancellable(request, budget, columnar.analyze, file_path, filename, selected_columns, kind, budget)
+        return await limits.run_cancellable(request, budget, analysis.analyze_csv, file_path, filename, selected_columns, fmt, budget)
+
+@app.get("/analyze/{filename}/stream")
+async def analyze_file_stream(
+    filename: str,
+    columns: str = Query(None, description="Номера столбцов через запятую, начиная с 1"),
+    encoding: str = Query(None, description="Кодировка файла; по умолчанию определяется автоматически"),
+    delimiter: str = Query(None, description="Разделитель столбцов (например ';' или 'tab'); по умолчанию определяется по заголовку"),
+    interval: float = Query(0.5, ge=0, le=10, description="Минимальный интервал между событиями progress, секунды"),
+    max_seconds: float = Query(None, gt=0, description="Предел времени анализа"),
+    max_rows: int = Query(None, gt=0, description="Предел числа строк; при превышении result содержит частичный результат"),
+):
+    """Анализ с событиями Server-Sent Events: progress (прочитанные байты, строки,
+    промежуточные агрегаты), затем result с тем же телом, что у /analyze, или error.
+    Если клиент отключился, чтение файла прекращается на ближайшей порции строк."""
+    file_path, kind, fmt = resolve_source(filename, encoding, delimiter)
+    selected_columns = parse_columns(columns)
+    budget = limits.Budget.from_env(max_seconds, max_rows)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    if kind is not None:
+        # Результат колоночного файла готов до ответа; отдача одного события слота не занимает
+        with limits.analysis_slot():
+            result = await run_in_threadpool(columnar.analyze, file_path, filename, selected_columns, kind, budget)
+        return StreamingResponse(iter([analysis.sse_event("result", result)]), media_type="text/event-stream", headers=headers)
+
+    # Один слот на весь проход, включая открытие файла и чтение заголовка; его освобождает ответ
+    token = limits.acquire_slot()
+    try:
+        # Заголовок и номера столбцов проверяются до начала потока, чтобы ошибки вернулись обычным статусом
+        csv_analysis = await run_in_threadpool(analysis.CsvAnalysis, file_path, filename, selected_columns, fmt, budget)
+    except BaseException:
+        limits.release_slot(token)
+        raise
+    event_stream = analysis.stream_csv(csv_analysis, interval)
+
+    async def send_events():
         try:
-            selected_columns = [int(i) - 1 for i in columns.split(",") if i.strip().isdigit()]
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Некорректный формат параметра columns")
-
-    with open(file_path, "r", encoding="utf-8", newline="") as csvfile:
-        reader = csv.reader(csvfile)
-        preview_lines = []
-        header = next(reader, None)
-
-        if header is None:
-            raise HTTPException(status_code=400, detail="Файл пустой")
-
-        col_count = len(header)
-        
-        # Проверяем корректность номеров столбцов после чтения заголовка
-        if selected_columns:
-            for col in selected_columns:
-                if col < 0 or col >= col_count:
-                    raise HTTPException(status_code=400, detail="Некорректный номер столбца")
-        
-        numeric_sums = [0.0] * col_count
-        numeric_counts = [0] * col_count
-        numeric_max = [float("-inf")] * col_count
-        has_non_numeric = [False] * col_count
-
-        preview_lines.append(", ".join(header))
-
-        for row in reader:
-            preview_lines.append(", ".join(row))
-            for j, value in enumerate(row):
-                if selected_columns and j not in selected_columns:
-                    continue
-
-                try:
-                    num = float(value)
-                    numeric_sums[j] += num
-                    numeric_counts[j] += 1
-                    if num > numeric_max[j]:
-                        numeric_max[j] = num
-                except (ValueError, TypeError):
-                    has_non_numeric[j] = True
-                    continue
-
-        # Вычисления
-        results = []
-        for j in range(col_count):
-            if selected_columns and j not in selected_columns:
-                continue
-
-            if numeric_counts[j] == 0:
-                results.append({
-                    "column": header[j] if header else f"Колонка {j+1}",
-                    "sum": "невозможно определить" if has_non_numeric[j] else 0,
-                    "average": "невозможно определить",
-                    "max": "невозможно определить"
-                })
-            else:
-                results.append({
-                    "column": header[j] if header else f"Колонка {j+1}",
-                    "sum": round(numeric_sums[j], 2),
-                    "average": round(numeric_sums[j] / numeric_counts[j], 2),
-                    "max": round(numeric_max[j], 2)
-                })
-
-        return {
-            "filename": filename,
-            "columns_total": col_count,
-            "columns_selected": [header[i] for i in selected_columns] if selected_columns else "Все",
-            "preview": "\n".join(preview_lines),
-            "analysis": results
-        }
+            while True:
+                event = await run_in_threadpool(next, event_stream, None)
+                if event is None:
+                    break
+                yield event
+        except HTTPException as e:
+            yield analysis.sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+        finally:
+            # При отключении клиента генератор закрывается, и проход прерывается
+            event_stream.close()
+
+    return limits.SlotStreamingResponse(token, send_events(), media_type="text/event-stream", headers=headers)
+
+def prepare_export(filename, columns, where, group_by, output_format):
+    """Набор для выгрузки; определение формата и чтение заголовка или схемы
+    блокирующие, поэтому обработчики вызывают её в пуле потоков"""
+    file_path = os.path.join(get_storage_dir(), filename)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    if output_format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Неподдерживаемый формат выгрузки: {output_format}")
+
+    kind = filetypes.sniff_columnar(file_path, filename)
+    try:
+        return export.derive(file_path, filename, kind, parse_columns(columns), where, group_by)
+    except (OSError, EOFError):
+        raise HTTPException(status_code=400, detail="Не удалось прочитать файл")
+
+@app.get("/export/{filename}")
+async def export_file(
+    filename: str,
+    columns: str = Query(None, description="Номера столбцов через запятую, начиная с 1"),
+    where: List[str] = Query(None, description="Условия фильтра вида 'столбец>значение'; операторы =, !=, >, >=, <, <="),
+    group_by: str = Query(None, description="Номер или имя столбца для агрегатов по группам"),
+    format: str = Query("csv", description="csv, ndjson или parquet"),
+):
+    """Потоково отдаёт производный набор данных (chunked transfer)"""
+    dataset = await run_in_threadpool(prepare_export, filename, columns, where, group_by, format)
+    media_type, extension = export.FORMATS[format]
+    download_name = os.path.splitext(filename)[0] + "_export" + extension
+    return StreamingResponse(
+        export.WRITERS[format](dataset),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(download_name)}"},
+    )
+
+@app.post("/export/{filename}")
+async def save_export(
+    request: Request,
+    filename: str,
+    columns: str = Query(None, description="Номера столбцов через запятую, начиная с 1"),
+    where: List[str] = Query(None, description="Условия фильтра вида 'столбец>значение'; операторы =, !=, >, >=, <, <="),
+    group_by: str = Query(None, description="Номер или имя столбца для агрегатов по группам"),
+    format: str = Query("csv", description="csv, ndjson или parquet"),
+    target: str = Query(None, description="Имя нового файла в storage"),
+    title: str = Query(None),
+    description: str = Query(None),
+):
+    """Сохраняет производный набор как новый файл и регистрирует его в data_service"""
+    dataset = await run_in_threadpool(prepare_export, filename, columns, where, group_by, format)
+    extension = export.FORMATS[format][1]
+    target = target or os.path.splitext(filename)[0] + "_export" + extension
+    if os.path.basename(target) != target or target.startswith("."):
+        raise HTTPException(status_code=400, detail="Некорректное имя файла")
+
+    storage_dir = get_storage_dir()
+    if os.path.exists(os.path.join(storage_dir, target)):
+        raise HTTPException(status_code=409, detail="Файл с таким именем уже существует")
+
+    # Запись набора и вызов data_service блокирующие: они выполняются в пуле потоков.
+    # Имя могли занять после проверки выше — тогда save_to_storage отвечает 409, не заменяя файл
+    file_path = await run_in_threadpool(export.save_to_storage, export.WRITERS[format](dataset), storage_dir, target)
+    operation = {"columns": columns, "where": where, "group_by": group_by, "format": format}
+    try:
+        return await run_in_threadpool(
+            export.register_derived,
+            target, format, filename, operation, title, description, request.headers.get("authorization"),
+        )
+    except HTTPException:
+        # Файл создан этим запросом: save_to_storage не публикует поверх существующего
+        os.remove(file_path)
+        raise
 
 @app.get("/health")
 async def health_check():
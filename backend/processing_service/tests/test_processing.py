@@ -5,7 +5,8 @@ import sys
 from pathlib import Path
 from unittest.mock import patch
 
-# Добавляем родительский каталог в путь для импорта
+# Добавляем каталог сервиса и backend (общий пакет common) в путь для импорта
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from fastapi.testclient import TestClient
@@ -13,6 +14,7 @@ from unittest.mock import patch, mock_open
 import json
 
 from main import app
+import gzip
 
 @pytest.fixture
 def client():
@@ -176,6 +178,339 @@ class TestCSVAnalysis:
         assert score_col["average"] == 85.27
         assert score_col["max"] == 92.0
 
+class TestEncodingAndDialect:
+    """Тесты определения кодировки, разделителя и сжатия"""
+
+    def test_analyze_cp1251_semicolon(self, client, temp_storage):
+        """Файл в cp1251 с разделителем ';'"""
+        filename = "instrument.csv"
+        content = "образец;масса;температура\nА1;1.5;20\nБ2;2.5;30\n"
+        with open(os.path.join(temp_storage, filename), 'wb') as f:
+            f.write(content.encode('cp1251'))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["encoding"] == "cp1251"
+        assert data["delimiter"] == ";"
+        assert data["columns_total"] == 3
+
+        mass_col = next(col for col in data["analysis"] if col["column"] == "масса")
+        assert mass_col["sum"] == 4.0
+        assert mass_col["max"] == 2.5
+
+    def test_analyze_gzip_csv(self, client, temp_storage):
+        """Сжатый gzip CSV анализируется без распаковки на диск"""
+        filename = "compressed.csv.gz"
+        with gzip.open(os.path.join(temp_storage, filename), 'wt', encoding='utf-8') as f:
+            f.write("id,value\n1,10\n2,20\n3,30\n")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["compressed"] is True
+        value_col = next(col for col in data["analysis"] if col["column"] == "value")
+        assert value_col["sum"] == 60
+
+    def test_analyze_tsv(self, client, temp_storage):
+        """TSV файл определяется по расширению"""
+        filename = "table.tsv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write("a\tb\n1\t2\n3\t4\n")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["delimiter"] == "\t"
+        b_col = next(col for col in data["analysis"] if col["column"] == "b")
+        assert b_col["sum"] == 6
+
+    def test_analyze_utf8_bom(self, client, temp_storage):
+        """BOM не попадает в имя первого столбца"""
+        filename = "bom.csv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8-sig') as f:
+            f.write("value,other\n1,2\n")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+
+        assert response.status_code == 200
+        assert response.json()["analysis"][0]["column"] == "value"
+
+    def test_analyze_explicit_encoding_and_delimiter(self, client, temp_storage):
+        """Явно заданные кодировка и разделитель имеют приоритет"""
+        filename = "explicit.csv"
+        with open(os.path.join(temp_storage, filename), 'wb') as f:
+            f.write("x|y\n1|2\n".encode('latin-1'))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}?encoding=latin-1&delimiter=|")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["encoding"] == "iso8859-1"
+        assert data["delimiter"] == "|"
+
+    def test_analyze_unknown_encoding(self, client, sample_csv_file, temp_storage):
+        """Неизвестная кодировка"""
+        filename, filepath = sample_csv_file
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}?encoding=no-such-codec")
+
+        assert response.status_code == 400
+        assert "Неизвестная кодировка" in response.json()["detail"]
+
+class TestColumnarAnalysis:
+    """Тесты анализа Parquet и Arrow файлов"""
+
+    @pytest.fixture
+    def sample_table(self):
+        import pyarrow as pa
+        return pa.table({
+            "name": ["John", "Jane", "Bob", "Alice"],
+            "age": [25, 30, 35, 28],
+            "score": [85.5, None, 78.3, 90.0],
+            "flag": [1, 1, 1, 1],
+        })
+
+    def test_analyze_parquet(self, client, temp_storage, sample_table):
+        """Анализ Parquet файла из нескольких групп строк"""
+        import pyarrow.parquet as pq
+        filename = "data.parquet"
+        pq.write_table(sample_table, os.path.join(temp_storage, filename), row_group_size=2)
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["format"] == "parquet"
+        assert data["columns_total"] == 4
+        assert data["columns_selected"] == "Все"
+        assert data["row_groups_total"] == 2
+        assert "name, age, score, flag" in data["preview"]
+
+        stats = {col["column"]: col for col in data["analysis"]}
+        assert stats["age"]["sum"] == 118
+        assert stats["age"]["average"] == 29.5
+        assert stats["age"]["max"] == 35
+        assert stats["score"]["sum"] == 253.8
+        assert stats["score"]["average"] == 84.6
+        assert stats["name"]["sum"] == "невозможно определить"
+
+    def test_analyze_parquet_constant_column_from_statistics(self, client, temp_storage, sample_table):
+        """Постоянный столбец считается по статистике футера без чтения данных"""
+        import pyarrow.parquet as pq
+        filename = "constant.parquet"
+        pq.write_table(sample_table, os.path.join(temp_storage, filename), row_group_size=2)
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}?columns=4")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["columns_selected"] == ["flag"]
+        assert data["chunks_from_statistics"] == 2
+        assert data["analysis"] == [{"column": "flag", "sum": 4, "average": 1.0, "max": 1}]
+
+    def test_analyze_parquet_max_from_statistics(self, client, temp_storage, sample_table):
+        """Максимум и количество берутся из статистики; данные читаются только для суммы"""
+        import pyarrow.parquet as pq
+        filename = "max_stats.parquet"
+        pq.write_table(sample_table, os.path.join(temp_storage, filename), row_group_size=2)
+
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('pyarrow.compute.max', side_effect=AssertionError("максимум считается по данным")):
+            response = client.get(f"/analyze/{filename}?columns=2,3")
+
+        assert response.status_code == 200
+        stats = {col["column"]: col for col in response.json()["analysis"]}
+        assert stats["age"] == {"column": "age", "sum": 118, "average": 29.5, "max": 35}
+        assert stats["score"]["max"] == 90.0
+        assert stats["score"]["average"] == 84.6
+
+    def test_analyze_parquet_invalid_column(self, client, temp_storage, sample_table):
+        """Неверный номер столбца для Parquet"""
+        import pyarrow.parquet as pq
+        filename = "invalid_column.parquet"
+        pq.write_table(sample_table, os.path.join(temp_storage, filename))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}?columns=9")
+
+        assert response.status_code == 400
+        assert "Некорректный номер столбца" in response.json()["detail"]
+
+    def test_analyze_arrow_ipc_and_feather(self, client, temp_storage, sample_table):
+        """Arrow IPC (file и stream) и Feather дают тот же результат"""
+        import pyarrow as pa
+        import pyarrow.feather as feather
+
+        with pa.OSFile(os.path.join(temp_storage, "data.arrow"), "wb") as sink:
+            with pa.ipc.new_file(sink, sample_table.schema) as writer:
+                for batch in sample_table.to_batches(max_chunksize=3):
+                    writer.write_batch(batch)
+        with pa.OSFile(os.path.join(temp_storage, "data.arrows"), "wb") as sink:
+            with pa.ipc.new_stream(sink, sample_table.schema) as writer:
+                writer.write_table(sample_table)
+        feather.write_feather(sample_table, os.path.join(temp_storage, "data.feather"))
+
+        for filename in ("data.arrow", "data.arrows", "data.feather"):
+            with patch('main.get_storage_dir', return_value=temp_storage):
+                response = client.get(f"/analyze/{filename}?columns=2,3")
+
+            assert response.status_code == 200
+            data = response.json()
+            assert data["format"] == "arrow"
+            assert data["columns_selected"] == ["age", "score"]
+            assert data["analysis"][0] == {"column": "age", "sum": 118, "average": 29.5, "max": 35}
+            assert data["analysis"][1]["sum"] == 253.8
+
+    def test_analyze_corrupted_parquet(self, client, temp_storage):
+        """Повреждённый Parquet файл"""
+        filename = "broken.parquet"
+        with open(os.path.join(temp_storage, filename), 'wb') as f:
+            f.write(b"PAR1" + b"\x00" * 32 + b"PAR1")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+
+        assert response.status_code == 400
+
+class TestExport:
+    """Тесты потоковой выгрузки производных наборов"""
+
+    @pytest.fixture
+    def export_csv_file(self, temp_storage):
+        filename = "export_source.csv"
+        content = "name,city,salary\nJohn,London,50000\nJane,Paris,60000\nBob,London,70000\n"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write(content)
+        return filename
+
+    def test_export_selected_columns_csv(self, client, temp_storage, export_csv_file):
+        """Выгрузка выбранных столбцов в CSV"""
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/export/{export_csv_file}?columns=1,3")
+
+        assert response.status_code == 200
+        assert "text/csv" in response.headers["content-type"]
+        assert response.text.splitlines() == ["name,salary", "John,50000", "Jane,60000", "Bob,70000"]
+
+    def test_export_filtered_rows_ndjson(self, client, temp_storage, export_csv_file):
+        """Фильтрация строк и выгрузка в NDJSON"""
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/export/{export_csv_file}", params={"where": ["salary>=60000", "city=London"], "format": "ndjson"})
+
+        assert response.status_code == 200
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert rows == [{"name": "Bob", "city": "London", "salary": "70000"}]
+
+    def test_export_group_aggregates_parquet(self, client, temp_storage, export_csv_file):
+        """Агрегаты по группам в формате Parquet"""
+        import io
+        import pyarrow.parquet as pq
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/export/{export_csv_file}?group_by=city&columns=3&format=parquet")
+
+        assert response.status_code == 200
+        table = pq.read_table(io.BytesIO(response.content))
+        rows = {row["city"]: row for row in table.to_pylist()}
+        assert rows["London"]["count"] == 2
+        assert rows["London"]["salary_sum"] == 120000
+        assert rows["London"]["salary_max"] == 70000
+        assert rows["Paris"]["salary_average"] == 60000
+
+    def test_export_parquet_keeps_source_types(self, client, temp_storage):
+        """Выгрузка Parquet из Parquet сохраняет типы столбцов источника"""
+        import io
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        source = pa.table({"name": ["John", "Jane"], "age": [25, 30], "score": [85.5, None]})
+        pq.write_table(source, os.path.join(temp_storage, "typed.parquet"))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get("/export/typed.parquet?where=age>20&format=parquet")
+
+        assert response.status_code == 200
+        table = pq.read_table(io.BytesIO(response.content))
+        assert table.schema.types == [pa.string(), pa.int64(), pa.float64()]
+        assert table.to_pylist() == source.to_pylist()
+
+    def test_export_invalid_filter(self, client, temp_storage, export_csv_file):
+        """Фильтр по несуществующему столбцу"""
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/export/{export_csv_file}?where=missing>1")
+
+        assert response.status_code == 400
+        assert "Неизвестный столбец" in response.json()["detail"]
+
+    def test_export_unknown_format(self, client, temp_storage, export_csv_file):
+        """Неподдерживаемый формат выгрузки"""
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/export/{export_csv_file}?format=xlsx")
+
+        assert response.status_code == 400
+
+    def test_save_export_registers_lineage(self, client, temp_storage, export_csv_file):
+        """Сохранение выгрузки в storage и регистрация в data_service"""
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('requests.post') as post:
+            post.return_value.json.return_value = {"filename": "london.csv"}
+            response = client.post(f"/export/{export_csv_file}?where=city=London&target=london.csv")
+
+        assert response.status_code == 200
+        with open(os.path.join(temp_storage, "london.csv"), encoding='utf-8') as f:
+            assert f.read().splitlines() == ["name,city,salary", "John,London,50000", "Bob,London,70000"]
+
+        payload = post.call_args.kwargs["json"]
+        assert payload["source_filename"] == export_csv_file
+        assert payload["operation"]["where"] == ["city=London"]
+        assert payload["filetype"] == "csv"
+
+    def test_save_export_registration_failure(self, client, temp_storage, export_csv_file):
+        """Если data_service недоступен — 502, а сохранённый этим запросом файл удаляется"""
+        import requests
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('requests.post', side_effect=requests.ConnectionError("нет соединения")):
+            response = client.post(f"/export/{export_csv_file}?target=lost.csv")
+
+        assert response.status_code == 502
+        assert os.listdir(temp_storage) == [export_csv_file]
+
+    def test_save_export_existing_target(self, client, temp_storage, export_csv_file):
+        """Сохранение поверх существующего файла запрещено"""
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.post(f"/export/{export_csv_file}?target={export_csv_file}")
+
+        assert response.status_code == 409
+
+    def test_save_export_does_not_replace_concurrent_file(self, temp_storage):
+        """Файл, появившийся под тем же именем во время записи выгрузки, не заменяется"""
+        import export
+        from fastapi import HTTPException
+
+        def chunks():
+            yield b"a,b\n"
+            with open(os.path.join(temp_storage, "out.csv"), "w") as f:
+                f.write("winner\n")
+            yield b"1,2\n"
+
+        with pytest.raises(HTTPException) as error:
+            export.save_to_storage(chunks(), temp_storage, "out.csv")
+        assert error.value.status_code == 409
+        with open(os.path.join(temp_storage, "out.csv")) as f:
+            assert f.read() == "winner\n"
+        assert os.listdir(temp_storage) == ["out.csv"]
+
 class TestCSVPreview:
     """Тесты предварительного просмотра CSV"""
     
@@ -347,6 +682,690 @@ John,25,50000"""
         assert value_col["average"] == 1333333333333333.0
         assert value_col["max"] == 2000000000000000
 
+class TestIncrementalAnalysis:
+    """Тесты повторного анализа дописываемых файлов"""
+
+    def test_second_analysis_reads_only_tail(self, client, temp_storage):
+        """После дозаписи обрабатываются только новые строки, агрегаты сливаются с прежними"""
+        filename = "growing.csv"
+        path = os.path.join(temp_storage, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("id,value\n1,10\n2,20\n")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            first = client.get(f"/analyze/{filename}").json()
+            size = os.path.getsize(path)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("3,50\n")
+            second = client.get(f"/analyze/{filename}").json()
+
+        assert first["resumed_from_offset"] == 0
+        assert second["resumed_from_offset"] == size
+        assert second["rows_total"] == 3
+        value = second["analysis"][1]
+        assert value == {"column": "value", "sum": 80, "average": 26.67, "max": 50}
+        assert second["preview"].splitlines()[-1] == "3, 50"
+
+    def test_rewritten_file_is_analyzed_from_start(self, client, temp_storage):
+        """Перезаписанный (а не дописанный) файл анализируется заново"""
+        filename = "rewritten.csv"
+        path = os.path.join(temp_storage, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("id,value\n1,10\n2,20\n")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            client.get(f"/analyze/{filename}")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("id,value\n7,70\n8,80\n9,90\n")
+            data = client.get(f"/analyze/{filename}").json()
+
+        assert data["resumed_from_offset"] == 0
+        assert data["analysis"][1]["sum"] == 240
+
+    def test_concurrent_resumed_passes_do_not_share_state(self, client, temp_storage):
+        """Два одновременных прохода по дописанному файлу дочитывают хвост каждый в свою копию состояния"""
+        import analysis
+        from common import csvio
+        filename = "concurrent.csv"
+        path = os.path.join(temp_storage, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("id,value\n" + "".join(f"{i},1\n" for i in range(100)))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            client.get(f"/analyze/{filename}")
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("".join(f"{i},1\n" for i in range(100, 2100)))
+
+            fmt = csvio.sniff(path, filename)
+            with patch('analysis.BATCH_ROWS', 100):
+                runs = [analysis.CsvAnalysis(path, filename, None, fmt) for _ in range(2)]
+                passes = [run.batches() for run in runs]
+                # Порции двух проходов чередуются, как в двух потоках
+                while passes:
+                    for batches in list(passes):
+                        if next(batches, StopIteration) is StopIteration:
+                            passes.remove(batches)
+
+            results = [run.result() for run in runs]
+            again = client.get(f"/analyze/{filename}").json()
+
+        for data in results + [again]:
+            assert data["rows_total"] == 2100
+            assert data["analysis"][1]["sum"] == 2100
+
+class TestAnalysisStream:
+    """Тесты потокового анализа с событиями прогресса"""
+
+    @staticmethod
+    def parse_events(text):
+        events = []
+        for block in text.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    def test_progress_then_result(self, client, temp_storage):
+        """События progress с растущим числом строк, последнее событие — полный результат"""
+        filename = "stream.csv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write("id,value\n" + "".join(f"{i},{i % 10}\n" for i in range(5000)))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}/stream?columns=2&interval=0")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = self.parse_events(response.text)
+        progress = [data for name, data in events if name == "progress"]
+        assert len(progress) >= 2
+        assert progress[0]["rows"] < progress[-1]["rows"]
+        assert progress[-1]["bytes_read"] <= progress[-1]["bytes_total"]
+        name, result = events[-1]
+        assert name == "result"
+        assert result["analysis"][0] == {"column": "value", "sum": 22500, "average": 4.5, "max": 9}
+
+    def test_invalid_columns_rejected_before_stream(self, client, sample_csv_file, temp_storage):
+        """Ошибки в заголовке и номерах столбцов возвращаются обычным статусом"""
+        filename, _ = sample_csv_file
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            assert client.get(f"/analyze/{filename}/stream?columns=10").status_code == 400
+            assert client.get("/analyze/missing.csv/stream").status_code == 404
+
+    def test_stream_holds_one_slot(self, client, sample_csv_file, temp_storage):
+        """Поток занимает один слот с открытия файла до конца передачи и освобождает его и при ошибке"""
+        from common import sharedstate
+        filename, _ = sample_csv_file
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('limits._slots', sharedstate.MemorySlots(1)) as slots:
+            token = slots.try_acquire()
+            assert client.get(f"/analyze/{filename}/stream").status_code == 503
+            slots.release(token)
+
+            assert client.get(f"/analyze/{filename}/stream?columns=10").status_code == 400
+            response = client.get(f"/analyze/{filename}/stream?interval=0")
+            assert self.parse_events(response.text)[-1][0] == "result"
+            assert slots.try_acquire() is not None
+
+    def test_interrupted_pass_discards_state(self, client, temp_storage):
+        """Прерванный проход (отключение клиента) не оставляет неполных агрегатов"""
+        import analysis
+        filename = "interrupted.csv"
+        path = os.path.join(temp_storage, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("id,value\n" + "".join(f"{i},1\n" for i in range(5000)))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            client.get(f"/analyze/{filename}")
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write("".join(f"{i},1\n" for i in range(5000)))
+
+            fmt = analysis.csvio.sniff(path, filename)
+            events = analysis.stream_csv(analysis.CsvAnalysis(path, filename, None, fmt), 0)
+            assert next(events).startswith("event: progress")
+            events.close()
+
+            data = client.get(f"/analyze/{filename}").json()
+
+        assert data["resumed_from_offset"] == 0
+        assert data["analysis"][1]["sum"] == 10000
+
+class TestAnalysisLimits:
+    """Тесты бюджетов ресурсов на запрос анализа"""
+
+    @pytest.fixture
+    def rows_csv_file(self, temp_storage):
+        filename = "limited.csv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write("id,value\n" + "".join(f"{i},1\n" for i in range(3000)))
+        return filename
+
+    def test_row_budget_returns_partial_result(self, client, temp_storage, rows_csv_file):
+        """При превышении числа строк возвращается частичный результат с флагом"""
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            data = client.get(f"/analyze/{rows_csv_file}?max_rows=100").json()
+            full = client.get(f"/analyze/{rows_csv_file}").json()
+
+        assert data["partial"] is True
+        assert data["limit_exceeded"] == "rows"
+        assert data["rows_total"] == 100
+        assert data["analysis"][1]["sum"] == 100
+        # Частичный проход не сохраняется для дозаписи
+        assert full["partial"] is False
+        assert full["resumed_from_offset"] == 0
+        assert full["analysis"][1]["sum"] == 3000
+
+    def test_memory_budget_and_gigantic_field(self, client, temp_storage, rows_csv_file):
+        """Бюджет памяти и слишком большое поле останавливают анализ без ошибки"""
+        with open(os.path.join(temp_storage, "huge_field.csv"), 'w', encoding='utf-8') as f:
+            f.write("id,text\n1,short\n2," + "x" * 200000 + "\n3,short\n")
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            with patch.dict(os.environ, {"ANALYZE_MAX_MEMORY_MB": "0.01"}):
+                data = client.get(f"/analyze/{rows_csv_file}").json()
+            field = client.get("/analyze/huge_field.csv").json()
+
+        assert data["partial"] is True
+        assert data["limit_exceeded"] == "memory"
+        assert 0 < data["rows_total"] < 3000
+        assert field["partial"] is True
+        assert field["limit_exceeded"] == "field_size"
+
+    def test_too_many_columns_rejected(self, client, temp_storage, rows_csv_file):
+        """Слишком широкий заголовок отклоняется до чтения строк"""
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch.dict(os.environ, {"ANALYZE_MAX_COLUMNS": "1"}):
+            response = client.get(f"/analyze/{rows_csv_file}")
+        assert response.status_code == 413
+
+    def test_busy_service_returns_503(self, client, temp_storage, rows_csv_file):
+        """Все слоты заняты — 503 с Retry-After"""
+        from common import sharedstate
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('limits._slots', sharedstate.MemorySlots(1)) as slots:
+            slots.try_acquire()
+            response = client.get(f"/analyze/{rows_csv_file}")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+    def test_cancelled_budget_stops_analysis(self, temp_storage, rows_csv_file):
+        """Отмена (отключение клиента) останавливает проход на границе порции"""
+        import analysis, limits
+        path = os.path.join(temp_storage, rows_csv_file)
+        budget = limits.Budget()
+        budget.cancel()
+        data = analysis.analyze_csv(path, rows_csv_file, None, analysis.csvio.sniff(path, rows_csv_file), budget)
+        assert data["partial"] is True
+        assert data["limit_exceeded"] == "cancelled"
+        assert data["rows_total"] == 0
+
+    def test_preview_is_capped(self, client, temp_storage, rows_csv_file):
+        """Превью содержит только первые строки файла"""
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('analysis.PREVIEW_MAX_ROWS', 3):
+            data = client.get(f"/analyze/{rows_csv_file}").json()
+        assert data["preview"].splitlines() == ["id, value", "0, 1", "1, 1", "2, 1"]
+        assert data["preview_truncated"] is True
+
+class TestApproxAnalysis:
+    """Тесты приближённого анализа по выборке блоков"""
+
+    @pytest.fixture
+    def large_csv_file(self, temp_storage):
+        filename = "approx.csv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write("id,value,label\n" + "".join(f"{i},{i % 100},row{i}\n" for i in range(20000)))
+        return filename
+
+    def test_estimate_with_confidence_interval(self, client, temp_storage, large_csv_file):
+        """Оценка по части блоков содержит доверительный интервал, накрывающий точное значение"""
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('approx.BLOCK_SIZE', 4096):
+            response = client.get(f"/analyze/{large_csv_file}?mode=approx&columns=2,3&target_error=0.05&seed=1")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["approximate"] is True
+        assert 0 < data["sampled_blocks"] < data["total_blocks"]
+        value = data["analysis"][0]
+        assert value["column"] == "value"
+        low, high = value["sum_ci"]
+        assert low <= 990000 <= high
+        assert value["average_ci"][0] <= 49.5 <= value["average_ci"][1]
+        assert value["max_is_lower_bound"] is True
+        assert data["analysis"][1]["sum"] == "невозможно определить"
+
+    def test_refine_session_until_exact(self, client, temp_storage, large_csv_file):
+        """Повторные запросы с session дочитывают блоки; после всех блоков ответ точный"""
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('approx.BLOCK_SIZE', 4096):
+            first = client.get(f"/analyze/{large_csv_file}?mode=approx&columns=2&target_error=0.2&seed=3").json()
+            session = first["session"]
+            sampled = first["sampled_blocks"]
+            while True:
+                data = client.get(f"/analyze/{large_csv_file}?mode=approx&session={session}&target_error=0").json()
+                assert data["sampled_blocks"] > sampled
+                sampled = data["sampled_blocks"]
+                if not data["approximate"]:
+                    break
+
+        value = data["analysis"][0]
+        assert data["rows_estimate"] == 20000
+        assert value["sum"] == 990000
+        assert value["average"] == 49.5
+        assert value["max"] == 99
+        assert value["sum_ci"] == [990000, 990000]
+
+    def test_refine_works_on_session_copy(self, client, temp_storage, large_csv_file):
+        """Уточнение меняет копию сессии: одновременный запрос не видит её незаконченную выборку"""
+        import approx
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('approx.BLOCK_SIZE', 4096):
+            first = client.get(f"/analyze/{large_csv_file}?mode=approx&columns=2&target_error=0.2&seed=3").json()
+            stored = approx._sessions.get(first["session"])
+            client.get(f"/analyze/{large_csv_file}?mode=approx&session={first['session']}&target_error=0")
+
+        assert stored.sampled == first["sampled_blocks"]
+        assert approx._sessions.get(first["session"]).sampled > stored.sampled
+
+    def test_unknown_session_and_compressed_file(self, client, temp_storage, large_csv_file):
+        """Неизвестная сессия — 404, сжатый файл в режиме approx — 400"""
+        with open(os.path.join(temp_storage, "packed.csv.gz"), 'wb') as f:
+            f.write(gzip.compress(b"a,b\n1,2\n"))
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            assert client.get(f"/analyze/{large_csv_file}?mode=approx&session=missing").status_code == 404
+            assert client.get("/analyze/packed.csv.gz?mode=approx").status_code == 400
+
+    def test_approx_takes_analysis_slot(self, client, temp_storage, large_csv_file):
+        """Приближённый анализ занимает слот наравне с точным: без свободных слотов — 503"""
+        from common import sharedstate
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('limits._slots', sharedstate.MemorySlots(1)) as slots:
+            token = slots.try_acquire()
+            assert client.get(f"/analyze/{large_csv_file}?mode=approx").status_code == 503
+            slots.release(token)
+            assert client.get(f"/analyze/{large_csv_file}?mode=approx").status_code == 200
+
+class TestRateLimit:
+    """Тесты ограничителя частоты запросов"""
+
+    @staticmethod
+    def make_app(backend):
+        from fastapi import FastAPI
+        from common import ratelimit
+
+        limited = FastAPI()
+        with patch.dict(os.environ, {"RATE_LIMIT_EXPENSIVE": "2/60", "RATE_LIMIT_CHEAP": "5/60"}):
+            ratelimit.install(limited, expensive_routes=(r"/analyze/",), backend=backend)
+
+        @limited.get("/analyze/{name}")
+        async def expensive(name: str):
+            return {"name": name}
+
+        @limited.get("/files")
+        async def cheap():
+            return []
+
+        # Запросы приходят как будто от nginx из частной сети
+        return TestClient(limited, client=("10.0.0.2", 50000))
+
+    @staticmethod
+    def bearer(sub):
+        import jwt
+        return {"Authorization": "Bearer " + jwt.encode({"sub": sub}, os.getenv("JWT_SECRET", "myjwtsecret"), algorithm="HS256")}
+
+    def test_expensive_and_cheap_budgets(self):
+        """Дорогие маршруты исчерпываются раньше дешёвых; отказ — 429 с Retry-After"""
+        from common import ratelimit
+        limited = self.make_app(ratelimit.MemoryBackend())
+
+        assert [limited.get("/analyze/a").status_code for _ in range(3)] == [200, 200, 429]
+        response = limited.get("/analyze/a")
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        assert limited.get("/files").status_code == 200
+
+    def test_keys_by_token_subject_and_client_ip(self):
+        """У каждого пользователя своя корзина; без токена ключ — IP клиента от доверенного прокси"""
+        from common import ratelimit
+        limited = self.make_app(ratelimit.MemoryBackend())
+
+        for _ in range(2):
+            assert limited.get("/analyze/a", headers=self.bearer("1")).status_code == 200
+        assert limited.get("/analyze/a", headers=self.bearer("1")).status_code == 429
+        assert limited.get("/analyze/a", headers=self.bearer("2")).status_code == 200
+
+        # Поддельный токен не даёт отдельной корзины: ключом остаётся IP клиента из X-Real-IP
+        forged = {"Authorization": "Bearer not-a-jwt", "X-Real-IP": "203.0.113.5"}
+        assert [limited.get("/analyze/a", headers=forged).status_code for _ in range(3)] == [200, 200, 429]
+        assert limited.get("/analyze/a", headers={"X-Real-IP": "203.0.113.6"}).status_code == 200
+
+        # Заголовкам от недоверенного адреса не верим
+        with patch.dict(os.environ, {"TRUSTED_PROXIES": "192.168.0.0/16"}):
+            limited = self.make_app(ratelimit.MemoryBackend())
+        assert [limited.get("/analyze/a", headers={"X-Real-IP": f"203.0.113.{i}"}).status_code for i in range(3)] == [200, 200, 429]
+
+    def test_database_backend_is_shared_between_replicas(self, temp_storage):
+        """Две реплики с общей базой расходуют одну корзину"""
+        from common import ratelimit
+        url = ratelimit.create_local_store(os.path.join(temp_storage, 'ratelimit.db'))
+        first = self.make_app(ratelimit.DatabaseBackend(url))
+        second = self.make_app(ratelimit.DatabaseBackend(url))
+
+        assert first.get("/analyze/a").status_code == 200
+        assert second.get("/analyze/a").status_code == 200
+        assert first.get("/analyze/a").status_code == 429
+        assert second.get("/analyze/a").status_code == 429
+
+    def test_refilled_buckets_are_swept(self, temp_storage):
+        """Корзины, пополнившиеся до полной, удаляются; неполные остаются"""
+        from sqlalchemy import select
+        from common import ratelimit
+        url = ratelimit.create_local_store(os.path.join(temp_storage, 'ratelimit.db'))
+        memory = ratelimit.MemoryBackend(sweep_seconds=10)
+        database = ratelimit.DatabaseBackend(url, sweep_seconds=10)
+
+        for backend in (memory, database):
+            # Ёмкость 2, пополнение 0.1 токена в секунду: пустая корзина полна через 20 секунд
+            for i in range(1000):
+                backend.take(f"ip:{i}", 2, 0.1, now=1000.0)
+            backend.take("busy", 2, 0.1, now=1015.0)
+            backend.take("busy", 2, 0.1, now=1015.0)
+            assert backend.take("busy", 2, 0.1, now=1025.0) == 0.0
+
+        assert list(memory._buckets) == ["busy"]
+        with database.engine.connect() as conn:
+            keys = conn.execute(select(ratelimit.buckets_table.c.key)).scalars().all()
+        assert keys == ["busy"]
+
+class TestMetrics:
+    """Тесты эндпоинта метрик"""
+
+    def test_metrics_endpoint(self, client, sample_csv_file, temp_storage):
+        """Строки, байты и фазы анализа попадают в /metrics"""
+        filename, filepath = sample_csv_file
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            client.get(f"/analyze/{filename}")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        body = response.text
+        assert 'analyze_rows_total{format="csv"}' in body
+        assert 'analyze_bytes_parsed_total{format="csv"}' in body
+        assert 'analyze_phase_duration_seconds_count{format="csv",phase="parse"}' in body
+        assert 'route="/analyze/{filename}"' in body
+
+class TestTracing:
+    """Тесты трассировки анализа"""
+
+    def test_analyze_spans_continue_incoming_trace(self, client, sample_csv_file, temp_storage):
+        """Спаны анализа продолжают трассу из traceparent и содержат фазы разбора и агрегирования"""
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        from common import tracing
+
+        exporter = InMemorySpanExporter()
+        tracing.provider.add_span_processor(SimpleSpanProcessor(exporter))
+        filename, filepath = sample_csv_file
+        trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(
+                f"/analyze/{filename}",
+                headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"},
+            )
+        assert response.status_code == 200
+
+        spans = {span.name: span for span in exporter.get_finished_spans()}
+        assert {"GET /analyze/{filename}", "analyze.csv", "analyze.parse", "analyze.aggregate"} <= set(spans)
+        for span in spans.values():
+            assert format(span.context.trace_id, "032x") == trace_id
+        assert spans["analyze.parse"].parent.span_id == spans["analyze.csv"].context.span_id
+        assert spans["analyze.csv"].attributes["analyze.rows"] == 5
+        exporter.clear()
+
+class TestProfiling:
+    """Тесты встроенного профилировщика"""
+
+    def test_profile_requires_admin_token(self, client):
+        """Без ADMIN_TOKEN профилирование выключено, с неверным токеном — запрещено"""
+        with patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("ADMIN_TOKEN", None)
+            assert client.get("/admin/profile?seconds=0.1").status_code == 404
+
+        with patch.dict(os.environ, {"ADMIN_TOKEN": "secret"}):
+            response = client.get("/admin/profile?seconds=0.1", headers={"X-Admin-Token": "wrong"})
+            assert response.status_code == 403
+            response = client.get("/admin/profile?seconds=0.1", headers={"X-Admin-Token": "пароль".encode("utf-8")})
+            assert response.status_code == 403
+
+    def test_profile_collapsed_and_svg(self, client):
+        """Профиль за заданное время в collapsed и SVG форматах"""
+        headers = {"X-Admin-Token": "secret"}
+        with patch.dict(os.environ, {"ADMIN_TOKEN": "secret"}):
+            response = client.get("/admin/profile?seconds=0.2&interval=0.005", headers=headers)
+            assert response.status_code == 200
+            lines = response.text.splitlines()
+            assert lines
+            stack, count = lines[0].rsplit(" ", 1)
+            assert int(count) > 0
+
+            response = client.get("/admin/profile?seconds=0.1&format=svg", headers=headers)
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("image/svg+xml")
+            assert response.text.startswith("<svg")
+
+    def test_profile_single_request(self, client, temp_storage):
+        """Профилирование отдельного запроса /analyze по заголовку X-Profile"""
+        filename = "profiled.csv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write("id,value\n" + "".join(f"{i},{i * 2}\n" for i in range(50000)))
+
+        headers = {"X-Admin-Token": "secret", "X-Profile": "wall"}
+        with patch.dict(os.environ, {"ADMIN_TOKEN": "secret"}), \
+             patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}", headers=headers)
+            assert response.status_code == 200
+            profile_id = response.headers["X-Profile-Id"]
+
+            profile = client.get(f"/admin/profile/{profile_id}", headers={"X-Admin-Token": "secret"})
+            assert profile.status_code == 200
+            assert "analyze_csv" in profile.text
+            assert response.headers["X-Profile-Scope"] == "process"
+
+            # У потокового ответа профилируется и генерация тела
+            response = client.get(f"/analyze/{filename}/stream?columns=2&interval=0", headers=headers)
+            profile = client.get(f"/admin/profile/{response.headers['X-Profile-Id']}", headers={"X-Admin-Token": "secret"})
+            assert "stream_csv" in profile.text
+
+    def test_stored_profile_visible_to_other_workers(self, temp_storage):
+        """Профиль запроса, сохранённый одним рабочим процессом, находит другой"""
+        from collections import Counter
+        from common import profiling, sharedstate
+
+        with patch.dict(os.environ, {"SHARED_STATE_DIR": temp_storage}):
+            first, second = sharedstate.create_store("profiles", 2), sharedstate.create_store("profiles", 2)
+        with patch('common.profiling._stored', first):
+            profile_id = profiling._store(Counter({"main;analyze": 3}))
+        with patch('common.profiling._stored', second):
+            assert profiling._stored.get(profile_id) == Counter({"main;analyze": 3})
+
+class TestFileEvents:
+    """Тесты подписки на события жизненного цикла файлов"""
+
+    def test_upload_warms_and_delete_evicts(self, client, temp_storage):
+        """file.uploaded прогревает состояние анализа, file.deleted его забывает"""
+        import analysis, lifecycle
+        from common import events
+        from sqlalchemy import create_engine
+
+        filename = "events.csv"
+        filepath = os.path.join(temp_storage, filename)
+        with open(filepath, "w", encoding="utf-8") as f:
+            f.write("a,b\n1,2\n3,4\n")
+
+        url = f"sqlite:///{os.path.join(temp_storage, 'events.db')}"
+        engine = create_engine(url)
+        # Таблицу event_outbox создают миграции data_service, подписчик её не создаёт
+        events.metadata.create_all(engine)
+        subscriber = events.Subscriber(url, lifecycle.handlers(lambda: temp_storage))
+        subscriber.seek_to_end()
+
+        with engine.begin() as conn:
+            events.publish(conn, events.FILE_UPLOADED, [{"filename": filename, "filetype": "csv"}])
+        assert subscriber.poll() == 1
+        assert any(key[0] == filepath for key in analysis._states)
+
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            response = client.get(f"/analyze/{filename}")
+        assert response.json()["resumed_from_offset"] == os.path.getsize(filepath)
+
+        # После дозаписи прогрев дочитывает только новые строки
+        appended_from = os.path.getsize(filepath)
+        with open(filepath, "a", encoding="utf-8") as f:
+            f.write("5,6\n")
+        with engine.begin() as conn:
+            events.publish(conn, events.FILE_UPDATED, [{"filename": filename, "filetype": "csv"}])
+        assert subscriber.poll() == 1
+        with patch('main.get_storage_dir', return_value=temp_storage):
+            data = client.get(f"/analyze/{filename}").json()
+        assert data["resumed_from_offset"] == os.path.getsize(filepath) > appended_from
+        assert data["analysis"][0]["sum"] == 9
+
+        with engine.begin() as conn:
+            events.publish(conn, events.FILE_DELETED, [{"filename": filename}])
+        assert subscriber.poll() == 1
+        assert subscriber.poll() == 0
+        assert not any(key[0] == filepath for key in analysis._states)
+        engine.dispose()
+        subscriber.engine.dispose()
+
+class TestSharedState:
+    """Тесты состояния, общего для рабочих процессов пода"""
+
+    def test_approx_session_continues_in_other_worker(self, client, temp_storage):
+        """Сессию, начатую одним процессом, продолжает другой с тем же SHARED_STATE_DIR"""
+        from common import sharedstate
+        filename = "shared.csv"
+        with open(os.path.join(temp_storage, filename), 'w', encoding='utf-8') as f:
+            f.write("id,value\n" + "".join(f"{i},{i % 10}\n" for i in range(5000)))
+        shared = os.path.join(temp_storage, "shared")
+
+        with patch('main.get_storage_dir', return_value=temp_storage), \
+             patch('approx.BLOCK_SIZE', 4096):
+            with patch('approx._sessions', sharedstate.DirectoryStore(shared, 8)):
+                first = client.get(f"/analyze/{filename}?mode=approx&columns=2&target_error=0.5&seed=1").json()
+            with patch('approx._sessions', sharedstate.DirectoryStore(shared, 8)):
+                second = client.get(f"/analyze/{filename}?mode=approx&session={first['session']}&target_error=0").json()
+
+        assert first["sampled_blocks"] < first["total_blocks"]
+        assert second["approximate"] is False
+        assert second["analysis"][0]["sum"] == 22500
+
+    def test_directory_store_lru_and_tags(self, temp_storage):
+        """Хранилище вытесняет давно не читанные значения и удаляет значения по метке"""
+        from common import sharedstate
+        path = os.path.join(temp_storage, "store")
+        first, second = sharedstate.DirectoryStore(path, 2), sharedstate.DirectoryStore(path, 2)
+
+        first.put(("a", 1), {"n": 1}, tag="a.csv")
+        os.utime(first._files()[0], (1, 1))
+        first.put(("a", 2), {"n": 2}, tag="a.csv")
+        assert second.get(("a", 1)) == {"n": 1}
+        second.put(("b", 1), {"n": 3}, tag="b.csv")
+        assert first.get(("a", 2)) is None
+        assert first.get(("a", 1)) == {"n": 1}
+
+        second.pop_tag("a.csv")
+        assert first.get(("a", 1)) is None
+        assert first.get(("b", 1)) == {"n": 3}
+
+    def test_file_slots_and_leader_are_pod_wide(self, temp_storage):
+        """Слоты и блокировка ведущего общие для всех владельцев каталога"""
+        from common import sharedstate
+        path = os.path.join(temp_storage, "slots")
+        first, second = sharedstate.FileSlots(path, 1), sharedstate.FileSlots(path, 1)
+        token = first.try_acquire()
+        assert token is not None
+        assert second.try_acquire() is None
+        first.release(token)
+        token = second.try_acquire()
+        assert token is not None
+        second.release(token)
+
+        with patch.dict(os.environ, {"SHARED_STATE_DIR": temp_storage}):
+            leader, follower = sharedstate.LeaderLock("events"), sharedstate.LeaderLock("events")
+        assert leader.acquire() and leader.acquire()
+        assert not follower.acquire()
+        leader.release()
+        assert follower.acquire()
+        follower.release()
+
+class TestAuthDependency:
+    """Тесты проверки токенов через common/auth.py"""
+
+    @staticmethod
+    def token(**claims):
+        import jwt, time
+        payload = {"sub": "7", "username": "alice", "exp": int(time.time()) + 60, **claims}
+        return jwt.encode(payload, os.getenv("JWT_SECRET", "myjwtsecret"), algorithm="HS256")
+
+    @staticmethod
+    def fake_introspector(revoked=()):
+        from common import auth
+        introspector = auth.Introspector("http://auth", batch_seconds=0.05)
+        calls = []
+
+        class Client:
+            def post(self, path, json, headers):
+                calls.append(json["tokens"])
+                response = type("Response", (), {})()
+                response.raise_for_status = lambda: None
+                response.json = lambda: {"results": [
+                    {"active": False, "reason": "Token revoked"} if t in revoked else {"active": True}
+                    for t in json["tokens"]
+                ]}
+                return response
+
+        introspector._client = Client()
+        return introspector, calls
+
+    def test_local_check_and_anonymous_access(self, client):
+        """Без токена запрос анонимный, если AUTH_REQUIRED не задан; поддельный токен — 401 без сетевых вызовов"""
+        assert client.get("/analyze/missing.csv").status_code == 404
+        headers = {"Authorization": "Bearer garbage"}
+        assert client.get("/analyze/missing.csv", headers=headers).status_code == 401
+        expired = {"Authorization": f"Bearer {self.token(exp=1)}"}
+        assert client.get("/analyze/missing.csv", headers=expired).json()["detail"] == "Token expired"
+        with patch.dict(os.environ, {"AUTH_REQUIRED": "true"}):
+            assert client.get("/analyze/missing.csv").status_code == 401
+            assert client.get("/health").status_code == 200
+
+    def test_revoked_token_rejected_remotely(self, client):
+        """Подлинный, но отозванный токен отклоняет auth_service; ответ кэшируется"""
+        revoked = self.token(jti="r")
+        introspector, calls = self.fake_introspector(revoked={revoked})
+        with patch('common.auth.introspector', introspector):
+            response = client.get("/analyze/missing.csv", headers={"Authorization": f"Bearer {revoked}"})
+            assert response.status_code == 401
+            assert response.json()["detail"] == "Token revoked"
+            valid = {"Authorization": f"Bearer {self.token(jti='v')}"}
+            assert client.get("/analyze/missing.csv", headers=valid).status_code == 404
+            assert client.get("/analyze/missing.csv", headers=valid).status_code == 404
+        assert len(calls) == 2
+
+    def test_concurrent_checks_share_one_call(self):
+        """Токены одновременных запросов проверяются одним вызовом, повторы токена — один раз"""
+        first, second = self.token(jti="a"), self.token(jti="b")
+        introspector, calls = self.fake_introspector(revoked={second})
+        futures = [introspector.submit(t) for t in (first, second, first)]
+        results = [future.result(timeout=5) for future in futures]
+        assert calls == [[first, second]]
+        assert [r["active"] for r in results] == [True, False, True]
+        assert introspector.submit(second).result(timeout=1)["active"] is False
+        assert calls == [[first, second]]
+
 class TestPerformance:
     """Тесты производительности"""
     
@@ -0,0 +1,44 @@
+"""Генерация синтетических CSV для бенчмарков.
+
+Файл пишется построчно, поэтому генерация не зависит от объёма памяти.
+Одинаковые параметры и seed дают побайтно одинаковый файл.
+"""
+import argparse
+import csv
+import random
+
+WORDS = ("alpha", "beta", "gamma", "delta", "omega", "sample", "probe", "sensor", "batch", "control")
+
+
+def column_kinds(columns: int, numeric_ratio: float):
+    numeric = round(columns * numeric_ratio)
+    return ["num"] * numeric + ["text"] * (columns - numeric)
+
+
+def generate_csv(path: str, rows: int, columns: int = 10, numeric_ratio: float = 0.7, seed: int = 42, delimiter: str = ","):
+    rng = random.Random(seed)
+    kinds = column_kinds(columns, numeric_ratio)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow([f"{kind}_{i + 1}" for i, kind in enumerate(kinds)])
+        for _ in range(rows):
+            writer.writerow([
+                f"{rng.uniform(-1000, 1000):.4f}" if kind == "num" else f"{rng.choice(WORDS)}-{rng.randrange(10000)}"
+                for kind in kinds
+            ])
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетического CSV")
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--numeric-ratio", type=float, default=0.7)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    generate_csv(args.path, args.rows, args.columns, args.numeric_ratio, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,13 +29,39 @@ async function login() {
     const data = await res.json();
     if (res.ok && data.access_token) {
         localStorage.setItem('access_token', data.access_token);
+        localStorage.setItem('refresh_token', data.refresh_token);
         window.location.href = 'upload.html';
     } else {
         alert(data.detail || 'Ошибка входа');
     }
 }
 
-async function checkSession() {
+// Access-токен живёт недолго: по refresh-токену выдаётся новая пара
+async function refreshTokens() {
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (!refreshToken) return false;
+    const res = await fetch(`/api/auth/refresh`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        },
+        body: JSON.stringify({refresh_token: refreshToken})
+    });
+    if (!res.ok) return false;
+    const data = await res.json();
+    localStorage.setItem('access_token', data.access_token);
+    localStorage.setItem('refresh_token', data.refresh_token);
+    return true;
+}
+
+// Заголовок с access-токеном для запросов к data и processing
+function authHeaders() {
+    const token = localStorage.getItem('access_token');
+    return token ? {'Authorization': `Bearer ${token}`} : {};
+}
+
+async function checkSession(retry = true) {
     const token = localStorage.getItem('access_token');
     if (!token) return false;
     
@@ -50,9 +76,13 @@ async function checkSession() {
             console.log('User ID:', data.user_id);
             return true;
         }
+        else if (retry && await refreshTokens()) {
+            return checkSession(false);
+        }
         else {
             console.log('Session invalid');
             localStorage.removeItem('access_token');
+            localStorage.removeItem('refresh_token');
             return false;
         }
     } catch (error) {
@@ -65,11 +95,19 @@ async function logout() {
     const token = localStorage.getItem('access_token');
     if (token) {
         try {
-            await fetch(`/api/auth/logout`, { method: 'POST' });
+            await fetch(`/api/auth/logout`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${token}`
+                },
+                body: JSON.stringify({refresh_token: localStorage.getItem('refresh_token') || ''})
+            });
         } catch (error) {
             console.error('Logout error:', error);
         }
         localStorage.removeItem('access_token');
+        localStorage.removeItem('refresh_token');
     }
     window.location.href = 'index.html';
 }
@@ -47,6 +47,7 @@ async function uploadFile() {
     try {
         const res = await fetch('/api/data/upload', {
             method: 'POST',
+            headers: authHeaders(),
             body: formData
         });
 
@@ -63,7 +64,7 @@ async function uploadFile() {
 
 async function getCsvPreview(filename) {
     try {
-        const response = await fetch(`/api/processing/analyze/${filename}`);
+        const response = await fetch(`/api/processing/analyze/${filename}`, { headers: authHeaders() });
         if (!response.ok) throw new Error(`Ошибка ${response.status}`);
         return await response.json();
     } catch (error) {
@@ -76,19 +77,88 @@ async function getCsvPreview(filename) {
     }
 }
 
+function renderAnalysisTable(analysis) {
+    return `
+        <div class="analysis-table">
+            ${analysis.map(col => `
+                <div class="analysis-row">
+                    <div class="column-name"><strong>${col.column}</strong></div>
+                    <div class="column-stats">
+                        <span>Сумма: ${col.sum}</span>
+                        <span>Среднее: ${col.average}</span>
+                        <span>Наибольшее значение: ${col.max}</span>
+                    </div>
+                </div>
+            `).join('')}
+        </div>
+    `;
+}
+
+function renderAnalysisProgress(progress, resultsDiv) {
+    const percent = progress.bytes_total ? Math.min(100, Math.round(progress.bytes_read / progress.bytes_total * 100)) : 0;
+    resultsDiv.querySelector('.analysis-progress').innerHTML = `
+        <progress max="100" value="${percent}"></progress>
+        <p>Прочитано ${percent}%, строк: ${progress.rows}</p>
+        <h4>Промежуточная статистика:</h4>
+        ${renderAnalysisTable(progress.analysis)}
+    `;
+}
+
+// Читает поток Server-Sent Events из ответа fetch и вызывает onEvent(имя, данные) для каждого события
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of block.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            onEvent(event, JSON.parse(data));
+        }
+    }
+}
+
 async function performCsvAnalysis(filename, columns, resultsDiv) {
+    // Повторный запуск или закрытие окна прерывает предыдущий анализ: сервер прекращает чтение файла
+    if (resultsDiv.analysisController) resultsDiv.analysisController.abort();
+    const controller = new AbortController();
+    resultsDiv.analysisController = controller;
+
     try {
         resultsDiv.classList.add('analysis-results-visible');
-        resultsDiv.innerHTML = '<div class="loading">Загрузка анализа...</div>';
-        
+        resultsDiv.innerHTML = `
+            <div class="loading">Загрузка анализа...</div>
+            <div class="analysis-progress"></div>
+            <button class="analyze-btn cancel-analysis-btn">Отменить</button>
+        `;
+        resultsDiv.querySelector('.cancel-analysis-btn').addEventListener('click', () => controller.abort());
+
         const url = columns ? 
-            `/api/processing/analyze/${filename}?columns=${encodeURIComponent(columns)}` : 
-            `/api/processing/analyze/${filename}`;
+            `/api/processing/analyze/${filename}/stream?columns=${encodeURIComponent(columns)}` : 
+            `/api/processing/analyze/${filename}/stream`;
             
-        const response = await fetch(url);
+        const response = await fetch(url, { signal: controller.signal, headers: authHeaders() });
         if (!response.ok) throw new Error(`Ошибка ${response.status}`);
         
-        const data = await response.json();
+        let data = null;
+        await readEventStream(response, (event, payload) => {
+            if (event === 'progress') renderAnalysisProgress(payload, resultsDiv);
+            else if (event === 'error') throw new Error(payload.detail);
+            else if (event === 'result') data = payload;
+        });
+        if (!data) throw new Error('Анализ прерван');
         
         resultsDiv.innerHTML = `
             <div class="analysis-summary">
@@ -96,26 +166,20 @@ async function performCsvAnalysis(filename, columns, resultsDiv) {
                 <p><strong>Файл:</strong> ${data.filename}</p>
                 <p><strong>Всего столбцов:</strong> ${data.columns_total}</p>
                 <p><strong>Выбранные столбцы:</strong> ${data.columns_selected}</p>
+                ${data.partial ? `<p class="error">Результат частичный: анализ остановлен по ограничению (${data.limit_exceeded})</p>` : ''}
             </div>
             
             <div class="analysis-details">
                 <h4>Статистика по столбцам:</h4>
-                <div class="analysis-table">
-                    ${data.analysis.map(col => `
-                        <div class="analysis-row">
-                            <div class="column-name"><strong>${col.column}</strong></div>
-                            <div class="column-stats">
-                                <span>Сумма: ${col.sum}</span>
-                                <span>Среднее: ${col.average}</span>
-                                <span>Наибольшее значение: ${col.max}</span>
-                            </div>
-                        </div>
-                    `).join('')}
-                </div>
+                ${renderAnalysisTable(data.analysis)}
             </div>
         `;
         
     } catch (error) {
+        if (error.name === 'AbortError') {
+            resultsDiv.innerHTML = '<div class="loading">Анализ отменён</div>';
+            return;
+        }
         console.error('Ошибка при анализе CSV:', error);
         resultsDiv.innerHTML = `
             <div class="error">
@@ -123,20 +187,32 @@ async function performCsvAnalysis(filename, columns, resultsDiv) {
                 <p>Не удалось проанализировать файл: ${error.message}</p>
             </div>
         `;
+    } finally {
+        if (resultsDiv.analysisController === controller) resultsDiv.analysisController = null;
     }
 }
 
+// Ссылка на скачивание без заголовка Authorization: <img> и <a> его не передают,
+// поэтому data_service выдаёт ссылку с подписью и сроком действия
+async function downloadUrl(filename) {
+    const response = await fetch(`/api/data/files/${encodeURIComponent(filename)}/download-link`, { headers: authHeaders() });
+    if (!response.ok) throw new Error(`Ссылка на ${filename} не получена`);
+    const data = await response.json();
+    return `/api/data/${data.url}`;
+}
+
 async function updateFileList(searchQuery = '') {
     try {
-        const response = await fetch('/api/data/files');
-        const files = await response.json();
+        // Поиск выполняется на сервере, весь каталог запрашивается только без запроса
+        const url = searchQuery
+            ? `/api/data/files/search?q=${encodeURIComponent(searchQuery)}&limit=100`
+            : '/api/data/files';
+        const response = await fetch(url, { headers: authHeaders() });
+        const data = await response.json();
         const fileList = document.getElementById('fileList');
         fileList.innerHTML = '';
 
-        const filteredFiles = files.filter(f => 
-            f.title.toLowerCase().includes(searchQuery) || 
-            f.filename.toLowerCase().includes(searchQuery)
-        );
+        const filteredFiles = searchQuery ? (response.ok ? data.items : []) : data;
 
         for (const file of filteredFiles) {
             const div = document.createElement('div');
@@ -181,7 +257,11 @@ async function updateFileList(searchQuery = '') {
                 const div_img= document.createElement('div');
                 div_img.classList.add('div_img', 'image-container');
                 const img = document.createElement('img');
-                img.src = `/api/data/download/${file.filename}`;
+                try {
+                    img.src = await downloadUrl(file.filename);
+                } catch (error) {
+                    console.error(error);
+                }
                 img.alt = file.filename;
                 div_img.appendChild(img);
                 div.appendChild(div_img);
@@ -190,9 +270,9 @@ async function updateFileList(searchQuery = '') {
             const downloadBtn = document.createElement('button');
             downloadBtn.classList.add('card_btn');
             downloadBtn.textContent = 'Скачать';
-            downloadBtn.onclick = () => {
+            downloadBtn.onclick = async () => {
                 const link = document.createElement('a');
-                link.href = `/api/data/download/${file.filename}`;
+                link.href = await downloadUrl(file.filename);
                 link.download = file.filename;
                 document.body.appendChild(link);
                 link.click();
@@ -207,7 +287,7 @@ async function updateFileList(searchQuery = '') {
                 const confirmDelete = confirm(`Вы уверены, что хотите удалить ${file.filename}?`);
                 if (!confirmDelete) return;
 
-                const res = await fetch(`/api/data/files/${file.filename}`, { method: 'DELETE' });
+                const res = await fetch(`/api/data/files/${file.filename}`, { method: 'DELETE', headers: authHeaders() });
                 if (res.ok) {
                     alert(`${file.filename} удалён`);
                     await updateFileList(searchQuery);
@@ -290,8 +370,11 @@ document.addEventListener('click', async function (e) {
         const imgContainer = document.createElement('div');
         imgContainer.classList.add('modal-image-container');
         imgContainer.innerHTML = `
-            <img src="/api/data/download/${actualFilename}" alt="${fileName}" style="max-width: 100%; height: auto; display: block; margin: 15px auto;">
+            <img alt="${fileName}" style="max-width: 100%; height: auto; display: block; margin: 15px auto;">
         `;
+        downloadUrl(actualFilename)
+            .then(url => { imgContainer.querySelector('img').src = url; })
+            .catch(error => console.error(error));
         modal.appendChild(imgContainer);
     }
 
@@ -350,7 +433,11 @@ document.addEventListener('click', async function (e) {
     closeBtn.textContent = '×';
     closeBtn.classList.add('close-btn');
     closeBtn.classList.add('modal-close-btn');
-    closeBtn.addEventListener('click', () => overlay.remove());
+    closeBtn.addEventListener('click', () => {
+        const resultsDiv = modal.querySelector('#analysisResults');
+        if (resultsDiv && resultsDiv.analysisController) resultsDiv.analysisController.abort();
+        overlay.remove();
+    });
     modal.appendChild(closeBtn);
 
     overlay.appendChild(modal);
@@ -5,13 +5,13 @@
 echo "Сборка Docker образов для Kubernetes..."
 
 echo "Сборка auth-service..."
-docker build -t auth-service:latest ./backend/authentification_service/
+docker build -t auth-service:latest -f ./backend/authentification_service/Dockerfile ./backend/
 
 echo "Сборка data-service..."
-docker build -t data-service:latest ./backend/data_service/
+docker build -t data-service:latest -f ./backend/data_service/Dockerfile ./backend/
 
 echo "Сборка processing-service..."
-docker build -t processing-service:latest ./backend/processing_service/
+docker build -t processing-service:latest -f ./backend/processing_service/Dockerfile ./backend/
 
 echo "Сборка frontend..."
 docker build -t frontend:latest ./frontend/
@@ -17,6 +17,9 @@ kubectl delete -f k8s/processing-deployment.yaml --ignore-not-found=true
 echo "Удаление Data Service..."
 kubectl delete -f k8s/data-deployment.yaml --ignore-not-found=true
 
+echo "Удаление задач миграций..."
+kubectl delete -f k8s/migrations-job.yaml --ignore-not-found=true
+
 echo "Удаление Auth Service..."
 kubectl delete -f k8s/auth-deployment.yaml --ignore-not-found=true
 
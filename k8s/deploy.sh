@@ -24,6 +24,11 @@ kubectl apply -f postgres-deployment.yaml -n $NAMESPACE
 echo "Ожидание готовности PostgreSQL..."
 kubectl wait --for=condition=available --timeout=300s deployment/postgres -n $NAMESPACE
 
+echo "Миграции схемы базы..."
+kubectl delete job auth-migrate data-migrate --ignore-not-found -n $NAMESPACE
+kubectl apply -f migrations-job.yaml -n $NAMESPACE
+kubectl wait --for=condition=complete --timeout=300s job/auth-migrate job/data-migrate -n $NAMESPACE
+
 echo "Создание/обновление деплойментов сервисов..."
 kubectl apply -f auth-deployment.yaml -n $NAMESPACE
 kubectl apply -f data-deployment.yaml -n $NAMESPACE
@@ -33,6 +38,7 @@ kubectl apply -f frontend-deployment.yaml -n $NAMESPACE
 echo "Обновление образов сервисов с Docker Hub..."
 kubectl set image deployment/auth-service auth-service=$DOCKER_USER/auth-service:$IMAGE_TAG -n $NAMESPACE
 kubectl set image deployment/data-service data-service=$DOCKER_USER/data-service:$IMAGE_TAG -n $NAMESPACE
+kubectl set image deployment/data-worker data-worker=$DOCKER_USER/data-service:$IMAGE_TAG -n $NAMESPACE
 kubectl set image deployment/processing-service processing-service=$DOCKER_USER/processing-service:$IMAGE_TAG -n $NAMESPACE
 kubectl set image deployment/frontend nginx=$DOCKER_USER/frontend:$IMAGE_TAG -n $NAMESPACE
 
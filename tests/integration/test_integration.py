@@ -34,6 +34,9 @@ class TestIntegration:
         
         # Ждем, пока сервисы запустятся
         self.wait_for_services()
+        
+        # data и processing запущены с AUTH_REQUIRED: запросы к ним идут с токеном
+        self.http = self.authorized_session()
     
     def wait_for_services(self):
         """Ждем, пока все сервисы запустятся"""
@@ -56,6 +59,17 @@ class TestIntegration:
         
         raise Exception("Services did not start within 60 seconds")
     
+    def authorized_session(self):
+        """Сессия requests с access-токеном отдельного пользователя для работы с файлами"""
+        user = {"username": "integration_files_user", "password": "integration_files_pass123"}
+        # Пользователь может остаться от прошлого запуска
+        requests.post(f"{self.auth_url}/register", json=user)
+        login_response = requests.post(f"{self.auth_url}/login", json=user)
+        assert login_response.status_code == 200
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {login_response.json()['access_token']}"
+        return session
+    
     def teardown_method(self):
         """Очистка после каждого теста"""
         # Удаляем временную папку
@@ -106,7 +120,7 @@ class TestIntegration:
         files = {"file": ("test_integration.csv", self.test_csv_content, "text/csv")}
         data = {"title": "Integration Test File", "description": "Test file for integration testing"}
         
-        upload_response = requests.post(
+        upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=files,
             data=data
@@ -118,24 +132,24 @@ class TestIntegration:
         assert upload_data["filetype"] == "csv"
         
         # 2. Получаем список файлов
-        list_response = requests.get(f"{self.data_url}/files")
+        list_response = self.http.get(f"{self.data_url}/files")
         assert list_response.status_code == 200
         files_list = list_response.json()
         assert len(files_list) > 0
         assert any(f["filename"] == "test_integration.csv" for f in files_list)
         
         # 3. Скачиваем файл
-        download_response = requests.get(f"{self.data_url}/download/test_integration.csv")
+        download_response = self.http.get(f"{self.data_url}/download/test_integration.csv")
         assert download_response.status_code == 200
         assert download_response.content.decode() == self.test_csv_content
         
         # 4. Удаляем файл
-        delete_response = requests.delete(f"{self.data_url}/files/test_integration.csv")
+        delete_response = self.http.delete(f"{self.data_url}/files/test_integration.csv")
         assert delete_response.status_code == 200
         assert "удалён полностью" in delete_response.json()["detail"]
         
         # 5. Проверяем что файл удален
-        final_list_response = requests.get(f"{self.data_url}/files")
+        final_list_response = self.http.get(f"{self.data_url}/files")
         assert final_list_response.status_code == 200
         final_files_list = final_list_response.json()
         assert not any(f["filename"] == "test_integration.csv" for f in final_files_list)
@@ -146,7 +160,7 @@ class TestIntegration:
         files = {"file": ("analysis_test.csv", self.test_csv_content, "text/csv")}
         data = {"title": "Analysis Test File"}
         
-        upload_response = requests.post(
+        upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=files,
             data=data
@@ -154,7 +168,7 @@ class TestIntegration:
         assert upload_response.status_code == 200
         
         # 2. Анализируем все столбцы
-        analysis_response = requests.get(f"{self.processing_url}/analyze/analysis_test.csv")
+        analysis_response = self.http.get(f"{self.processing_url}/analyze/analysis_test.csv")
         assert analysis_response.status_code == 200
         analysis_data = analysis_response.json()
         
@@ -175,7 +189,7 @@ class TestIntegration:
         assert salary_col["max"] == 70000
         
         # 3. Анализируем конкретные столбцы
-        specific_analysis_response = requests.get(
+        specific_analysis_response = self.http.get(
             f"{self.processing_url}/analyze/analysis_test.csv?columns=2,3"
         )
         assert specific_analysis_response.status_code == 200
@@ -198,7 +212,7 @@ class TestIntegration:
         assert "age" in analysis_data["preview"]
         
         # 5. Удаляем тестовый файл
-        delete_response = requests.delete(f"{self.data_url}/files/analysis_test.csv")
+        delete_response = self.http.delete(f"{self.data_url}/files/analysis_test.csv")
         assert delete_response.status_code == 200
     
     def test_error_handling_integration(self):
@@ -212,19 +226,23 @@ class TestIntegration:
         assert "Invalid credentials" in invalid_login_response.json()["detail"]
         
         # 2. Попытка скачать несуществующий файл
-        download_response = requests.get(f"{self.data_url}/download/nonexistent.csv")
+        download_response = self.http.get(f"{self.data_url}/download/nonexistent.csv")
         assert download_response.status_code == 404
         assert "Файл не найден" in download_response.json()["detail"]
         
         # 3. Попытка удалить несуществующий файл
-        delete_response = requests.delete(f"{self.data_url}/files/nonexistent.csv")
+        delete_response = self.http.delete(f"{self.data_url}/files/nonexistent.csv")
         assert delete_response.status_code == 404
         assert "Файл не найден в базе данных" in delete_response.json()["detail"]
         
         # 4. Попытка анализа несуществующего файла
-        analysis_response = requests.get(f"{self.processing_url}/analyze/nonexistent.csv")
+        analysis_response = self.http.get(f"{self.processing_url}/analyze/nonexistent.csv")
         assert analysis_response.status_code == 404
         assert "Файл не найден" in analysis_response.json()["detail"]
+        
+        # 5. Запросы без токена к data и processing отклоняются
+        assert requests.get(f"{self.data_url}/files").status_code == 401
+        assert requests.get(f"{self.processing_url}/analyze/nonexistent.csv").status_code == 401
     
     def test_multiple_file_types(self):
         """Тестирование работы с разными типами файлов"""
@@ -232,7 +250,7 @@ class TestIntegration:
         csv_files = {"file": ("test.csv", self.test_csv_content, "text/csv")}
         csv_data = {"title": "CSV Test File"}
         
-        csv_upload_response = requests.post(
+        csv_upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=csv_files,
             data=csv_data
@@ -246,7 +264,7 @@ class TestIntegration:
         image_files = {"file": ("test.jpg", image_content, "image/jpeg")}
         image_data = {"title": "Image Test File"}
         
-        image_upload_response = requests.post(
+        image_upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=image_files,
             data=image_data
@@ -260,7 +278,7 @@ class TestIntegration:
         text_files = {"file": ("test.txt", text_content, "text/plain")}
         text_data = {"title": "Text Test File"}
         
-        text_upload_response = requests.post(
+        text_upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=text_files,
             data=text_data
@@ -270,7 +288,7 @@ class TestIntegration:
         assert text_upload_data["filetype"] == "other"
         
         # 4. Проверяем что все файлы в списке
-        list_response = requests.get(f"{self.data_url}/files")
+        list_response = self.http.get(f"{self.data_url}/files")
         assert list_response.status_code == 200
         files_list = list_response.json()
         
@@ -279,9 +297,9 @@ class TestIntegration:
         assert any(f["filename"] == "test.txt" for f in files_list)
         
         # 5. Очищаем тестовые файлы
-        requests.delete(f"{self.data_url}/files/test.csv")
-        requests.delete(f"{self.data_url}/files/test.jpg")
-        requests.delete(f"{self.data_url}/files/test.txt")
+        self.http.delete(f"{self.data_url}/files/test.csv")
+        self.http.delete(f"{self.data_url}/files/test.jpg")
+        self.http.delete(f"{self.data_url}/files/test.txt")
     
     def test_concurrent_operations(self):
         """Тестирование параллельных операций"""
@@ -296,7 +314,7 @@ class TestIntegration:
                 files = {"file": (f"concurrent_test_{file_num}.csv", self.test_csv_content, "text/csv")}
                 data = {"title": f"Concurrent Test File {file_num}"}
                 
-                response = requests.post(
+                response = self.http.post(
                     f"{self.data_url}/upload",
                     files=files,
                     data=data
@@ -308,7 +326,7 @@ class TestIntegration:
         def list_files():
             """Функция для получения списка файлов"""
             try:
-                response = requests.get(f"{self.data_url}/files")
+                response = self.http.get(f"{self.data_url}/files")
                 results.put(("list", response.status_code))
             except Exception as e:
                 results.put(("list", str(e)))
@@ -349,7 +367,7 @@ class TestIntegration:
         
         # Очищаем тестовые файлы
         for i in range(3):
-            requests.delete(f"{self.data_url}/files/concurrent_test_{i}.csv")
+            self.http.delete(f"{self.data_url}/files/concurrent_test_{i}.csv")
     
     def test_health_checks(self):
         """Тестирование проверки здоровья всех сервисов"""
@@ -361,14 +379,14 @@ class TestIntegration:
         assert auth_health_data["service"] == "auth-service"
         
         # Проверяем здоровье data-service
-        data_health_response = requests.get(f"{self.data_url}/health")
+        data_health_response = self.http.get(f"{self.data_url}/health")
         assert data_health_response.status_code == 200
         data_health_data = data_health_response.json()
         assert data_health_data["status"] == "healthy"
         assert data_health_data["service"] == "data-service"
         
         # Проверяем здоровье processing-service
-        processing_health_response = requests.get(f"{self.processing_url}/health")
+        processing_health_response = self.http.get(f"{self.processing_url}/health")
         assert processing_health_response.status_code == 200
         processing_health_data = processing_health_response.json()
         assert processing_health_data["status"] == "healthy"
@@ -380,7 +398,7 @@ class TestIntegration:
         files = {"file": ("persistence_test.csv", self.test_csv_content, "text/csv")}
         data = {"title": "Persistence Test File", "description": "Test for data persistence"}
         
-        upload_response = requests.post(
+        upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=files,
             data=data
@@ -388,7 +406,7 @@ class TestIntegration:
         assert upload_response.status_code == 200
         
         # 2. Получаем список файлов
-        list_response = requests.get(f"{self.data_url}/files")
+        list_response = self.http.get(f"{self.data_url}/files")
         assert list_response.status_code == 200
         files_list = list_response.json()
         
@@ -399,18 +417,18 @@ class TestIntegration:
         assert test_file["filetype"] == "csv"
         
         # 3. Анализируем файл
-        analysis_response = requests.get(f"{self.processing_url}/analyze/persistence_test.csv")
+        analysis_response = self.http.get(f"{self.processing_url}/analyze/persistence_test.csv")
         assert analysis_response.status_code == 200
         analysis_data = analysis_response.json()
         assert analysis_data["filename"] == "persistence_test.csv"
         
         # 4. Скачиваем файл
-        download_response = requests.get(f"{self.data_url}/download/persistence_test.csv")
+        download_response = self.http.get(f"{self.data_url}/download/persistence_test.csv")
         assert download_response.status_code == 200
         assert download_response.content.decode() == self.test_csv_content
         
         # 5. Удаляем файл
-        delete_response = requests.delete(f"{self.data_url}/files/persistence_test.csv")
+        delete_response = self.http.delete(f"{self.data_url}/files/persistence_test.csv")
         assert delete_response.status_code == 200
     
     def test_large_file_handling(self):
@@ -424,7 +442,7 @@ class TestIntegration:
         files = {"file": ("large_test.csv", large_csv_content, "text/csv")}
         data = {"title": "Large Test File"}
         
-        upload_response = requests.post(
+        upload_response = self.http.post(
             f"{self.data_url}/upload",
             files=files,
             data=data
@@ -432,7 +450,7 @@ class TestIntegration:
         assert upload_response.status_code == 200
         
         # Анализируем большой файл
-        analysis_response = requests.get(f"{self.processing_url}/analyze/large_test.csv")
+        analysis_response = self.http.get(f"{self.processing_url}/analyze/large_test.csv")
         assert analysis_response.status_code == 200
         analysis_data = analysis_response.json()
         
@@ -446,7 +464,7 @@ class TestIntegration:
         assert value_col["max"] == 99900
         
         # Удаляем большой файл
-        delete_response = requests.delete(f"{self.data_url}/files/large_test.csv")
+        delete_response = self.http.delete(f"{self.data_url}/files/large_test.csv")
         assert delete_response.status_code == 200
 
 